@@ -0,0 +1,209 @@
+from collections.abc import Mapping
+from enum import Enum
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Optional, Union
+import hashlib
+import json
+import time
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+# a tensor, a flat dict of tensors (e.g. PruneScores, BatchOutputs), or a dict of dicts of
+# tensors (e.g. CircuitOutputs)
+Artifact = Union[torch.Tensor, Dict[Any, torch.Tensor], Dict[Any, Dict[Any, torch.Tensor]]]
+
+_SEP = "/"
+_TENSOR_NAME = "tensor"
+
+
+def _json_default(obj: Any) -> Any:
+    if isinstance(obj, Enum):
+        return obj.name
+    return str(obj)
+
+
+def config_key(config: Dict[str, Any]) -> str:
+    """Digest of the (json serialized) config that produces an artifact."""
+    config_json = json.dumps(config, sort_keys=True, default=_json_default)
+    return hashlib.blake2b(config_json.encode(), digest_size=16).hexdigest()
+
+
+def _key_type(keys) -> str:
+    return "int" if all(isinstance(k, int) for k in keys) else "str"
+
+
+def _parse_key(key: str, key_type: str) -> Any:
+    return int(key) if key_type == "int" else key
+
+
+def _saveable(tensor: torch.Tensor) -> torch.Tensor:
+    tensor = tensor.detach().cpu().contiguous()
+    return tensor.clone() if tensor._base is not None else tensor # views can't be saved
+
+
+class LazyTensorDict(Mapping):
+    """Read-only dict of tensors, each loaded from a memory-mapped file when accessed."""
+
+    def __init__(self, path: Path, names: Dict[Any, str], device: str = "cpu"):
+        self._file = safe_open(str(path), framework="pt", device=str(device))
+        self._names = names
+
+    def __getitem__(self, key: Any) -> torch.Tensor:
+        return self._file.get_tensor(self._names[key])
+
+    def __iter__(self) -> Iterator:
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+
+class ArtifactStore:
+    """
+    Content-addressed store of tensor artifacts (e.g. prune scores, circuit outputs),
+    keyed by a digest of the config that produced them, so reruns with the same config
+    reuse earlier results instead of recomputing them.
+
+    Each artifact is one safetensors file, loaded lazily (memory-mapped). `manifest.json`
+    records the config, structure, size and last access time of every artifact. When
+    `max_bytes` is set, the least recently used artifacts are evicted to stay within it.
+    Access times of reads are written with the next `put` or `remove`, at most every
+    `ACCESS_WRITE_SECS` by `get`, or by `flush`.
+    """
+
+    MANIFEST = "manifest.json"
+    ACCESS_WRITE_SECS = 60.0
+
+    def __init__(self, root: Union[str, Path], max_bytes: Optional[int] = None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        manifest_path = self.root / self.MANIFEST
+        self.manifest: Dict[str, Dict[str, Any]] = (
+            json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+        )
+        self._dirty = False # access times not yet written
+        self._last_write = time.time()
+
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.safetensors"
+
+    def _write_manifest(self):
+        manifest_path = self.root / self.MANIFEST
+        tmp_path = manifest_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.manifest, indent=4))
+        tmp_path.replace(manifest_path)
+        self._dirty = False
+        self._last_write = time.time()
+
+    def flush(self):
+        """Write access times recorded since the last manifest write."""
+        if self._dirty:
+            self._write_manifest()
+
+    def __contains__(self, config: Dict[str, Any]) -> bool:
+        key = config_key(config)
+        return key in self.manifest and self._path(key).exists()
+
+    def put(self, config: Dict[str, Any], artifact: Artifact) -> str:
+        """
+        Store `artifact` under the digest of `config`.
+
+        Returns:
+            The artifact key.
+        """
+        key = config_key(config)
+        if isinstance(artifact, torch.Tensor):
+            kind, key_types = "tensor", []
+            tensors = {_TENSOR_NAME: artifact}
+        elif all(isinstance(v, torch.Tensor) for v in artifact.values()):
+            kind, key_types = "dict", [_key_type(artifact.keys())]
+            tensors = {str(k): v for k, v in artifact.items()}
+        else:
+            inner_keys = [k for sub_artifact in artifact.values() for k in sub_artifact.keys()]
+            kind, key_types = "nested", [_key_type(artifact.keys()), _key_type(inner_keys)]
+            tensors = {
+                f"{k}{_SEP}{inner_k}": v
+                for k, sub_artifact in artifact.items() for inner_k, v in sub_artifact.items()
+            }
+        tensors = {name: _saveable(tensor) for name, tensor in tensors.items()}
+        save_file(tensors, str(self._path(key)))
+        self.manifest[key] = {
+            "config": json.loads(json.dumps(config, default=_json_default)),
+            "kind": kind,
+            "key_types": key_types,
+            "names": list(tensors.keys()),
+            "nbytes": self._path(key).stat().st_size,
+            "last_access": time.time(),
+        }
+        self._evict(keep=key)
+        self._write_manifest()
+        return key
+
+    def get(self, config: Dict[str, Any], device: str = "cpu", lazy: bool = True) -> Optional[Artifact]:
+        """
+        Load the artifact produced by `config` (or `None` if it is not stored). Dicts of
+        tensors are loaded lazily unless `lazy` is `False`.
+        """
+        if config not in self:
+            return None
+        key = config_key(config)
+        entry = self.manifest[key]
+        entry["last_access"] = time.time()
+        self._dirty = True
+        if entry["last_access"] - self._last_write >= self.ACCESS_WRITE_SECS:
+            self._write_manifest()
+        path = self._path(key)
+        if entry["kind"] == "tensor":
+            return LazyTensorDict(path, {_TENSOR_NAME: _TENSOR_NAME}, device=device)[_TENSOR_NAME]
+        if entry["kind"] == "dict":
+            (key_type,) = entry["key_types"]
+            artifact = LazyTensorDict(
+                path, {_parse_key(name, key_type): name for name in entry["names"]}, device=device
+            )
+            return artifact if lazy else dict(artifact)
+        outer_type, inner_type = entry["key_types"]
+        names: Dict[Any, Dict[Any, str]] = {}
+        for name in entry["names"]:
+            outer, inner = name.split(_SEP, 1)
+            names.setdefault(_parse_key(outer, outer_type), {})[_parse_key(inner, inner_type)] = name
+        artifact = {k: LazyTensorDict(path, sub_names, device=device) for k, sub_names in names.items()}
+        return artifact if lazy else {k: dict(v) for k, v in artifact.items()}
+
+    def get_or_compute(
+        self,
+        config: Dict[str, Any],
+        compute: Callable[[], Artifact],
+        device: str = "cpu",
+        lazy: bool = True,
+    ) -> Artifact:
+        """Load the artifact produced by `config`, computing and storing it if missing."""
+        artifact = self.get(config, device=device, lazy=lazy)
+        if artifact is None:
+            artifact = compute()
+            self.put(config, artifact)
+        return artifact
+
+    def remove(self, config: Dict[str, Any]):
+        self._remove(config_key(config))
+        self._write_manifest()
+
+    def _remove(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+        self.manifest.pop(key, None)
+
+    def _evict(self, keep: str):
+        if self.max_bytes is None:
+            return
+        by_last_access = sorted(self.manifest, key=lambda k: self.manifest[k]["last_access"])
+        total_bytes = sum(entry["nbytes"] for entry in self.manifest.values())
+        for key in by_last_access:
+            if total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total_bytes -= self.manifest[key]["nbytes"]
+            print(f"Evicting artifact {key} ({self.manifest[key]['config']})")
+            self._remove(key)
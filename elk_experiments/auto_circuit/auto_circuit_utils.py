@@ -1,5 +1,5 @@
 
-from typing import Dict, List, Tuple, Optional, Union
+from typing import Callable, Dict, List, Tuple, Optional, Union, NamedTuple
 import math
 from collections import defaultdict
 from contextlib import ExitStack
@@ -7,13 +7,14 @@ from contextlib import ExitStack
 import torch 
 import torch as t
 from torch.nn.functional import log_softmax
+from torch.utils.data import Sampler
 import matplotlib.pyplot as plt
 import numpy as np
 from transformer_lens import HookedTransformer
 
 from cupbearer.data import MixedData
 
-from auto_circuit.types import BatchKey, CircuitOutputs, Measurements, PatchWrapper
+from auto_circuit.types import BatchKey, BatchOutputs, CircuitOutputs, Measurements, PatchWrapper
 from auto_circuit.utils.custom_tqdm import tqdm
 from auto_circuit.utils.patchable_model import PatchableModel
 from auto_circuit.data import PromptDataset, PromptDataLoader, PromptPair, PromptPairBatch
@@ -24,87 +25,399 @@ from auto_circuit.utils.tensor_ops import prune_scores_threshold
 from auto_circuit.visualize import draw_seq_graph
 from auto_circuit.utils.misc import module_by_name
 
+from elk_experiments.utils import tensor_digest
+from elk_experiments.profiler import PROFILER, profiled
+from elk_experiments.auto_circuit.ranked_edges import RankedEdges
+from elk_experiments.auto_circuit.edge_index import EdgeIndex, edge_index
+from elk_experiments.auto_circuit.sparse_prune_scores import SparsePruneScores
+from elk_experiments.auto_circuit.prefix_cache import LayerPrefixCache
+from elk_experiments.auto_circuit.src_ablation_cache import (
+    SrcAblationCache,
+    SRC_ABLATION_CACHE,
+    batch_mean_src_outs,
+)
+from elk_experiments.auto_circuit.compact_outputs import (
+    CompactLogits,
+    OutputStorage,
+    compact_log_answer_dist,
+    compact_log_dist,
+    kl_div_log_probs,
+    output_reducer,
+)
+
 
 EdgeScore = Tuple[str, str, float]
+# reduces a batch of (sliced) model outputs to what is kept, e.g. per instance scores
+OutputReducer = Callable[[torch.Tensor, PromptPairBatch], Union[torch.Tensor, CompactLogits]]
 
 
 
-def make_prompt_dataset(data, effect_tokens, vocab_size, device='cpu'):
-    clean_prompts = [x[0] for x in data]
-    answers = [effect_tokens] * len(clean_prompts)
-    wrong_answers = [list(set(range(vocab_size)) - set(answer)) for answer in answers]
-    
-    # put into torch tensors
-    clean_prompts = torch.stack(clean_prompts, dim=0)
-    corrupt_prompts = torch.stack([torch.zeros_like(clean_prompts[0], dtype=int)] * len(clean_prompts), dim=0)
-    answers = [torch.tensor(answer, dtype=int) for answer in answers]
-    wrong_answers= [torch.tensor(answer, dtype=int) for answer in wrong_answers]
+def wrong_answer_mask(answers: List[int], vocab_size: int) -> torch.Tensor:
+    """
+    Boolean vocab mask that is `True` for every token except `answers`.
 
-    return PromptDataset(clean_prompts, corrupt_prompts, answers, wrong_answers)
+    A single mask is shared by every prompt (see `make_prompt_dataset`), in place of 
+    materializing `set(range(vocab_size)) - set(answers)` for each prompt. Score functions 
+    in `score_funcs` accept wrong answers in this form.
 
-def make_mixed_prompt_dataloader(dataset: MixedData, effect_tokens, model, batch_size, device='cpu'):
-    normal_dataset = make_prompt_dataset(dataset.normal_data, effect_tokens, model.tokenizer.vocab_size, device=device)
-    anomalous_dataset = make_prompt_dataset(dataset.anomalous_data, effect_tokens, model.tokenizer.vocab_size, device=device)
-    prompt_dataset = MixedData(normal_dataset, anomalous_dataset, dataset.normal_weight, dataset.return_anomaly_labels)
-    seq_len = normal_dataset.clean_prompts.size(1)
-    dataloader = PromptDataLoader(
-        prompt_dataset,
-        seq_len=seq_len,
-        diverge_idx=0,
-        batch_size=batch_size,
-        shuffle=False, 
-        collate_fn=collate_fn
+    Args:
+        answers: The answer tokens.
+        vocab_size: The size of the vocabulary.
+
+    Returns:
+        The [vocab_size] boolean wrong answer mask.
+    """
+    mask = torch.ones(vocab_size, dtype=torch.bool)
+    mask[torch.tensor(answers, dtype=torch.long)] = False
+    return mask
+
+
+# built prompt datasets and dataloaders, keyed by dataset fingerprint, effect tokens, 
+# (and batch size), so repeated detector train / eval calls skip rebuilding
+_PROMPT_DATASET_CACHE: Dict[tuple, PromptDataset] = {}
+_PROMPT_LOADER_CACHE: Dict[tuple, PromptDataLoader] = {}
+
+
+def clear_prompt_data_cache():
+    _PROMPT_DATASET_CACHE.clear()
+    _PROMPT_LOADER_CACHE.clear()
+
+
+def dataset_fingerprint(data) -> str:
+    """
+    Digest of the clean prompt tokens of `data` (a sequence of `(prompt, ...)` items).
+
+    Args:
+        data: The dataset to fingerprint.
+
+    Returns:
+        A hex digest identifying the prompts in the dataset.
+    """
+    return tensor_digest(*[x[0] for x in data], digest_size=16)
+
+
+def make_prompt_dataset(
+    data, 
+    effect_tokens, 
+    vocab_size, 
+    device='cpu', 
+    compact_wrong_answers: bool = True,
+    use_cache: bool = True,
+    fingerprint: Optional[str] = None,
+):
+    if use_cache:
+        fingerprint = fingerprint or dataset_fingerprint(data)
+        cache_key = (fingerprint, tuple(effect_tokens), vocab_size, compact_wrong_answers)
+        if cache_key in _PROMPT_DATASET_CACHE:
+            return _PROMPT_DATASET_CACHE[cache_key]
+    prompt_lens = set(len(x[0]) for x in data)
+    if len(prompt_lens) == 1:
+        clean_prompts = torch.stack([x[0] for x in data], dim=0)
+        # corrupt prompts are all zeros, so expand (rather than copy) a single corrupt prompt
+        corrupt_prompts = torch.zeros_like(clean_prompts[0], dtype=int).expand(len(clean_prompts), -1)
+    else: # variable length prompts (batched by length, see LengthBucketBatchSampler)
+        clean_prompts = [x[0] for x in data]
+        corrupt_prompt_by_len = {seq_len: torch.zeros(seq_len, dtype=int) for seq_len in prompt_lens}
+        corrupt_prompts = [corrupt_prompt_by_len[len(prompt)] for prompt in clean_prompts]
+    # answers are the same for every prompt, so expand (rather than copy) a single tensor
+    answers = torch.tensor(effect_tokens, dtype=int).expand(len(clean_prompts), -1)
+    if compact_wrong_answers: # O(V) shared vocab mask instead of O(N*V) token lists
+        wrong_answers = wrong_answer_mask(effect_tokens, vocab_size).expand(len(clean_prompts), -1)
+    else: # token lists, for score functions that only accept index wrong answers
+        wrong_answer = torch.tensor(list(set(range(vocab_size)) - set(effect_tokens)), dtype=int)
+        wrong_answers = wrong_answer.expand(len(clean_prompts), -1)
+    prompt_dataset = PromptDataset(clean_prompts, corrupt_prompts, answers, wrong_answers)
+    if use_cache:
+        _PROMPT_DATASET_CACHE[cache_key] = prompt_dataset
+    return prompt_dataset
+
+def make_mixed_prompt_dataloader(dataset: MixedData, effect_tokens, model, batch_size, device='cpu', use_cache: bool = True):
+    if isinstance(dataset, PromptDataLoader): # already built (e.g. streaming_data loaders)
+        return dataset
+    vocab_size = model.tokenizer.vocab_size
+    if use_cache:
+        normal_fingerprint = dataset_fingerprint(dataset.normal_data)
+        anomalous_fingerprint = dataset_fingerprint(dataset.anomalous_data)
+        cache_key = (
+            "mixed", normal_fingerprint, anomalous_fingerprint, dataset.normal_weight, 
+            dataset.return_anomaly_labels, tuple(effect_tokens), vocab_size, batch_size
+        )
+        if cache_key in _PROMPT_LOADER_CACHE:
+            return _PROMPT_LOADER_CACHE[cache_key]
+    else: 
+        normal_fingerprint, anomalous_fingerprint = None, None
+    normal_dataset = make_prompt_dataset(
+        dataset.normal_data, effect_tokens, vocab_size, device=device, use_cache=use_cache, fingerprint=normal_fingerprint
     )
+    anomalous_dataset = make_prompt_dataset(
+        dataset.anomalous_data, effect_tokens, vocab_size, device=device, use_cache=use_cache, fingerprint=anomalous_fingerprint
+    )
+    prompt_dataset = MixedData(normal_dataset, anomalous_dataset, dataset.normal_weight, dataset.return_anomaly_labels)
+    dataloader = make_length_bucketed_loader(prompt_dataset, batch_size, collate_fn=collate_fn)
+    if use_cache:
+        _PROMPT_LOADER_CACHE[cache_key] = dataloader
     return dataloader
 
-def make_prompt_data_loader(dataset, effect_tokens, model, batch_size):
-    prompt_dataset = make_prompt_dataset(dataset, effect_tokens, model.tokenizer.vocab_size)
-    seq_len = prompt_dataset.clean_prompts.size(1)
-    dataloader = PromptDataLoader(
-        prompt_dataset,
-        seq_len=seq_len,
-        diverge_idx=0,
-        batch_size=batch_size,
-        shuffle=False
+def make_prompt_data_loader(dataset, effect_tokens, model, batch_size, use_cache: bool = True):
+    if isinstance(dataset, PromptDataLoader): # already built (e.g. streaming_data loaders)
+        return dataset
+    vocab_size = model.tokenizer.vocab_size
+    fingerprint = None
+    if use_cache:
+        fingerprint = dataset_fingerprint(dataset)
+        cache_key = (fingerprint, tuple(effect_tokens), vocab_size, batch_size)
+        if cache_key in _PROMPT_LOADER_CACHE:
+            return _PROMPT_LOADER_CACHE[cache_key]
+    prompt_dataset = make_prompt_dataset(
+        dataset, effect_tokens, vocab_size, use_cache=use_cache, fingerprint=fingerprint
     )
+    dataloader = make_length_bucketed_loader(prompt_dataset, batch_size, collate_fn=prompt_collate_fn)
+    if use_cache:
+        _PROMPT_LOADER_CACHE[cache_key] = dataloader
     return dataloader
 
 
 
-def collate_fn(batch: List[Tuple[PromptPair, int]]) -> Tuple[PromptPairBatch, torch.Tensor]:
-    clean = torch.stack([p.clean for p, y in batch])
-    corrupt = torch.stack([p.corrupt for p, y in batch])
-    labels = torch.tensor([y for p, y in batch], dtype=torch.int)
-    if all([p.answers.shape == batch[0][0].answers.shape for p, y in batch]):
-        answers = torch.stack([p.answers for p, y in batch])
+class PromptBucket(NamedTuple):
+    seq_len: int
+    diverge_idx: int
+    n_prompts: int
+
+
+class LengthBucketBatchSampler(Sampler[List[int]]):
+    """
+    Batch sampler that groups prompts by length, so every batch can be stacked without 
+    padding. Buckets are visited in order of increasing length, and prompts within a 
+    bucket in dataset order.
+    """
+
+    def __init__(self, lengths: List[int], batch_size: int, drop_last: bool = False):
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.buckets: Dict[int, List[int]] = defaultdict(list)
+        for idx, length in enumerate(lengths):
+            self.buckets[length].append(idx)
+
+    def _bucket_batches(self, idxs: List[int]) -> int:
+        if self.drop_last:
+            return len(idxs) // self.batch_size
+        return math.ceil(len(idxs) / self.batch_size)
+
+    def __iter__(self):
+        for length in sorted(self.buckets):
+            idxs = self.buckets[length]
+            for batch_idx in range(self._bucket_batches(idxs)):
+                yield idxs[batch_idx * self.batch_size:(batch_idx + 1) * self.batch_size]
+
+    def __len__(self) -> int:
+        return sum(self._bucket_batches(idxs) for idxs in self.buckets.values())
+
+
+class BucketedPromptDataLoader(PromptDataLoader):
+    """
+    `PromptDataLoader` whose batches come from a `LengthBucketBatchSampler` (with
+    `drop_last`, so every batch has `batch_size` prompts of one length). The sampler is
+    used by `__iter__` rather than passed to `DataLoader`, as `PromptDataLoader` always
+    passes `drop_last=True`, which `DataLoader` does not allow with a `batch_sampler`.
+    """
+
+    def __init__(self, prompt_dataset, lengths: List[int], batch_size: int, **kwargs):
+        self.length_sampler = LengthBucketBatchSampler(lengths, batch_size, drop_last=True)
+        super().__init__(prompt_dataset, batch_size=batch_size, shuffle=False, **kwargs)
+
+    def __iter__(self):
+        for idxs in self.length_sampler:
+            yield self.collate_fn([self.dataset[idx] for idx in idxs])
+
+    def __len__(self) -> int:
+        return len(self.length_sampler)
+
+
+def _prompt_pair(item) -> PromptPair:
+    return item if isinstance(item, PromptPair) else item[0] # (prompt pair, label) 
+
+
+def _first_diverge_idx(clean: torch.Tensor, corrupt: torch.Tensor) -> int:
+    """The minimum over `[n, seq]` prompt pairs of the first index where they differ (0 if any are equal)."""
+    differs = clean != corrupt
+    if not differs.any(dim=1).all():
+        return 0
+    return int(differs.any(dim=0).int().argmax().item())
+
+
+def _bucket_prompts(
+    lengths: List[int], clean: List[torch.Tensor], corrupt: List[torch.Tensor]
+) -> Dict[int, PromptBucket]:
+    # one stacked diverge index computation per length (not one sync per prompt)
+    bucket_idxs: Dict[int, List[int]] = defaultdict(list)
+    for idx, length in enumerate(lengths):
+        bucket_idxs[length].append(idx)
+    return {
+        length: PromptBucket(
+            length,
+            _first_diverge_idx(torch.stack([clean[i] for i in idxs]), torch.stack([corrupt[i] for i in idxs])),
+            len(idxs),
+        )
+        for length, idxs in bucket_idxs.items()
+    }
+
+
+def _merge_buckets(*bucket_dicts: Dict[int, PromptBucket]) -> Dict[int, PromptBucket]:
+    merged: Dict[int, PromptBucket] = {}
+    for buckets in bucket_dicts:
+        for length, bucket in buckets.items():
+            if length in merged:
+                other = merged[length]
+                bucket = PromptBucket(length, min(bucket.diverge_idx, other.diverge_idx), bucket.n_prompts + other.n_prompts)
+            merged[length] = bucket
+    return merged
+
+
+def _prompt_buckets(prompt_dataset) -> Tuple[List[int], Dict[int, PromptBucket]]:
+    """
+    The prompt length of each item of `prompt_dataset` and the buckets of each length.
+    Stacked `PromptDataset`s (and `MixedData` of them) are bucketed without touching
+    their items.
+    """
+    clean_prompts = getattr(prompt_dataset, "clean_prompts", None)
+    corrupt_prompts = getattr(prompt_dataset, "corrupt_prompts", None)
+    if isinstance(clean_prompts, torch.Tensor): # stacked, so fixed length
+        n_prompts, seq_len = clean_prompts.shape[:2]
+        bucket = PromptBucket(seq_len, _first_diverge_idx(clean_prompts, corrupt_prompts), n_prompts)
+        return [seq_len] * n_prompts, {seq_len: bucket}
+    if isinstance(clean_prompts, list) and isinstance(corrupt_prompts, list):
+        lengths = [prompt.size(0) for prompt in clean_prompts]
+        return lengths, _bucket_prompts(lengths, clean_prompts, corrupt_prompts)
+    if isinstance(prompt_dataset, MixedData): # normal items, then anomalous items
+        normal_len = getattr(prompt_dataset, "normal_len", len(prompt_dataset.normal_data))
+        anomalous_len = getattr(prompt_dataset, "anomalous_len", len(prompt_dataset.anomalous_data))
+        # (only if every item of both halves is used, otherwise bucket the items)
+        if normal_len == len(prompt_dataset.normal_data) and anomalous_len == len(prompt_dataset.anomalous_data):
+            normal_lengths, normal_buckets = _prompt_buckets(prompt_dataset.normal_data)
+            anomalous_lengths, anomalous_buckets = _prompt_buckets(prompt_dataset.anomalous_data)
+            return normal_lengths + anomalous_lengths, _merge_buckets(normal_buckets, anomalous_buckets)
+    pairs = [_prompt_pair(prompt_dataset[i]) for i in range(len(prompt_dataset))]
+    lengths = [pair.clean.size(0) for pair in pairs]
+    return lengths, _bucket_prompts(lengths, [pair.clean for pair in pairs], [pair.corrupt for pair in pairs])
+
+
+def make_length_bucketed_loader(prompt_dataset, batch_size: int, collate_fn=None) -> PromptDataLoader:
+    """
+    Construct a `PromptDataLoader` over `prompt_dataset`. If the prompts have different 
+    lengths, batches are bucketed by length (with a `BucketedPromptDataLoader`), the 
+    loader `seq_len` is `None` and `dataloader.buckets` maps each prompt length to its 
+    `PromptBucket` (`seq_len` and `diverge_idx`). As with `PromptDataLoader`, every batch
+    has `batch_size` prompts (the remainder of each bucket is dropped).
+
+    Args:
+        prompt_dataset: A `PromptDataset`, or a dataset of `(PromptPair, label)` items.
+        batch_size: The batch size.
+        collate_fn: The collate function.
+
+    Returns:
+        The dataloader.
+    """
+    lengths, buckets = _prompt_buckets(prompt_dataset)
+    if len(buckets) == 1:
+        dataloader = PromptDataLoader(
+            prompt_dataset,
+            seq_len=next(iter(buckets)),
+            diverge_idx=0,
+            batch_size=batch_size,
+            shuffle=False,
+            collate_fn=collate_fn
+        )
+    else:
+        dataloader = BucketedPromptDataLoader(
+            prompt_dataset,
+            lengths,
+            seq_len=None,
+            diverge_idx=min(bucket.diverge_idx for bucket in buckets.values()),
+            batch_size=batch_size,
+            collate_fn=collate_fn
+        )
+    dataloader.buckets = buckets
+    return dataloader
+
+
+def stack_shared(tensors: List[torch.Tensor]) -> torch.Tensor:
+    """
+    Stack `tensors`, expanding (rather than copying) when they are all views of the same 
+    data (e.g. the shared wrong answer mask from `make_prompt_dataset`).
+    """
+    first = tensors[0]
+    if all(
+        x.data_ptr() == first.data_ptr() and x.shape == first.shape and x.stride() == first.stride() 
+        for x in tensors
+    ):
+        return first.unsqueeze(0).expand(len(tensors), *first.shape)
+    return torch.stack(tensors)
+
+
+def batch_key(clean: torch.Tensor, corrupt: torch.Tensor) -> BatchKey:
+    """
+    Key of a batch of prompts: a digest of the raw clean and corrupt token bytes. The key 
+    is stable across processes, so `BatchKey`-indexed outputs (`CircuitOutputs`, src 
+    outs, model outputs) can be saved to disk and reused by later runs.
+    """
+    return int(tensor_digest(clean, corrupt), 16)
+
+
+def collate_prompt_pairs(pairs: List[PromptPair]) -> PromptPairBatch:
+    clean = torch.stack([p.clean for p in pairs])
+    corrupt = stack_shared([p.corrupt for p in pairs])
+    if all([p.answers.shape == pairs[0].answers.shape for p in pairs]):
+        answers = stack_shared([p.answers for p in pairs])
     else:  # Sometimes each prompt has a different number of answers
-        answers = [p.answers for p, y in batch]
-    if all([p.wrong_answers.shape == batch[0][0].wrong_answers.shape for p, y in batch]):
-        wrong_answers = torch.stack([p.wrong_answers for p, y in batch])
+        answers = [p.answers for p in pairs]
+    if all([p.wrong_answers.shape == pairs[0].wrong_answers.shape for p in pairs]):
+        wrong_answers = stack_shared([p.wrong_answers for p in pairs])
     else:  # Sometimes each prompt has a different number of wrong answers
-        wrong_answers = [p.wrong_answers for p, y in batch]
-    key = hash((str(clean.tolist()), str(corrupt.tolist())))
+        wrong_answers = [p.wrong_answers for p in pairs]
+    key = batch_key(clean, corrupt)
 
     diverge_idxs = (~(clean == corrupt)).int().argmax(dim=1)
     batch_dvrg_idx: int = int(diverge_idxs.min().item())
-    return PromptPairBatch(key, batch_dvrg_idx, clean, corrupt, answers, wrong_answers), labels
+    return PromptPairBatch(key, batch_dvrg_idx, clean, corrupt, answers, wrong_answers)
+
+
+def prompt_collate_fn(batch: List[PromptPair]) -> PromptPairBatch:
+    return collate_prompt_pairs(batch)
+
+
+def collate_fn(batch: List[Tuple[PromptPair, int]]) -> Tuple[PromptPairBatch, torch.Tensor]:
+    labels = torch.tensor([y for p, y in batch], dtype=torch.int)
+    return collate_prompt_pairs([p for p, y in batch]), labels
+
+
+class BatchShard:
+    """
+    A subset of the batches of a dataloader, iterable in place of the dataloader (e.g. to
+    run circuits on some batches, see `parallel_run_circuits` and sequential equiv tests).
+    """
+
+    def __init__(self, batches: List[PromptPairBatch], seq_labels: Optional[List[str]] = None):
+        self.batches = batches
+        self.seq_labels = seq_labels
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
 
 
 def sorted_scores(scores: PruneScores, model: PatchableModel) -> List[EdgeScore]:
-    sorted_srcs = sorted(model.srcs, key=lambda x: x.src_idx)
-    sorted_dests_by_module = {mod.module_name: sorted([dest for dest in model.dests if dest.module_name == mod.module_name], key=lambda x: x.head_idx) for mod in model.dest_wrappers}
-    
-    score_thruple = []
-    for mod_name, score in scores.items():
-        if score.ndim == 1:
-            score = score.unsqueeze(0)
-        for i in range(score.shape[0]):
-            dest_name = sorted_dests_by_module[mod_name][i].name
-            for j in range(score.shape[1]):
-                src_name = sorted_srcs[j].name
-                score_thruple.append((src_name, dest_name, score[i, j]))
-    score_thruple.sort(key=lambda x: abs(x[2]), reverse=True)
-    return score_thruple
+    index = edge_index(model)
+    sorted_vals, edge_ids = index.sort(scores, use_abs=True)
+    coords = index.coords
+    src_names = {src.src_idx: src.name for src in model.srcs}
+    dest_names = {(dest.module_name, dest.head_idx): dest.name for dest in model.dests}
+    mod_ids, heads, srcs = (c[edge_ids.to(c.device)].tolist() for c in (coords.module, coords.head, coords.src))
+    return [
+        (src_names[src], dest_names[(index.module_names[mod_id], head if head >= 0 else None)], score)
+        for mod_id, head, src, score in zip(mod_ids, heads, srcs, sorted_vals.tolist())
+    ]
 
 
 def log_answer_dist(logits, answers: torch.Tensor):
@@ -132,6 +445,9 @@ def measure_kl_div(
         compare_to_clean: Whether to compare the circuit output to the full model on the
             clean (`True`) or corrupt (`False`) prompt.
         over_vals: Whether to take KL over [answer, wrong_answer] or entire token distribution
+            (`OutputStorage.ANSWERS` outputs only support `over_vals`; for other compact
+            outputs the KL is over the kept tokens and the rest of the vocab, a lower
+            bound on the full KL)
 
     Returns:
         A list of tuples, where the first element is the number of edges pruned and the
@@ -139,30 +455,37 @@ def measure_kl_div(
     """
     circuit_kl_divs: Measurements = []
     default_logprobs: Dict[BatchKey, t.Tensor] = {}
+    # compact circuit outputs need the full target distribution (coarsened per circuit)
+    compact = any(
+        isinstance(out, CompactLogits) for circuit_out in circuit_outs.values() for out in circuit_out.values()
+    )
     with t.inference_mode():
         for batch in dataloader:
             default_batch = batch.clean if compare_to_clean else batch.corrupt
             logits = model(default_batch)[model.out_slice]
-            default_logprobs[batch.key] = log_softmax(logits, dim=-1) if not over_vals else log_answer_dist(logits, batch.answers)
+            if not over_vals or compact:
+                default_logprobs[batch.key] = log_softmax(logits, dim=-1)
+            else:
+                default_logprobs[batch.key] = log_answer_dist(logits, batch.answers)
 
     for edge_count, circuit_out in (pruned_out_pbar := tqdm(circuit_outs.items())):
         pruned_out_pbar.set_description_str(f"KL Div for {edge_count} edges")
-        circuit_logprob_list: List[t.Tensor] = []
-        default_logprob_list: List[t.Tensor] = []
+        kl_instance_list: List[t.Tensor] = []
         for batch in dataloader:
-            circuit_logprob_list.append(log_softmax(circuit_out[batch.key], dim=-1) if not over_vals else log_answer_dist(circuit_out[batch.key], batch.answers))
-            default_logprob_list.append(default_logprobs[batch.key])
+            out, target_logprobs = circuit_out[batch.key], default_logprobs[batch.key]
+            if isinstance(out, CompactLogits) and over_vals:
+                input_logprobs = compact_log_answer_dist(out.to(target_logprobs.device))
+                target_logprobs = log_answer_dist(target_logprobs, batch.answers)
+            elif isinstance(out, CompactLogits):
+                input_logprobs, target_logprobs = compact_log_dist(out.to(target_logprobs.device), target_logprobs)
+            elif over_vals:
+                input_logprobs = log_answer_dist(out.float(), batch.answers)
+            else:
+                input_logprobs = log_softmax(out.float(), dim=-1)
+            kl_instance_list.append(kl_div_log_probs(input_logprobs, target_logprobs))
         
-        input_logprobs = t.cat(circuit_logprob_list)
-        target_logprobs = t.cat(default_logprob_list)
-        n_batch = math.prod(input_logprobs.shape[:-1])
-        kl_instance = torch.nn.functional.kl_div( 
-            input_logprobs,
-            target_logprobs,
-            reduction="none",
-            log_target=True,
-        )
-        kl_instance = kl_instance.sum(dim=-1) # sum over "clases"
+        kl_instance = t.cat(kl_instance_list) # summed over "classes"
+        n_batch = kl_instance.numel()
         kl = kl_instance.sum() / n_batch
         # kl = multibatch_kl_div(input_logprobs, target_logprobs)
        
@@ -266,11 +589,12 @@ def desc_prune_scores(prune_scores: PruneScores, per_inst: bool=False, use_abs=T
     return prune_scores_flat.sort(descending=True).values
 
 def prune_scores_threshold(
-    prune_scores: PruneScores | t.Tensor, edge_count: int, use_abs: bool = True
+    prune_scores: PruneScores | t.Tensor | RankedEdges, edge_count: int, use_abs: bool = True
 ) -> t.Tensor:
     """
     Return the minimum absolute value of the top `edge_count` prune scores.
-    Supports passing in a pre-sorted tensor of prune scores to avoid re-sorting.
+    Supports passing in a pre-sorted tensor of prune scores or a `RankedEdges` to avoid
+    re-sorting.
 
     Args:
         prune_scores: The prune scores to threshold.
@@ -282,11 +606,13 @@ def prune_scores_threshold(
     if edge_count == 0:
         return t.tensor(float("inf"))  # return the maximum value so no edges are pruned
 
+    if isinstance(prune_scores, RankedEdges):
+        return prune_scores.threshold(edge_count)
     if isinstance(prune_scores, t.Tensor):
         assert prune_scores.ndim == 1
         return prune_scores[edge_count - 1]
     else:
-        return desc_prune_scores(prune_scores, use_abs=use_abs)[edge_count - 1]
+        return RankedEdges(prune_scores, use_abs=use_abs).threshold(edge_count)
 
 
 
@@ -296,10 +622,130 @@ def expand_patch_src_out(patch_src_out: torch.Tensor, batch_size: int):
     )
 
 
+def repeat_patch_src_out(patch_src_out: torch.Tensor, n_repeats: int) -> torch.Tensor:
+    """Repeat the patch src outs along the batch dim (expanding if the batch dim is 1)."""
+    if patch_src_out.size(1) == 1:
+        return expand_patch_src_out(patch_src_out, n_repeats)
+    return patch_src_out.repeat(1, n_repeats, *((1,) * (patch_src_out.ndim - 2)))
+
+
+class CircuitMasks:
+    """
+    Sets the patch masks of the circuits of ranked prune scores. The dest wrappers are
+    resolved once, and the masks of every module (for any number of thresholds) are
+    computed in a single device-side comparison on the flat scores, then split into per
+    module views, so setting a circuit's masks launches one kernel and never syncs.
+    """
+
+    def __init__(self, model: PatchableModel, ranked_edges: RankedEdges, patch_type: PatchType):
+        self.ranked_edges = ranked_edges
+        self.patch_type = patch_type
+        start_dim = 1 if ranked_edges.per_inst else 0
+        self.dests: List[PatchWrapper] = []
+        self.shapes: List[torch.Size] = []
+        for mod_name, scores in ranked_edges.prune_scores.items():
+            dest = module_by_name(model, mod_name)
+            assert isinstance(dest, PatchWrapper)
+            assert dest.is_dest and dest.patch_mask is not None
+            self.dests.append(dest)
+            self.shapes.append(scores.shape[start_dim:])
+        self.sizes = [math.prod(shape) for shape in self.shapes]
+
+    def flat_masks(self, thresholds: List[torch.Tensor | float]) -> torch.Tensor:
+        """The flat masks (1 = ablated) of each threshold (`[n_thresholds, (batch), n_edges]`)."""
+        thresholds = self.ranked_edges.threshold_tensor(thresholds).unsqueeze(-1)
+        scores = self.ranked_edges.scores.unsqueeze(0)
+        if self.patch_type == PatchType.EDGE_PATCH:
+            return (scores >= thresholds).float()
+        assert self.patch_type == PatchType.TREE_PATCH
+        return (scores < thresholds).float()
+
+    def set_masks(self, flat_mask: torch.Tensor, alias: bool = False):
+        """
+        Set the patch masks to a flat `[..., n_edges]` mask. The masks are views of a copy
+        of `flat_mask` (in-place mask updates, e.g. upstream `set_all_masks`, would
+        otherwise write into the caller's tensor), or of `flat_mask` itself with `alias`
+        (for temporary masks, or masks meant to be updated through `flat_mask`).
+        """
+        flat_mask = flat_mask if alias else flat_mask.clone()
+        for dest, shape, mask in zip(self.dests, self.shapes, flat_mask.split(self.sizes, dim=-1)):
+            dest.patch_mask.data = mask.unflatten(-1, shape)
+
+    def edge_counts(self, thresholds: List[torch.Tensor | float]) -> List[int]:
+        """Edges in the circuit of each threshold (summed over instances), in one sync."""
+        counts = self.ranked_edges.counts(thresholds)
+        return counts.reshape(len(thresholds), -1).sum(dim=-1).tolist()
+
+
+class IncrementalCircuitMasks(CircuitMasks):
+    """
+    `CircuitMasks` for sweeps over edge counts: the patch masks are views of one flat
+    mask, and moving from one edge count to another flips only the edges (in ranked
+    order) that enter or leave the circuit, so each step costs O(delta edges).
+
+    The circuit of edge count `k` is the top `k` edges in ranked order, which (for edge
+    counts of thresholds) is the circuit of the threshold, ties included.
+    """
+
+    def __init__(self, model: PatchableModel, ranked_edges: RankedEdges, patch_type: PatchType):
+        assert not ranked_edges.per_inst
+        super().__init__(model, ranked_edges, patch_type)
+        self.in_circuit_val = 1.0 if patch_type == PatchType.EDGE_PATCH else 0.0
+        self.order = ranked_edges.order
+        self.flat_mask = torch.full_like(ranked_edges.scores, 1.0 - self.in_circuit_val)
+        self.edge_count = 0
+
+    def set_edge_count(self, edge_count: int):
+        if edge_count > self.edge_count:
+            self.flat_mask[self.order[self.edge_count:edge_count]] = self.in_circuit_val
+        elif edge_count < self.edge_count:
+            self.flat_mask[self.order[edge_count:self.edge_count]] = 1.0 - self.in_circuit_val
+        self.edge_count = edge_count
+        self.set_masks(self.flat_mask, alias=True) # (re)bind the views, in case the masks were replaced
+
+    def sweep_order(self, edge_counts: List[int]) -> List[int]:
+        """Indices of `edge_counts` in monotone order, starting from the end nearest the current count."""
+        order = sorted(range(len(edge_counts)), key=lambda i: edge_counts[i])
+        if abs(self.edge_count - edge_counts[order[-1]]) < abs(self.edge_count - edge_counts[order[0]]):
+            order.reverse()
+        return order
+
+
+class SparseCircuitMasks(CircuitMasks):
+    """
+    `CircuitMasks` for `SparsePruneScores`: the masks of each threshold are the base
+    circuit's masks (one comparison on the shared flat scores), expanded to the batch
+    size, with the masks of the overridden (instance, edge) entries set in one scatter.
+    """
+
+    def __init__(self, model: PatchableModel, sparse_scores: SparsePruneScores, patch_type: PatchType):
+        super().__init__(model, sparse_scores.ranked_edges, patch_type)
+        self.sparse_scores = sparse_scores
+        self.in_circuit_val = 1.0 if patch_type == PatchType.EDGE_PATCH else 0.0
+
+    def flat_masks(self, thresholds: List[torch.Tensor | float]) -> torch.Tensor:
+        """The flat masks (1 = ablated) of each threshold (`[n_thresholds, batch, n_edges]`)."""
+        sparse_scores = self.sparse_scores
+        masks = super().flat_masks(thresholds).unsqueeze(1).repeat(1, sparse_scores.batch_size, 1)
+        thresholds = self.ranked_edges.threshold_tensor(thresholds).unsqueeze(-1)
+        override_scores = sparse_scores.override_scores().unsqueeze(0)
+        if self.patch_type == PatchType.EDGE_PATCH:
+            override_masks = override_scores >= thresholds
+        else:
+            override_masks = override_scores < thresholds
+        masks[:, sparse_scores.inst_idxs, sparse_scores.edge_ids] = override_masks.float()
+        return masks
+
+    def edge_counts(self, thresholds: List[torch.Tensor | float]) -> List[int]:
+        """Edges in the circuit of each threshold (summed over instances), in one sync."""
+        return (self.flat_masks(thresholds) == self.in_circuit_val).sum(dim=(1, 2)).tolist()
+
+
+@profiled()
 def run_circuits(
     model: PatchableModel,
     dataloader: PromptDataLoader,
-    prune_scores: Optional[Union[PruneScores, Dict[BatchKey, PruneScores]]] = None,
+    prune_scores: Optional[Union[PruneScores, Dict[BatchKey, PruneScores], Dict[BatchKey, SparsePruneScores]]] = None,
     thresholds: Optional[List[float]] = None,
     edges: Optional[List[Edge]] = None, # compliment of circuit
     patch_type: PatchType = PatchType.EDGE_PATCH,
@@ -307,6 +753,16 @@ def run_circuits(
     reverse_clean_corrupt: bool = False,
     use_abs: bool = True,
     test_edge_counts: Optional[List[int]] = None,
+    ranked_edges: Optional[RankedEdges] = None,
+    circuits_per_forward: int = 1,
+    incremental_masks: bool = False,
+    prefix_cache: Optional[LayerPrefixCache] = None,
+    reducer: Optional[OutputReducer] = None,
+    output_storage: OutputStorage = OutputStorage.FULL,
+    output_topk: Optional[int] = None,
+    output_dtype: Optional[torch.dtype] = None,
+    src_ablation_cache: Optional[SrcAblationCache] = None,
+    mean_src_outs: Optional[Dict[int, torch.Tensor]] = None,
     render_graph: bool = False,
     render_score_threshold: bool = False,
     render_file_path: Optional[str] = None,
@@ -318,7 +774,30 @@ def run_circuits(
         model: The model to run
         dataloader: The dataloader to use for input and patches
         test_edge_counts: The numbers of edges to prune.
-        prune_scores: The scores that determine the ordering of edges for pruning
+        prune_scores: The scores that determine the ordering of edges for pruning (or per
+            instance scores for each batch key, dense or as `SparsePruneScores`)
+        ranked_edges: The ranked `prune_scores` (pass to reuse the ranking across calls).
+        circuits_per_forward: The number of circuits (thresholds) to evaluate in a single
+            forward pass, by stacking the circuits along the batch dim (with per instance
+            masks). Trades memory (`circuits_per_forward` x batch size) for fewer passes.
+        incremental_masks: Update the masks incrementally between consecutive edge counts
+            (in sorted order, alternating direction across batches) instead of rebuilding
+            them for each threshold.
+        prefix_cache: Reuse the activations of the previous circuit run on each batch below
+            the first layer where the masks differ (pass the same cache across calls to
+            reuse activations across calls).
+        reducer: Applied to the output of each circuit on each batch (e.g. a score
+            function from `score_funcs.get_score_func`), so only the reduced outputs
+            (e.g. [batch] scores instead of [batch, vocab] logits) are kept.
+        output_storage: Keep the full logits, only the answer logits, or only the top
+            `output_topk` logits (the compact forms are `CompactLogits`, with the vocab
+            logsumexp, see `measure_kl_div`). Not used with `reducer`.
+        output_dtype: Keep the (kept) logits in this dtype (e.g. `torch.bfloat16`).
+        src_ablation_cache: The cache of dataset mean src outs, for `ablation_type`s with
+            `mean_over_dataset` (default `SRC_ABLATION_CACHE`).
+        mean_src_outs: The dataset mean src outs for each sequence length (as returned by
+            `SrcAblationCache.src_outs`), e.g. computed over a larger dataloader than
+            `dataloader` (overrides `src_ablation_cache`).
         patch_type: Whether to patch the circuit or the complement.
         ablation_type: The type of ablation to use.
         reverse_clean_corrupt: Reverse clean and corrupt (for input and patches).
@@ -330,7 +809,7 @@ def run_circuits(
         A dictionary mapping from the number of pruned edges to a
             [`BatchOutputs`][auto_circuit.types.BatchOutputs] object, which is a
             dictionary mapping from [`BatchKey`s][auto_circuit.types.BatchKey] to output
-            tensors.
+            tensors (reduced by `reducer`, if given).
     """
     # must define method for constructing circuitt 
     if prune_scores is not None:
@@ -339,21 +818,31 @@ def run_circuits(
         assert prune_scores is None
         assert patch_type == PatchType.EDGE_PATCH #must use edge patch for patching edges 
 
-    per_inst = isinstance(next(iter(prune_scores.values())), dict)
+    if output_storage != OutputStorage.FULL or output_dtype is not None:
+        assert reducer is None, "reducer and compact output storage are exclusive"
+        reducer = output_reducer(output_storage, k=output_topk, dtype=output_dtype)
+
+    per_inst = isinstance(next(iter(prune_scores.values())), (dict, SparsePruneScores))
     circ_outs: CircuitOutputs = defaultdict(dict)
     if per_inst: 
         prune_scores_all: Dict[BatchKey, PruneScores] = prune_scores
-        desc_ps_all: Dict[BatchKey: torch.Tensor] = {
-            batch_key: desc_prune_scores(ps, per_inst=per_inst, use_abs=use_abs) 
-            for batch_key, ps in prune_scores_all.items()
-        }
+        # ranked lazily (only to count edges)
+        ranked_edges_all: Dict[BatchKey, RankedEdges] = {}
     else:
-        desc_ps: torch.Tensor = desc_prune_scores(prune_scores, use_abs=use_abs)
+        if ranked_edges is None or ranked_edges.prune_scores is not prune_scores or ranked_edges.use_abs != use_abs:
+            ranked_edges = RankedEdges(prune_scores, use_abs=use_abs)
+        if test_edge_counts is not None:
+            thresholds = ranked_edges.thresholds(test_edge_counts)
     # check if prune scores are instance specific (in which case we need to add the set_batch_size context)
   
+    # built once (or once per batch for per instance scores)
+    circuit_masks: Optional[CircuitMasks] = None
+    edge_counts: List[int] = []
+
     patch_src_outs: Optional[t.Tensor] = None
-    if ablation_type.mean_over_dataset:
-        patch_src_outs = src_ablations(model, dataloader, ablation_type)
+    if ablation_type.mean_over_dataset and mean_src_outs is None:
+        with PROFILER.span("src_ablations", dataset_mean=True):
+            mean_src_outs = (src_ablation_cache or SRC_ABLATION_CACHE).src_outs(model, dataloader, ablation_type)
 
     for batch_idx, batch in enumerate(batch_pbar := tqdm(dataloader)):
         batch_pbar.set_description_str(f"Pruning Batch {batch_idx}", refresh=True)
@@ -362,52 +851,89 @@ def run_circuits(
         ):
             batch_input = batch.clean
             if not ablation_type.mean_over_dataset:
-                patch_src_outs = src_ablations(model, batch.corrupt, ablation_type)
+                with PROFILER.span("src_ablations"):
+                    patch_src_outs = src_ablations(model, batch.corrupt, ablation_type)
+            else:
+                patch_src_outs = batch_mean_src_outs(mean_src_outs, batch_input)
         elif (patch_type == PatchType.EDGE_PATCH and not reverse_clean_corrupt) or (
             patch_type == PatchType.TREE_PATCH and reverse_clean_corrupt
         ):
             batch_input = batch.corrupt
             if not ablation_type.mean_over_dataset:
-                patch_src_outs = src_ablations(model, batch.clean, ablation_type)
+                with PROFILER.span("src_ablations"):
+                    patch_src_outs = src_ablations(model, batch.clean, ablation_type)
+            else:
+                patch_src_outs = batch_mean_src_outs(mean_src_outs, batch_input)
         else:
             raise NotImplementedError
 
         if per_inst:
+            assert test_edge_counts is None # TODO: support
             prune_scores = prune_scores_all[batch.key]
-            desc_ps = desc_ps_all[batch.key]
-
-        if test_edge_counts is not None:
-            assert per_inst is False # TODO: support
-            thresholds = [prune_scores_threshold(desc_ps, edge_count, use_abs=use_abs)
-                          for edge_count in test_edge_counts]
-        else: 
-            assert thresholds is not None
+            if isinstance(prune_scores, SparsePruneScores): # the shared base ranking
+                assert prune_scores.ranked_edges.use_abs == use_abs
+                ranked_edges = prune_scores.ranked_edges
+            else:
+                if batch.key not in ranked_edges_all:
+                    ranked_edges_all[batch.key] = RankedEdges(prune_scores, use_abs=use_abs, per_inst=True)
+                ranked_edges = ranked_edges_all[batch.key]
+        assert thresholds is not None
+        sparse = isinstance(prune_scores, SparsePruneScores) # masks differ per batch (same ranking)
+        if prune_scores is not None and (
+            sparse or circuit_masks is None or circuit_masks.ranked_edges is not ranked_edges
+        ):
+            # When prune_scores are tied we can't prune exactly edge_count edges
+            with PROFILER.span("mask_setup", n_thresholds=len(thresholds)):
+                if incremental_masks:
+                    assert not per_inst and circuits_per_forward == 1
+                    circuit_masks = IncrementalCircuitMasks(model, ranked_edges, patch_type)
+                elif sparse:
+                    circuit_masks = SparseCircuitMasks(model, prune_scores, patch_type)
+                else:
+                    circuit_masks = CircuitMasks(model, ranked_edges, patch_type)
+                edge_counts = circuit_masks.edge_counts(thresholds)
         
         assert patch_src_outs is not None
+        if circuits_per_forward > 1:
+            assert prune_scores is not None and not render_graph and prefix_cache is None
+            assert model.kv_caches is None # kv caches are keyed by batch size
+            run_stacked_circuits(
+                model=model,
+                batch=batch,
+                batch_input=batch_input,
+                patch_src_outs=patch_src_outs,
+                circuit_masks=circuit_masks,
+                thresholds=thresholds,
+                edge_counts=edge_counts,
+                circ_outs=circ_outs,
+                circuits_per_forward=circuits_per_forward,
+                reducer=reducer,
+            )
+            continue
         with ExitStack() as stack:
             stack.enter_context(patch_mode(model, patch_src_outs, edges=edges))
             if per_inst:
                 stack.enter_context(set_mask_batch_size(model, batch_input.size(0)))
-            for threshold in tqdm(thresholds):
-                if prune_scores is not None:
-                    # When prune_scores are tied we can't prune exactly edge_count edges
-                    patch_edge_count = 0
-                    for mod_name, patch_mask in prune_scores.items():
-                        dest = module_by_name(model, mod_name)
-                        assert isinstance(dest, PatchWrapper)
-                        assert dest.is_dest and dest.patch_mask is not None
-                        if patch_type == PatchType.EDGE_PATCH:
-                            dest.patch_mask.data = ((patch_mask.abs() if use_abs else patch_mask) >= threshold).float()
-                            patch_edge_count += dest.patch_mask.int().sum().item()
-                        else:
-                            assert patch_type == PatchType.TREE_PATCH
-                            dest.patch_mask.data = ((patch_mask.abs() if use_abs else patch_mask) < threshold).float()
-                            patch_edge_count += (1 - dest.patch_mask.int()).sum().item()
-                else: # edges is not None
-                    assert edges is not None
-                with t.inference_mode():
-                    model_output = model(batch_input)[model.out_slice]
-                circ_outs[patch_edge_count][batch.key] = model_output.detach().clone()
+            threshold_idxs = list(range(len(thresholds)))
+            if incremental_masks:
+                threshold_idxs = circuit_masks.sweep_order(edge_counts)
+            for threshold_idx in tqdm(threshold_idxs):
+                threshold, patch_edge_count = thresholds[threshold_idx], edge_counts[threshold_idx]
+                with PROFILER.span("mask_setup", edge_count=patch_edge_count):
+                    if prune_scores is not None and incremental_masks:
+                        circuit_masks.set_edge_count(patch_edge_count)
+                        flat_mask = circuit_masks.flat_mask
+                    elif prune_scores is not None:
+                        flat_mask = circuit_masks.flat_masks([threshold])[0]
+                        circuit_masks.set_masks(flat_mask, alias=True)
+                    else: # edges is not None
+                        assert edges is not None and prefix_cache is None
+                with PROFILER.span("circuit_forward", edge_count=patch_edge_count), t.inference_mode():
+                    if prefix_cache is not None:
+                        model_output = prefix_cache.run(circuit_masks, batch.key, batch_input, flat_mask)
+                    else:
+                        model_output = model(batch_input)[model.out_slice]
+                circ_outs[patch_edge_count][batch.key] = reduce_output(model_output, batch, reducer)
             if render_graph:
                 draw_seq_graph(
                     model=model,
@@ -419,6 +945,136 @@ def run_circuits(
     del patch_src_outs
     return circ_outs
 
+
+def reduce_output(
+    model_output: torch.Tensor, batch: PromptPairBatch, reducer: Optional[OutputReducer] = None
+) -> Union[torch.Tensor, CompactLogits]:
+    """The output of a circuit on `batch` to keep (reduced by `reducer`, if given)."""
+    if reducer is not None:
+        model_output = reducer(model_output, batch)
+    if isinstance(model_output, CompactLogits):
+        return model_output.detach_clone()
+    return model_output.detach().clone()
+
+
+def run_stacked_circuits(
+    model: PatchableModel,
+    batch: PromptPairBatch,
+    batch_input: torch.Tensor,
+    patch_src_outs: torch.Tensor,
+    circuit_masks: CircuitMasks,
+    thresholds: List[float],
+    edge_counts: List[int],
+    circ_outs: CircuitOutputs,
+    circuits_per_forward: int = 2,
+    reducer: Optional[OutputReducer] = None,
+):
+    """
+    Run the circuits of `thresholds` on one batch, `circuits_per_forward` circuits per
+    forward pass. The input (and patch src outs) are repeated once per circuit, and each
+    circuit's mask is set on its own block of the (per instance) masks, so block `i` of
+    the output is the output of circuit `i`. Outputs (reduced by `reducer`, if given) are
+    added to `circ_outs`.
+    """
+    batch_size = batch_input.size(0)
+    for chunk_start in range(0, len(thresholds), circuits_per_forward):
+        threshold_chunk = thresholds[chunk_start:chunk_start + circuits_per_forward]
+        n_circs = len(threshold_chunk)
+        flat_masks = circuit_masks.flat_masks(threshold_chunk) # [n_circs, (batch), n_edges]
+        flat_masks = flat_masks.reshape(n_circs, -1, flat_masks.size(-1)).expand(n_circs, batch_size, -1)
+        chunk_edge_counts = edge_counts[chunk_start:chunk_start + circuits_per_forward]
+        with ExitStack() as stack:
+            stack.enter_context(PROFILER.span("circuit_forward", edge_counts=str(chunk_edge_counts)))
+            stack.enter_context(patch_mode(model, repeat_patch_src_out(patch_src_outs, n_circs)))
+            stack.enter_context(set_mask_batch_size(model, n_circs * batch_size))
+            circuit_masks.set_masks(flat_masks.reshape(n_circs * batch_size, -1), alias=True)
+            with t.inference_mode():
+                model_output = model(batch_input.repeat(n_circs, *((1,) * (batch_input.ndim - 1))))[model.out_slice]
+        for edge_count, circ_output in zip(chunk_edge_counts, model_output.split(batch_size)):
+            circ_outs[edge_count][batch.key] = reduce_output(circ_output, batch, reducer)
+
+
+@profiled()
+def run_edge_ablations(
+    model: PatchableModel,
+    dataloader: PromptDataLoader,
+    prune_scores: PruneScores,
+    threshold: Union[float, torch.Tensor],
+    edges: List[Edge],
+    ablation_type: AblationType,
+    use_abs: bool = True,
+    tokens: bool = False,
+    edges_per_forward: int = 8,
+    reducer: Optional[OutputReducer] = None,
+    src_ablation_cache: Optional[SrcAblationCache] = None,
+    mean_src_outs: Optional[Dict[int, torch.Tensor]] = None,
+) -> Dict[Edge, BatchOutputs]:
+    """Run the (tree patched) circuit of `threshold` with each of `edges` ablated, packing
+    the single edge ablations of `edges_per_forward` edges into one forward pass.
+
+    Each batch is repeated once per edge in a chunk, and each (edge, instance) row gets
+    the circuit's mask with that edge ablated (with per instance masks), so block `i` of
+    the output is the output of the circuit without edge `i`. This is the output of
+    `run_circuits` on prune scores with the edge's score set to 0 (for thresholds > 0).
+
+    Args:
+        model: The model to run.
+        dataloader: The dataloader to use for input and patches.
+        prune_scores: The scores of the circuit.
+        threshold: The circuit threshold (edges with scores >= `threshold` are kept).
+        edges: The edges to ablate (one at a time).
+        ablation_type: The type of ablation to use.
+        use_abs: Rank the absolute values of `prune_scores`.
+        tokens: Whether `prune_scores` have a seq dim (token circuits).
+        edges_per_forward: The number of edge ablations per forward pass. Trades memory
+            (`edges_per_forward` x batch size) for fewer passes.
+        reducer: Applied to the output of each ablated circuit on each batch.
+        src_ablation_cache: The cache of dataset mean src outs (see `run_circuits`).
+        mean_src_outs: The dataset mean src outs (see `run_circuits`).
+
+    Returns:
+        A dictionary mapping each edge to the [`BatchOutputs`][auto_circuit.types.BatchOutputs]
+            of the circuit without it.
+    """
+    assert model.kv_caches is None # kv caches are keyed by batch size
+    ranked_edges = RankedEdges(prune_scores, use_abs=use_abs)
+    circuit_masks = CircuitMasks(model, ranked_edges, PatchType.TREE_PATCH)
+    circuit_mask = circuit_masks.flat_masks([threshold])[0] # [n_edges]
+    index = EdgeIndex(
+        model.srcs, model.dests, {mod_name: ps.shape for mod_name, ps in prune_scores.items()}, tokens=tokens
+    )
+    edge_ids = index.edge_ids(edges).to(circuit_mask.device)
+    if ablation_type.mean_over_dataset and mean_src_outs is None:
+        with PROFILER.span("src_ablations", dataset_mean=True):
+            mean_src_outs = (src_ablation_cache or SRC_ABLATION_CACHE).src_outs(model, dataloader, ablation_type)
+
+    edge_outs: Dict[Edge, BatchOutputs] = {edge: {} for edge in edges}
+    for batch in tqdm(dataloader):
+        batch_input, batch_size = batch.clean, batch.clean.size(0)
+        if ablation_type.mean_over_dataset:
+            patch_src_outs = batch_mean_src_outs(mean_src_outs, batch_input)
+        else:
+            with PROFILER.span("src_ablations"):
+                patch_src_outs = src_ablations(model, batch.corrupt, ablation_type)
+        for chunk_start in range(0, len(edges), edges_per_forward):
+            chunk_ids = edge_ids[chunk_start:chunk_start + edges_per_forward]
+            n_ablations = chunk_ids.size(0)
+            flat_masks = circuit_mask.unsqueeze(0).repeat(n_ablations, 1)
+            flat_masks[torch.arange(n_ablations, device=flat_masks.device), chunk_ids] = 1.0 # ablated
+            flat_masks = flat_masks.unsqueeze(1).expand(n_ablations, batch_size, -1)
+            with ExitStack() as stack:
+                stack.enter_context(PROFILER.span("circuit_forward", edge_ablations=n_ablations))
+                stack.enter_context(patch_mode(model, repeat_patch_src_out(patch_src_outs, n_ablations)))
+                stack.enter_context(set_mask_batch_size(model, n_ablations * batch_size))
+                circuit_masks.set_masks(flat_masks.reshape(n_ablations * batch_size, -1), alias=True)
+                with t.inference_mode():
+                    model_output = model(batch_input.repeat(n_ablations, *((1,) * (batch_input.ndim - 1))))[model.out_slice]
+            chunk_edges = edges[chunk_start:chunk_start + edges_per_forward]
+            for edge, edge_output in zip(chunk_edges, model_output.split(batch_size)):
+                edge_outs[edge][batch.key] = reduce_output(edge_output, batch, reducer)
+        del patch_src_outs
+    return edge_outs
+
 def load_tf_model(model_name: str):
     model = HookedTransformer.from_pretrained(
         model_name,
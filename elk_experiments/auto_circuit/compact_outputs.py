@@ -0,0 +1,121 @@
+from typing import List, NamedTuple, Optional, Union
+from enum import Enum
+
+import torch
+
+from auto_circuit.data import PromptPairBatch
+
+
+class OutputStorage(Enum):
+    FULL = "full" # the full vocab logits
+    ANSWERS = "answers" # the answer logits (and the logsumexp over the vocab)
+    TOPK = "topk" # the top k logits (and the logsumexp over the vocab)
+
+
+class CompactLogits(NamedTuple):
+    """
+    A subset of the vocab logits of a batch of outputs, with the logsumexp over the full
+    vocab, so the log probs of the kept tokens (and the total log prob of the rest of the
+    vocab) are exact. Padded entries (for ragged answers) have `-inf` logits.
+    """
+    token_ids: torch.Tensor # [batch, k]
+    logits: torch.Tensor # [batch, k] (possibly in reduced precision)
+    logsumexp: torch.Tensor # [batch] (fp32)
+
+    def log_probs(self) -> torch.Tensor:
+        """The log probs of the kept tokens ([batch, k])."""
+        return self.logits.float() - self.logsumexp.unsqueeze(-1)
+
+    def tail_log_prob(self) -> torch.Tensor:
+        """The log of the total prob of the tokens that were not kept ([batch])."""
+        kept_log_prob = self.log_probs().logsumexp(dim=-1).clamp(max=0.0)
+        return torch.log(-torch.expm1(kept_log_prob))
+
+    def detach_clone(self) -> "CompactLogits":
+        return CompactLogits(*[x.detach().clone() for x in self])
+
+    def to(self, device: Union[str, torch.device]) -> "CompactLogits":
+        return CompactLogits(*[x.to(device) for x in self])
+
+
+def _padded_answers(answers: Union[torch.Tensor, List[torch.Tensor]], device: torch.device):
+    # [batch, n_answers] answer ids and the mask of padded entries (for ragged answers)
+    if isinstance(answers, torch.Tensor):
+        answers = answers.to(device)
+        return answers, torch.zeros_like(answers, dtype=torch.bool)
+    max_answers = max(a.numel() for a in answers)
+    ids = torch.zeros(len(answers), max_answers, dtype=torch.long, device=device)
+    pad = torch.ones(len(answers), max_answers, dtype=torch.bool, device=device)
+    for i, a in enumerate(answers):
+        ids[i, :a.numel()] = a
+        pad[i, :a.numel()] = False
+    return ids, pad
+
+
+def compact_logits(
+    logits: torch.Tensor,
+    batch: PromptPairBatch,
+    storage: OutputStorage,
+    k: Optional[int] = None,
+    dtype: Optional[torch.dtype] = None,
+) -> Union[torch.Tensor, CompactLogits]:
+    """
+    The `[batch, vocab]` `logits` in `storage` form, with the kept logits cast to `dtype`
+    (if given). The logsumexp is computed on the full precision logits.
+    """
+    if storage == OutputStorage.FULL:
+        return logits if dtype is None else logits.to(dtype)
+    logsumexp = logits.float().logsumexp(dim=-1)
+    if storage == OutputStorage.ANSWERS:
+        token_ids, pad = _padded_answers(batch.answers, logits.device)
+        kept = logits.gather(-1, token_ids).masked_fill(pad, float("-inf"))
+    elif storage == OutputStorage.TOPK:
+        assert k is not None, "k must be given for top k storage"
+        kept, token_ids = logits.topk(min(k, logits.size(-1)), dim=-1)
+    else:
+        raise NotImplementedError(storage)
+    return CompactLogits(token_ids, kept if dtype is None else kept.to(dtype), logsumexp)
+
+
+def output_reducer(storage: OutputStorage, k: Optional[int] = None, dtype: Optional[torch.dtype] = None):
+    """
+    A `run_circuits` reducer storing circuit outputs in `storage` form (in `dtype`), or
+    `None` if the outputs are stored as they are.
+    """
+    if storage == OutputStorage.FULL and dtype is None:
+        return None
+    return lambda logits, batch: compact_logits(logits, batch, storage, k=k, dtype=dtype)
+
+
+def compact_log_answer_dist(circuit_out: CompactLogits) -> torch.Tensor:
+    """
+    The log probs of [answer, not answer] (as `log_answer_dist`) of answer-restricted
+    (`OutputStorage.ANSWERS`) outputs.
+    """
+    answer_log_prob = circuit_out.log_probs().logsumexp(dim=-1)
+    return torch.stack([answer_log_prob, circuit_out.tail_log_prob()], dim=-1)
+
+
+def compact_log_dist(
+    circuit_out: CompactLogits, target_logprobs: torch.Tensor
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    The circuit and target log probs over the tokens kept in `circuit_out` and one bucket
+    for the rest of the vocab (`[batch, k + 1]`), given full vocab `target_logprobs`. The
+    KL divergence between these coarsened distributions is a lower bound on the full KL.
+    """
+    circuit_kept = circuit_out.log_probs()
+    target_kept = target_logprobs.gather(-1, circuit_out.token_ids.to(target_logprobs.device))
+    pad = torch.isneginf(circuit_out.logits)
+    target_kept = target_kept.masked_fill(pad.to(target_kept.device), float("-inf"))
+    target_tail = torch.log(-torch.expm1(target_kept.logsumexp(dim=-1).clamp(max=0.0)))
+    return (
+        torch.cat([circuit_kept, circuit_out.tail_log_prob().unsqueeze(-1)], dim=-1),
+        torch.cat([target_kept, target_tail.unsqueeze(-1)], dim=-1),
+    )
+
+
+def kl_div_log_probs(input_logprobs: torch.Tensor, target_logprobs: torch.Tensor) -> torch.Tensor:
+    """KL(target || input) per instance (summed over the last dim), with 0 log 0 = 0."""
+    kl = target_logprobs.exp() * (target_logprobs - input_logprobs)
+    return torch.where(torch.isneginf(target_logprobs), torch.zeros_like(kl), kl).sum(dim=-1)
@@ -10,6 +10,8 @@ import matplotlib.pyplot as plt
 from auto_circuit.types import SrcNode, DestNode, Edge, Node
 from auto_circuit.utils.custom_tqdm import tqdm
 
+from elk_experiments.profiler import profiled
+
 class NodeType(Enum):
     Q = 0 
     K = 1 
@@ -116,6 +118,7 @@ class SeqGraph():
     Automatically removed edges which cannot reach output at last_seq_idx
     """
 
+    @profiled("SeqGraph")
     def __init__(
         self, 
         edges: list[Edge],
@@ -229,6 +232,7 @@ def edge_in_path(edge: Edge, seq_graph: SeqGraph, in_path_req=True, reach_req=Tr
 
 # goal is to return equivalent of path counts, but only count paths that have at least one edge in provided edges 
 PathCounts = dict[Tuple[SeqNodeKey, bool], int]
+@profiled()
 def get_edge_path_counts(
     edges: list[Edge],
     seq_graph: SeqGraph,
@@ -370,6 +374,7 @@ def sample_path_random_walk_rejection( # only used for comparision, should be th
     return path
     
 
+@profiled()
 def sample_paths(
     seq_graph: SeqGraph, 
     n_paths: int, 
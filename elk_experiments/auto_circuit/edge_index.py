@@ -0,0 +1,210 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+import bisect
+import math
+import weakref
+
+import torch
+
+from auto_circuit.types import DestNode, Edge, PruneScores, SrcNode
+from auto_circuit.utils.patchable_model import PatchableModel
+
+
+def _contiguous_strides(shape: Sequence[int]) -> Tuple[int, ...]:
+    strides = [1]
+    for size in reversed(shape[1:]):
+        strides.insert(0, strides[0] * size)
+    return tuple(strides)
+
+
+class EdgeCoords(NamedTuple):
+    """Coordinates of flat edge ids (-1 where a module has no head / seq dim)."""
+    module: torch.Tensor # index into `EdgeIndex.module_names`
+    seq: torch.Tensor
+    head: torch.Tensor
+    src: torch.Tensor
+
+
+class EdgeIndex:
+    """
+    Table between `Edge`s and positions in a `PruneScores`. Edges are numbered by a flat
+    edge id, in module order (so flat ids index the `flatten`ed prune scores), and each
+    edge id has coordinates (module, seq, head, src) such that the edge's score is
+    `prune_scores[module][(seq,) (head,) src]` (seq for token circuits, head for dests
+    with heads).
+
+    `Edge` objects are only resolved when requested, so the table itself holds a few
+    tensors (and node lookups), and every operation on sets of edges is vectorized.
+    """
+
+    def __init__(
+        self,
+        srcs: Iterable[SrcNode],
+        dests: Iterable[DestNode],
+        shapes: Dict[str, torch.Size],
+        tokens: bool = False,
+        device: Union[str, torch.device] = "cpu",
+    ):
+        self.tokens = tokens
+        self.device = torch.device(device)
+        self.module_names: List[str] = list(shapes.keys())
+        self.module_ids: Dict[str, int] = {name: i for i, name in enumerate(self.module_names)}
+        self.shapes: List[torch.Size] = [torch.Size(shape) for shape in shapes.values()]
+        self.has_head: List[bool] = [len(shape) == 2 + tokens for shape in self.shapes]
+        self.strides: List[Tuple[int, ...]] = [_contiguous_strides(shape) for shape in self.shapes]
+        sizes = [math.prod(shape) for shape in self.shapes]
+        self.offsets: List[int] = [0]
+        for size in sizes:
+            self.offsets.append(self.offsets[-1] + size)
+        self._offsets = torch.tensor(self.offsets, device=self.device)
+        self.src_by_idx: Dict[int, SrcNode] = {src.src_idx: src for src in srcs}
+        self.dest_by_mod_head: Dict[Tuple[str, Optional[int]], DestNode] = {
+            (dest.module_name, dest.head_idx): dest for dest in dests
+        }
+        self._coords: Optional[EdgeCoords] = None
+        self._edges: Dict[int, Edge] = {}
+
+    @classmethod
+    def from_model(cls, model: PatchableModel) -> "EdgeIndex":
+        prune_scores = model.new_prune_scores()
+        shapes = {mod_name: ps.shape for mod_name, ps in prune_scores.items()}
+        device = next(iter(prune_scores.values())).device
+        return cls(model.srcs, model.dests, shapes, tokens=model.seq_len is not None, device=device)
+
+    @property
+    def n_edges(self) -> int:
+        return self.offsets[-1]
+
+    # flat <-> PruneScores
+
+    def flatten(self, scores: PruneScores, per_inst: bool = False) -> torch.Tensor:
+        """Concatenate `scores` into one `[n_edges]` (or `[batch, n_edges]`) tensor."""
+        start_dim = 1 if per_inst else 0
+        return torch.cat([scores[name].flatten(start_dim) for name in self.module_names], dim=start_dim)
+
+    def unflatten(self, flat: torch.Tensor) -> PruneScores:
+        """Split a flat `[..., n_edges]` tensor into prune scores (views of `flat`)."""
+        batch_shape = flat.shape[:-1]
+        return {
+            name: flat[..., start:stop].view(*batch_shape, *shape)
+            for name, shape, start, stop in zip(
+                self.module_names, self.shapes, self.offsets[:-1], self.offsets[1:]
+            )
+        }
+
+    # edge ids <-> coordinates / edges
+
+    @property
+    def coords(self) -> EdgeCoords:
+        """Coordinates of every flat edge id (built on first use)."""
+        if self._coords is None:
+            coords: List[List[torch.Tensor]] = [[], [], [], []]
+            for mod_id, (shape, has_head) in enumerate(zip(self.shapes, self.has_head)):
+                local = torch.arange(math.prod(shape), device=self.device)
+                *outer, n_src = shape
+                no_dim = torch.full_like(local, -1)
+                seq = local // math.prod(outer[1:] + [n_src]) if self.tokens else no_dim
+                head = (local // n_src) % outer[-1] if has_head else no_dim
+                for dim_coords, c in zip(coords, [torch.full_like(local, mod_id), seq, head, local % n_src]):
+                    dim_coords.append(c)
+            self._coords = EdgeCoords(*[torch.cat(c) for c in coords])
+        return self._coords
+
+    def _local_idx(self, edge: Edge) -> Tuple[int, ...]:
+        # dests without heads (mlps, resid end) have no head dim
+        idx = (edge.src.src_idx,) if edge.dest.head_idx is None else (edge.dest.head_idx, edge.src.src_idx)
+        if self.tokens:
+            idx = (edge.seq_idx,) + idx
+        return idx
+
+    def edge_id(self, edge: Edge) -> int:
+        mod_id = self.module_ids[edge.dest.module_name]
+        local_idx = self._local_idx(edge)
+        return self.offsets[mod_id] + sum(i * stride for i, stride in zip(local_idx, self.strides[mod_id]))
+
+    def edge_ids(self, edges: Iterable[Edge]) -> torch.Tensor:
+        return torch.tensor([self.edge_id(edge) for edge in edges], dtype=torch.long, device=self.device)
+
+    def edge(self, edge_id: int) -> Edge:
+        if edge_id not in self._edges:
+            mod_id = bisect.bisect_right(self.offsets, edge_id) - 1
+            self._edges[edge_id] = self._resolve(mod_id, edge_id - self.offsets[mod_id])
+        return self._edges[edge_id]
+
+    def _resolve(self, mod_id: int, local_id: int) -> Edge:
+        local_idx = []
+        for stride in self.strides[mod_id]:
+            idx, local_id = divmod(local_id, stride)
+            local_idx.append(idx)
+        seq_idx = local_idx.pop(0) if self.tokens else None
+        head_idx = local_idx.pop(0) if self.has_head[mod_id] else None
+        dest = self.dest_by_mod_head[(self.module_names[mod_id], head_idx)]
+        return Edge(src=self.src_by_idx[local_idx[0]], dest=dest, seq_idx=seq_idx)
+
+    def edges(self, edge_ids: Union[torch.Tensor, Sequence[int]]) -> List[Edge]:
+        edge_ids = edge_ids.tolist() if isinstance(edge_ids, torch.Tensor) else edge_ids
+        missing = [i for i in edge_ids if i not in self._edges]
+        if missing: # resolve in one pass over the coordinates
+            missing_t = torch.tensor(missing, dtype=torch.long, device=self.device)
+            mod_ids = (torch.searchsorted(self._offsets, missing_t, right=True) - 1)
+            local_ids = missing_t - self._offsets[mod_ids]
+            for edge_id, mod_id, local_id in zip(missing, mod_ids.tolist(), local_ids.tolist()):
+                self._edges[edge_id] = self._resolve(mod_id, local_id)
+        return [self._edges[i] for i in edge_ids]
+
+    # vectorized operations
+
+    def mask_to_edge_ids(self, mask: PruneScores) -> torch.Tensor:
+        """Flat ids of the nonzero entries of `mask`."""
+        return self.flatten(mask).nonzero().squeeze(-1)
+
+    def mask_to_edges(self, mask: PruneScores) -> List[Edge]:
+        return self.edges(self.mask_to_edge_ids(mask))
+
+    def gather(self, scores: PruneScores, edge_ids: torch.Tensor, per_inst: bool = False) -> torch.Tensor:
+        """The scores of `edge_ids` (`[n_ids]`, or `[batch, n_ids]` if `per_inst`)."""
+        return self.flatten(scores, per_inst=per_inst)[..., edge_ids.to(self.device)]
+
+    def scatter(
+        self,
+        scores: PruneScores,
+        edge_ids: torch.Tensor,
+        values: Union[float, torch.Tensor],
+        batch_idxs: Optional[torch.Tensor] = None,
+    ) -> PruneScores:
+        """
+        Set the scores of `edge_ids` to `values` in place, for the instances `batch_idxs`
+        (one per edge id) if the scores are per instance.
+        """
+        edge_ids = edge_ids.to(self.device)
+        values = torch.as_tensor(values, device=self.device).expand(edge_ids.shape)
+        mod_ids = torch.searchsorted(self._offsets, edge_ids, right=True) - 1
+        for mod_id in mod_ids.unique().tolist():
+            sel = mod_ids == mod_id
+            local_ids = edge_ids[sel] - self.offsets[mod_id]
+            mod_scores = scores[self.module_names[mod_id]]
+            local_ids, mod_values = local_ids.to(mod_scores.device), values[sel].to(mod_scores)
+            if batch_idxs is None:
+                flat_scores = mod_scores.view(-1)
+                flat_scores.index_put_((local_ids,), mod_values)
+            else:
+                flat_scores = mod_scores.view(mod_scores.size(0), -1)
+                flat_scores.index_put_((batch_idxs.to(self.device)[sel].to(mod_scores.device), local_ids), mod_values)
+        return scores
+
+    def sort(
+        self, scores: PruneScores, use_abs: bool = True, descending: bool = True
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The flat scores in sorted order, and their edge ids."""
+        flat = self.flatten(scores)
+        _, edge_ids = (flat.abs() if use_abs else flat).sort(descending=descending, stable=True)
+        return flat[edge_ids], edge_ids
+
+
+_EDGE_INDICES: "weakref.WeakKeyDictionary[PatchableModel, EdgeIndex]" = weakref.WeakKeyDictionary()
+
+
+def edge_index(model: PatchableModel) -> EdgeIndex:
+    """The `EdgeIndex` of `model` (built once per model)."""
+    if model not in _EDGE_INDICES:
+        _EDGE_INDICES[model] = EdgeIndex.from_model(model)
+    return _EDGE_INDICES[model]
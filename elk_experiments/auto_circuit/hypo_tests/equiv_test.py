@@ -8,10 +8,10 @@ from scipy.stats import binom, beta
 
 import matplotlib.pyplot as plt
 
-from auto_circuit.data import PromptDataLoader
-from auto_circuit.prune import run_circuits
+from auto_circuit.data import PromptDataLoader, PromptPairBatch
 from auto_circuit.types import (
     CircuitOutputs, 
+    BatchOutputs,
     BatchKey,
     PruneScores,
     PatchType, 
@@ -20,13 +20,28 @@ from auto_circuit.types import (
 from auto_circuit.utils.patchable_model import PatchableModel
 from auto_circuit.utils.custom_tqdm import tqdm
 
+from elk_experiments.profiler import PROFILER, profiled
+from elk_experiments.artifact_store import ArtifactStore
+from elk_experiments.auto_circuit.ranked_edges import RankedEdges
+from elk_experiments.auto_circuit.auto_circuit_utils import BatchShard, run_circuits
+from elk_experiments.auto_circuit.src_ablation_cache import SRC_ABLATION_CACHE
+from elk_experiments.auto_circuit.prefix_cache import LayerPrefixCache
 from elk_experiments.auto_circuit.score_funcs import GradFunc, AnswerFunc, get_score_func
+from elk_experiments.auto_circuit.hypo_tests.model_output_cache import ModelOutputCache, MODEL_OUTPUT_CACHE
 
 class Side(Enum): 
     LEFT = "left"
     RIGHT = "right"
     NONE = "none"
 
+class EquivTestMode(Enum):
+    FULL = "full" # test each circuit on every batch
+    SEQUENTIAL = "sequential" # group sequential test, stopping once a circuit is not equiv
+    HALVING = "halving" # successive halving, screening circuits on growing subsets of batches
+
+# alpha spending function exponent (alpha * t**rho), conservative at early looks
+ALPHA_SPENDING_RHO = 3.0
+
 def compute_num_C_gt_M(
     circ_out: CircuitOutputs, 
     model_out: CircuitOutputs, 
@@ -34,23 +49,25 @@ def compute_num_C_gt_M(
     grad_function: GradFunc,
     answer_function: AnswerFunc,
 ) -> tuple[int, int, torch.Tensor, torch.Tensor]:
-    # compute number of samples with ablated C > M
     score_func = get_score_func(grad_function, answer_function)
+    circ_scores = {batch.key: score_func(circ_out[batch.key], batch) for batch in dataloader}
+    model_scores = {batch.key: score_func(model_out[batch.key], batch) for batch in dataloader}
+    return count_C_gt_M(circ_scores, model_scores, dataloader)
+
+def count_C_gt_M(
+    circ_scores: BatchOutputs,
+    model_scores: BatchOutputs,
+    dataloader: PromptDataLoader,
+) -> tuple[int, int, torch.Tensor, torch.Tensor]:
+    # compute number of samples with ablated C > M (from per instance scores)
     num_ablated_C_gt_M = 0
     n = 0
-    circ_scores = []
-    model_scores = []
     for batch in dataloader:
-        bs = batch.clean.size(0)
-        circ_out_batch = circ_out[batch.key]
-        model_out_batch = model_out[batch.key]
-        circ_score = score_func(circ_out_batch, batch)
-        model_score = score_func(model_out_batch, batch)
-        num_ablated_C_gt_M += torch.sum(circ_score > model_score).item()
-        n += bs
-        circ_scores.append(circ_score)
-        model_scores.append(model_score)
-    return num_ablated_C_gt_M, n, torch.cat(circ_scores), torch.cat(model_scores)
+        num_ablated_C_gt_M += torch.sum(circ_scores[batch.key] > model_scores[batch.key]).item()
+        n += batch.clean.size(0)
+    circ_scores_cat = torch.cat([circ_scores[batch.key] for batch in dataloader])
+    model_scores_cat = torch.cat([model_scores[batch.key] for batch in dataloader])
+    return num_ablated_C_gt_M, n, circ_scores_cat, model_scores_cat
 
 # ok 
 def run_non_equiv_test(
@@ -94,10 +111,68 @@ class EquivResult(NamedTuple):
     num_ablated_C_gt_M: int
     n: int
     not_equiv: bool
-    p_value: float
+    p_value: Optional[float] # None for circuits screened out by `halving_equiv_test`
     circ_scores: torch.Tensor
     model_scores: torch.Tensor
 
+class EquivMemo:
+    """
+    Per instance circuit scores for each tested edge count (and the model scores), so
+    repeated or refined equivalence tests only run the circuits of new edge counts, and
+    results for any `alpha` / `epsilon` / `side` are recomputed from the stored scores
+    (without forward passes).
+
+    A memo is only valid for one model, dataloader, prune scores (and `use_abs`),
+    ablation type and score function. With an `artifact_store`, the scores are persisted
+    under `config` (which must identify all of these) and loaded on construction.
+
+    Early stopping tests (`EquivTestMode.SEQUENTIAL` / `HALVING`) add the scores of the
+    circuits they test on every batch (which get the full test). The circuits they stop
+    early are judged on a subset of the batches, so their results are kept as decisions
+    (per mode, `alpha`, `epsilon` and `side`, in memory only) rather than as scores to be
+    re-judged with the full test, and an edge count gets the same verdict in every round.
+    """
+
+    def __init__(self, artifact_store: Optional[ArtifactStore] = None, config: Optional[Dict[str, Any]] = None):
+        assert artifact_store is None or config is not None, "persisted memos need a config"
+        self.artifact_store = artifact_store
+        self.config = config
+        self.circ_scores: Dict[int, torch.Tensor] = {}
+        self.model_scores: Optional[torch.Tensor] = None
+        self.decisions: Dict[Tuple[EquivTestMode, float, float, Side], Dict[int, EquivResult]] = {}
+        if artifact_store is not None:
+            circ_scores = artifact_store.get(self._config("circuit"), lazy=False)
+            model_scores = artifact_store.get(self._config("model"))
+            if circ_scores is not None and model_scores is not None:
+                self.circ_scores, self.model_scores = dict(circ_scores), model_scores
+
+    def _config(self, scores: str) -> Dict[str, Any]:
+        return {**self.config, "artifact": "equiv_memo", "scores": scores}
+
+    def __contains__(self, edge_count: int) -> bool:
+        return edge_count in self.circ_scores and self.model_scores is not None
+
+    def add(self, circ_scores: Dict[int, torch.Tensor], model_scores: torch.Tensor):
+        """Add the ([n]) circuit scores of edge counts (and the model scores)."""
+        self.circ_scores.update({k: v.detach().cpu() for k, v in circ_scores.items()})
+        self.model_scores = model_scores.detach().cpu()
+        if self.artifact_store is not None:
+            self.artifact_store.put(self._config("circuit"), self.circ_scores)
+            self.artifact_store.put(self._config("model"), self.model_scores)
+
+    def decided(self, mode: EquivTestMode, alpha: float, epsilon: float, side: Side) -> Dict[int, "EquivResult"]:
+        """The (mutable) results of the early stopping tests of `mode` with these parameters."""
+        return self.decisions.setdefault((mode, alpha, epsilon, side), {})
+
+    def result(self, edge_count: int, alpha: float = 0.05, epsilon: float = 0.1, side: Side = Side.NONE) -> "EquivResult":
+        circ_scores, model_scores = self.circ_scores[edge_count], self.model_scores
+        num_ablated_C_gt_M = int(torch.sum(circ_scores > model_scores).item())
+        n = circ_scores.numel()
+        not_equiv, p_value = run_non_equiv_test(num_ablated_C_gt_M, n, alpha, epsilon, side=side)
+        return EquivResult(num_ablated_C_gt_M, n, not_equiv, p_value, circ_scores, model_scores)
+
+
+@profiled()
 def equiv_test(
     model: PatchableModel, 
     dataloader: PromptDataLoader,
@@ -112,45 +187,341 @@ def equiv_test(
     side: Side = Side.NONE,
     alpha: float = 0.05,
     epsilon: float = 0.1,
+    model_out_cache: Optional[ModelOutputCache] = None,
+    circuits_per_forward: int = 1,
+    incremental_masks: bool = False,
+    prefix_cache: Optional[LayerPrefixCache] = None,
+    memo: Optional[EquivMemo] = None,
+    ranked_edges: Optional[RankedEdges] = None,
+    mode: EquivTestMode = EquivTestMode.FULL,
 ) -> Dict[int, EquivResult]:
+    """
+    Results are keyed by the number of edges in each circuit (which can exceed the
+    requested edge count when scores are tied). With a `memo`, only the circuits of edge
+    counts that are not in the memo are run.
 
-    # circuit out
-    circuit_outs = dict(run_circuits(
-        model=model, 
-        dataloader=dataloader,
-        test_edge_counts=edge_counts,
-        prune_scores=prune_scores,
-        patch_type=PatchType.TREE_PATCH,
-        ablation_type=ablation_type,
-        reverse_clean_corrupt=False,
-        use_abs=use_abs,
-    ))
-    
-    # model out
-    if model_out is None:
-        model_out = {}
-        ref_model = full_model if full_model is not None else model
-        for batch in dataloader:
-            model_out[batch.key] = ref_model(batch.clean)[model.out_slice]
+    In `EquivTestMode.SEQUENTIAL` (`EquivTestMode.HALVING`) mode, circuits that are not
+    in the memo are tested with `sequential_equiv_test` (`halving_equiv_test`), so
+    circuits that are clearly not equivalent are rejected after a few batches. Circuits
+    run on every batch get the full test and are memoized as scores, and the rejected ones
+    are kept as memo decisions (see `EquivMemo`), so tested edge counts are not re-run and
+    keep their verdict in later calls.
+    """
+    score_func = get_score_func(grad_function, answer_function)
+    memo = memo if memo is not None else EquivMemo()
+    if ranked_edges is None or ranked_edges.prune_scores is not prune_scores or ranked_edges.use_abs != use_abs:
+        ranked_edges = RankedEdges(prune_scores, use_abs=use_abs)
+    # edge counts of the circuits (with ties), to look up in the memo
+    thresholds = ranked_edges.thresholds(edge_counts) if edge_counts else []
+    circuit_edge_counts = ranked_edges.counts(thresholds).tolist() if edge_counts else []
+    early_stopping = mode in (EquivTestMode.SEQUENTIAL, EquivTestMode.HALVING)
+    decided = memo.decided(mode, alpha, epsilon, side) if early_stopping else {}
+    missing_idxs = [i for i, k in enumerate(circuit_edge_counts) if k not in decided and k not in memo]
+
+    if missing_idxs and early_stopping:
+        early_stopping_test = sequential_equiv_test if mode == EquivTestMode.SEQUENTIAL else halving_equiv_test
+        early_results = early_stopping_test(
+            model=model,
+            dataloader=dataloader,
+            prune_scores=prune_scores,
+            ranked_edges=ranked_edges,
+            thresholds=[thresholds[i] for i in missing_idxs],
+            score_func=score_func,
+            ablation_type=ablation_type,
+            use_abs=use_abs,
+            model_out=model_out,
+            full_model=full_model,
+            side=side,
+            alpha=alpha,
+            epsilon=epsilon,
+            model_out_cache=model_out_cache,
+            circuits_per_forward=circuits_per_forward,
+            incremental_masks=incremental_masks,
+            prefix_cache=prefix_cache,
+            memo=memo,
+        )
+        # circuits stopped early or screened out (the others are in the memo)
+        decided.update({k: r for k, r in early_results.items() if k not in memo})
+    elif missing_idxs:
+        # circuit scores (reduced per batch, so the circuit logits are never all kept)
+        circuit_scores = dict(run_circuits(
+            model=model, 
+            dataloader=dataloader,
+            thresholds=[thresholds[i] for i in missing_idxs],
+            prune_scores=prune_scores,
+            ranked_edges=ranked_edges,
+            patch_type=PatchType.TREE_PATCH,
+            ablation_type=ablation_type,
+            reverse_clean_corrupt=False,
+            use_abs=use_abs,
+            circuits_per_forward=circuits_per_forward,
+            incremental_masks=incremental_masks,
+            prefix_cache=prefix_cache,
+            reducer=score_func,
+        ))
+        
+        # model out
+        if model_out is None:
+            model_out_cache = model_out_cache or MODEL_OUTPUT_CACHE
+            ref_model = full_model if full_model is not None else model
+            model_out = model_out_cache.batch_outputs(ref_model, dataloader, out_slice=model.out_slice)
+        model_scores = {batch.key: score_func(model_out[batch.key], batch) for batch in dataloader}
+        memo.add(
+            {
+                edge_count: torch.cat([circuit_score[batch.key] for batch in dataloader])
+                for edge_count, circuit_score in circuit_scores.items()
+            },
+            torch.cat([model_scores[batch.key] for batch in dataloader]),
+        )
     
     # run statitiscal tests for each edge count
-    test_results = {}
-    for edge_count, circuit_out in circuit_outs.items():
-        num_ablated_C_gt_M, n, circ_scores, model_scores = compute_num_C_gt_M(
-            circuit_out, model_out, dataloader, grad_function, answer_function
+    return {
+        edge_count: (
+            decided[edge_count] if edge_count in decided
+            else memo.result(edge_count, alpha=alpha, epsilon=epsilon, side=side)
         )
-        not_equiv, p_value = run_non_equiv_test(num_ablated_C_gt_M, n, alpha, epsilon, side=side)
-        test_results[edge_count] = EquivResult(
-            num_ablated_C_gt_M, 
-            n, 
-            not_equiv, 
-            p_value, 
-            circ_scores.detach().cpu(), 
-            model_scores.detach().cpu()
+        for edge_count in dict.fromkeys(circuit_edge_counts)
+    }
+
+
+def clopper_pearson(k: int, n: int, alpha: float) -> tuple[float, float]:
+    """The (two sided, level `1 - alpha`) Clopper-Pearson interval of a binomial proportion."""
+    lower = beta.ppf(alpha / 2, k, n - k + 1) if k > 0 else 0.0
+    upper = beta.ppf(1 - alpha / 2, k + 1, n - k) if k < n else 1.0
+    return float(lower), float(upper)
+
+
+def outside_equiv_region(k: int, n: int, alpha: float, epsilon: float, side: Side = Side.NONE) -> bool:
+    """
+    Whether the Clopper-Pearson interval of P(C > M) lies entirely outside the region
+    where `run_non_equiv_test` can accept equivalence.
+    """
+    lower, upper = clopper_pearson(k, n, alpha)
+    if side == Side.LEFT:
+        return upper < 1 / 2 - epsilon
+    elif side == Side.RIGHT:
+        return lower > 1 / 2 + epsilon
+    return upper < 1 / 2 - epsilon or lower > 1 / 2 + epsilon
+
+
+def alpha_spent(alpha: float, t: float, rho: float = ALPHA_SPENDING_RHO) -> float:
+    """The alpha spent by information fraction `t` (power family spending function)."""
+    return alpha * min(t, 1.0) ** rho
+
+
+@profiled()
+def sequential_equiv_test(
+    model: PatchableModel,
+    dataloader: PromptDataLoader,
+    prune_scores: PruneScores,
+    ranked_edges: RankedEdges,
+    thresholds: list[torch.Tensor],
+    score_func: Callable,
+    ablation_type: AblationType,
+    use_abs: bool = True,
+    model_out: Optional[Dict[BatchKey, torch.Tensor]] = None,
+    full_model: Optional[torch.nn.Module] = None,
+    side: Side = Side.NONE,
+    alpha: float = 0.05,
+    epsilon: float = 0.1,
+    model_out_cache: Optional[ModelOutputCache] = None,
+    circuits_per_forward: int = 1,
+    incremental_masks: bool = False,
+    prefix_cache: Optional[LayerPrefixCache] = None,
+    memo: Optional[EquivMemo] = None,
+) -> Dict[int, EquivResult]:
+    """
+    Group sequential version of the non-equivalence test, which only curtails the full
+    test: the circuits of `thresholds` are run batch by batch, and after each batch but
+    the last (look) each pending circuit is tested on the instances seen so far at the
+    alpha spent in that look, `alpha_spent(alpha, t) - alpha_spent(alpha, t_prev)` (with
+    `t` the fraction of batches seen). A circuit stops (and is not run on later batches)
+    once it is not equivalent. Circuits that are never rejected early get the full test
+    (at `alpha`) on every batch, so their results are those of `equiv_test` in
+    `EquivTestMode.FULL` (and are added to the `memo`).
+
+    Early looks can only reject, at a total alpha below `alpha_spent(alpha, 1) = alpha`,
+    so the test is at most that much stricter than the full test (an equivalent circuit
+    is rejected early with probability below `alpha`), never more lenient. The p value of
+    an early rejection is that of its look (below the look's alpha), and `n` the
+    instances it was tested on.
+    """
+    model_out_cache = model_out_cache or MODEL_OUTPUT_CACHE
+    ref_model = full_model if full_model is not None else model
+    n_batches = len(dataloader)
+    mean_src_outs = None
+    if ablation_type.mean_over_dataset: # the mean over the full dataloader
+        mean_src_outs = SRC_ABLATION_CACHE.src_outs(model, dataloader, ablation_type)
+    pending_thresholds = dict(zip(ranked_edges.counts(thresholds).tolist(), thresholds))
+    circ_scores: Dict[int, list[torch.Tensor]] = {edge_count: [] for edge_count in pending_thresholds}
+    model_scores: list[torch.Tensor] = []
+    results: Dict[int, EquivResult] = {}
+    n, prev_alpha_spent = 0, 0.0
+    for batch_idx, batch in enumerate(dataloader):
+        if not pending_thresholds:
+            break
+        batch_circ_scores = run_circuits(
+            model=model,
+            dataloader=BatchShard([batch], getattr(dataloader, "seq_labels", None)),
+            thresholds=list(pending_thresholds.values()),
+            prune_scores=prune_scores,
+            ranked_edges=ranked_edges,
+            patch_type=PatchType.TREE_PATCH,
+            ablation_type=ablation_type,
+            reverse_clean_corrupt=False,
+            use_abs=use_abs,
+            circuits_per_forward=circuits_per_forward,
+            incremental_masks=incremental_masks,
+            prefix_cache=prefix_cache,
+            reducer=score_func,
+            mean_src_outs=mean_src_outs,
+        )
+        batch_model_out = (
+            model_out[batch.key] if model_out is not None
+            else model_out_cache.get(ref_model, batch, out_slice=model.out_slice)
         )
-    return test_results
+        model_scores.append(score_func(batch_model_out, batch))
+        model_scores_cat = torch.cat(model_scores)
+        n += batch.clean.size(0)
+        last_look = batch_idx == n_batches - 1
+        # the full test on the last look, the spent alpha (rejecting only) on earlier looks
+        look_alpha = alpha if last_look else alpha_spent(alpha, (batch_idx + 1) / n_batches) - prev_alpha_spent
+        prev_alpha_spent += look_alpha
+        for edge_count in list(pending_thresholds):
+            circ_scores[edge_count].append(batch_circ_scores[edge_count][batch.key])
+            circ_scores_cat = torch.cat(circ_scores[edge_count])
+            num_ablated_C_gt_M = int(torch.sum(circ_scores_cat > model_scores_cat).item())
+            not_equiv, p_value = run_non_equiv_test(num_ablated_C_gt_M, n, look_alpha, epsilon, side=side)
+            if not_equiv or last_look:
+                results[edge_count] = EquivResult(
+                    num_ablated_C_gt_M, 
+                    n, 
+                    not_equiv, 
+                    p_value, 
+                    circ_scores_cat.detach().cpu(), 
+                    model_scores_cat.detach().cpu()
+                )
+                del pending_thresholds[edge_count]
+    # circuits run on every batch (given the full test)
+    complete = {k: r for k, r in results.items() if len(model_scores) == n_batches and r.n == n}
+    if memo is not None and complete:
+        memo.add({k: r.circ_scores for k, r in complete.items()}, torch.cat(model_scores))
+    return results
 
 
+@profiled()
+def halving_equiv_test(
+    model: PatchableModel,
+    dataloader: PromptDataLoader,
+    prune_scores: PruneScores,
+    ranked_edges: RankedEdges,
+    thresholds: list[torch.Tensor],
+    score_func: Callable,
+    ablation_type: AblationType,
+    use_abs: bool = True,
+    model_out: Optional[Dict[BatchKey, torch.Tensor]] = None,
+    full_model: Optional[torch.nn.Module] = None,
+    side: Side = Side.NONE,
+    alpha: float = 0.05,
+    epsilon: float = 0.1,
+    model_out_cache: Optional[ModelOutputCache] = None,
+    circuits_per_forward: int = 1,
+    incremental_masks: bool = False,
+    prefix_cache: Optional[LayerPrefixCache] = None,
+    memo: Optional[EquivMemo] = None,
+    eta: int = 4,
+    n_rungs: int = 3,
+    screen_alpha: Optional[float] = None,
+) -> Dict[int, EquivResult]:
+    """
+    Successive halving over the circuits of `thresholds`: rung `r` (of `n_rungs`) scores
+    the surviving circuits on the first `1 / eta ** (n_rungs - 1 - r)` of the batches
+    (reusing the scores of earlier rungs), and screens out the circuits whose
+    Clopper-Pearson interval (level `1 - screen_alpha`, default `alpha / n_rungs`) of
+    P(C > M) lies outside the equivalence region. The last rung is the full dataloader,
+    so the survivors get the full test (as in `equiv_test`, and are added to the `memo`).
+
+    Screened circuits are not equivalent, with no p value (`p_value=None`) and the `n`
+    of their subset. Unlike the full test, an equivalent circuit can be screened out
+    (with probability at most `screen_alpha` per rung, so at most `alpha` over the rungs
+    by default). The dataloader is iterated once, holding one rung of batches at a time.
+    """
+    model_out_cache = model_out_cache or MODEL_OUTPUT_CACHE
+    ref_model = full_model if full_model is not None else model
+    screen_alpha = alpha / n_rungs if screen_alpha is None else screen_alpha
+    n_batches = len(dataloader)
+    seq_labels = getattr(dataloader, "seq_labels", None)
+    rung_ends = {
+        max(math.ceil(n_batches / eta ** (n_rungs - 1 - r)), 1) for r in range(n_rungs)
+    }
+    mean_src_outs = None
+    if ablation_type.mean_over_dataset: # the mean over the full dataloader
+        mean_src_outs = SRC_ABLATION_CACHE.src_outs(model, dataloader, ablation_type)
+    pending_thresholds = dict(zip(ranked_edges.counts(thresholds).tolist(), thresholds))
+    circ_scores: Dict[int, list[torch.Tensor]] = {edge_count: [] for edge_count in pending_thresholds}
+    model_scores: list[torch.Tensor] = []
+    results: Dict[int, EquivResult] = {}
+    rung_batches: list[PromptPairBatch] = []
+    for batch_idx, batch in enumerate(dataloader):
+        rung_batches.append(batch)
+        if batch_idx + 1 not in rung_ends:
+            continue
+        rung_circ_scores = run_circuits(
+            model=model,
+            dataloader=BatchShard(rung_batches, seq_labels),
+            thresholds=list(pending_thresholds.values()),
+            prune_scores=prune_scores,
+            ranked_edges=ranked_edges,
+            patch_type=PatchType.TREE_PATCH,
+            ablation_type=ablation_type,
+            reverse_clean_corrupt=False,
+            use_abs=use_abs,
+            circuits_per_forward=circuits_per_forward,
+            incremental_masks=incremental_masks,
+            prefix_cache=prefix_cache,
+            reducer=score_func,
+            mean_src_outs=mean_src_outs,
+        )
+        for rung_batch in rung_batches:
+            batch_model_out = (
+                model_out[rung_batch.key] if model_out is not None
+                else model_out_cache.get(ref_model, rung_batch, out_slice=model.out_slice)
+            )
+            model_scores.append(score_func(batch_model_out, rung_batch))
+        model_scores_cat = torch.cat(model_scores)
+        n = model_scores_cat.numel()
+        last_rung = batch_idx == n_batches - 1
+        PROFILER.count("halving_circuits_scored", len(pending_thresholds))
+        for edge_count in list(pending_thresholds):
+            circ_scores[edge_count] += [rung_circ_scores[edge_count][rung_batch.key] for rung_batch in rung_batches]
+            circ_scores_cat = torch.cat(circ_scores[edge_count])
+            num_ablated_C_gt_M = int(torch.sum(circ_scores_cat > model_scores_cat).item())
+            if last_rung:
+                not_equiv, p_value = run_non_equiv_test(num_ablated_C_gt_M, n, alpha, epsilon, side=side)
+            elif outside_equiv_region(num_ablated_C_gt_M, n, screen_alpha, epsilon, side=side):
+                not_equiv, p_value = True, None # screened out
+            else:
+                continue
+            results[edge_count] = EquivResult(
+                num_ablated_C_gt_M, 
+                n, 
+                not_equiv, 
+                p_value, 
+                circ_scores_cat.detach().cpu(), 
+                model_scores_cat.detach().cpu()
+            )
+            del pending_thresholds[edge_count]
+        rung_batches = []
+        if not pending_thresholds:
+            break
+    # circuits that survived every rung (given the full test)
+    complete = {k: r for k, r in results.items() if r.p_value is not None}
+    if memo is not None and complete:
+        memo.add({k: r.circ_scores for k, r in complete.items()}, torch.cat(model_scores))
+    return results
+
+
+@profiled()
 def sweep_search_smallest_equiv(
     model: PatchableModel,
     dataloader: PromptDataLoader,
@@ -163,14 +534,29 @@ def sweep_search_smallest_equiv(
     alpha: float = 0.05,
     epsilon: float = 0.1,
     model_out: Optional[Dict[BatchKey, torch.Tensor]] = None,
+    model_out_cache: Optional[ModelOutputCache] = None,
+    circuits_per_forward: int = 1,
+    incremental_masks: bool = False,
+    prefix_cache: Optional[LayerPrefixCache] = None,
+    memo: Optional[EquivMemo] = None,
+    mode: EquivTestMode = EquivTestMode.FULL,
 ) -> tuple[dict[int, EquivResult], int]:
-    """Returns equiv test results and minimal equivalent number of edges."""
+    """
+    Returns equiv test results and minimal equivalent number of edges. Each round tests
+    ~10 edge counts, so `circuits_per_forward` up to ~10 evaluates a round in as few
+    forward passes per batch. Alternatively, `incremental_masks` makes the mask updates
+    of the (sorted) edge counts of each round O(delta edges).
+
+    Edge counts tested in earlier rounds (the interval endpoints) are looked up in the
+    `memo` (in memory by default; pass a persisted memo to reuse the scores of an earlier
+    search, e.g. with a different `alpha` / `epsilon`).
+    """
+    memo = memo if memo is not None else EquivMemo()
+    ranked_edges = RankedEdges(prune_scores, use_abs=use_abs)
     full_results = {}
     width = 10 ** math.floor(math.log10(model.n_edges)-1)
     interval_min = 0 
     interval_max = model.n_edges #FIXME: if not use_abs, should only look at positive values
-    if model_out is None:
-        model_out = {batch.key: model(batch.clean)[model.out_slice] for batch in dataloader}
     while width > 0:
         print(f"interval: {interval_min} - {interval_max}")
         print("width", width)
@@ -185,11 +571,18 @@ def sweep_search_smallest_equiv(
             ablation_type=ablation_type,
             edge_counts=edge_counts,
             model_out=model_out,
+            model_out_cache=model_out_cache,
             full_model=None,
             use_abs=use_abs,
             side=side,
             alpha=alpha,
             epsilon=epsilon,
+            circuits_per_forward=circuits_per_forward,
+            incremental_masks=incremental_masks,
+            prefix_cache=prefix_cache,
+            memo=memo,
+            ranked_edges=ranked_edges,
+            mode=mode,
         )
         full_results.update(test_results)
         # find lowest interval where equivalence holds
@@ -211,12 +604,12 @@ def sweep_search_smallest_equiv(
             interval_max = min_equiv
             interval_min = min_equiv - width
         width = new_width
-    del model_out
     full_results = {k: full_results[k] for k in sorted(full_results.keys())}
     return full_results, interval_max
     
 
 
+@profiled()
 def bin_search_smallest_equiv(
     model: PatchableModel,
     dataloader: PromptDataLoader,
@@ -228,16 +621,17 @@ def bin_search_smallest_equiv(
     side: Side = Side.NONE,
     alpha: float = 0.05,
     epsilon: float = 0.1,
+    model_out_cache: Optional[ModelOutputCache] = None,
+    memo: Optional[EquivMemo] = None,
 ):
-    edge_count_interval = [i for i in range(model.n_edges + 1)]
-    min_equiv = edge_count_interval[-1]
+    memo = memo if memo is not None else EquivMemo()
+    ranked_edges = RankedEdges(prune_scores, use_abs=use_abs)
+    interval_min, interval_max = 0, model.n_edges # search [interval_min, interval_max]
+    min_equiv = model.n_edges
     min_equiv_p_val = 0.0
-    model_out = {batch.key: model(batch.clean)[model.out_slice] for batch in dataloader}
-    while len(edge_count_interval) > 0:
-        midpoint = len(edge_count_interval) // 2
-        edge_count = edge_count_interval[midpoint]
-
-        num_ablated_C_gt_M, n, not_equiv, p_value = next(iter(equiv_test(
+    while interval_min <= interval_max:
+        edge_count = (interval_min + interval_max + 1) // 2
+        tested_count, result = next(iter(equiv_test(
             model=model, 
             dataloader=dataloader,
             prune_scores=prune_scores,
@@ -245,25 +639,303 @@ def bin_search_smallest_equiv(
             answer_function=answer_function,
             ablation_type=ablation_type,
             edge_counts=[edge_count],
-            model_out=model_out,
+            model_out_cache=model_out_cache,
             use_abs=use_abs,
             side=side,
             alpha=alpha,
             epsilon=epsilon,
-        ).values()))
+            memo=memo,
+            ranked_edges=ranked_edges,
+        ).items()))
 
-        if not_equiv:
-            print(f"not equiv at {edge_count}, p value : {p_value}, increase edge count")
-            edge_count_interval = edge_count_interval[midpoint+1:] # more edges 
+        if result.not_equiv:
+            print(f"not equiv at {edge_count}, p value : {result.p_value}, increase edge count")
+            interval_min = max(edge_count, tested_count) + 1 # more edges 
         else:
-            min_equiv = edge_count
-            min_equiv_p_val = p_value
-            print(f"equiv at {edge_count},  p value: {p_value}, decrease edge count")
-            edge_count_interval = edge_count_interval[:midpoint] # less edges
-    del model_out
+            min_equiv = tested_count
+            min_equiv_p_val = result.p_value
+            print(f"equiv at {edge_count},  p value: {result.p_value}, decrease edge count")
+            interval_max = edge_count - 1 # less edges
     return min_equiv, min_equiv_p_val
 
 
+def default_circuits_per_forward(
+    circuits_per_forward: Optional[int],
+    probes_per_round: int,
+    incremental_masks: bool,
+    prefix_cache: Optional[LayerPrefixCache],
+) -> int:
+    """
+    The circuits per forward pass of a search, by default all `probes_per_round` probes
+    (or one with `incremental_masks` or a `prefix_cache`, which run one circuit at a
+    time).
+    """
+    one_at_a_time = incremental_masks or prefix_cache is not None
+    if circuits_per_forward is None:
+        return 1 if one_at_a_time else probes_per_round
+    if circuits_per_forward > 1 and one_at_a_time:
+        raise ValueError("incremental_masks and prefix_cache run one circuit per forward pass")
+    return circuits_per_forward
+
+
+@profiled()
+def gallop_search_smallest_equiv(
+    model: PatchableModel,
+    dataloader: PromptDataLoader,
+    prune_scores: PruneScores,
+    grad_function: GradFunc,
+    answer_function: AnswerFunc,
+    ablation_type: AblationType, 
+    use_abs: bool = True,
+    side: Side = Side.NONE,
+    alpha: float = 0.05,
+    epsilon: float = 0.1,
+    model_out: Optional[Dict[BatchKey, torch.Tensor]] = None,
+    model_out_cache: Optional[ModelOutputCache] = None,
+    probes_per_round: int = 8,
+    circuits_per_forward: Optional[int] = None,
+    incremental_masks: bool = False,
+    prefix_cache: Optional[LayerPrefixCache] = None,
+    memo: Optional[EquivMemo] = None,
+    mode: EquivTestMode = EquivTestMode.FULL,
+) -> tuple[dict[int, EquivResult], int]:
+    """
+    Returns equiv test results and minimal equivalent number of edges (as
+    `sweep_search_smallest_equiv`), testing `probes_per_round` edge counts per round (in
+    `circuits_per_forward` circuits per forward pass, see `default_circuits_per_forward`).
+
+    The search first gallops from the top of the ranking (edge counts 0, 1, 2, 4, ...,
+    `probes_per_round` per round, up to `model.n_edges`) until a count is equivalent,
+    bracketing the minimal equivalent count between the largest non equivalent and the
+    smallest equivalent count. Each following round splits the bracket into
+    `probes_per_round + 1` even parts, so the search takes about
+    `log2(min_equiv) / probes_per_round + log(min_equiv) / log(probes_per_round + 1)`
+    rounds (vs. ~log2(n_edges) single circuit rounds for `bin_search_smallest_equiv`).
+    As the other searches, it assumes equivalence is monotone in the edge count.
+
+    Edge counts are mapped to circuit sizes (with tied scores, several counts give the
+    same circuit), and tested circuits are looked up in the `memo`.
+    """
+    memo = memo if memo is not None else EquivMemo()
+    ranked_edges = RankedEdges(prune_scores, use_abs=use_abs)
+    circuits_per_forward = default_circuits_per_forward(
+        circuits_per_forward, probes_per_round, incremental_masks, prefix_cache
+    )
+    full_results: Dict[int, EquivResult] = {}
+
+    def test(edge_counts: list[int]) -> Dict[int, EquivResult]:
+        test_results = equiv_test(
+            model=model, 
+            dataloader=dataloader,
+            prune_scores=prune_scores,
+            grad_function=grad_function,
+            answer_function=answer_function,
+            ablation_type=ablation_type,
+            edge_counts=edge_counts,
+            model_out=model_out,
+            model_out_cache=model_out_cache,
+            use_abs=use_abs,
+            side=side,
+            alpha=alpha,
+            epsilon=epsilon,
+            circuits_per_forward=circuits_per_forward,
+            incremental_masks=incremental_masks,
+            prefix_cache=prefix_cache,
+            memo=memo,
+            ranked_edges=ranked_edges,
+            mode=mode,
+        )
+        full_results.update(test_results)
+        return test_results
+
+    # gallop: largest non equiv (interval_min) and smallest equiv (interval_max) sizes
+    interval_min, interval_max = -1, None
+    next_count = 1
+    edge_counts = [0]
+    while interval_max is None:
+        while len(edge_counts) < probes_per_round and next_count < model.n_edges:
+            edge_counts.append(next_count)
+            next_count *= 2
+        if len(edge_counts) < probes_per_round or next_count >= model.n_edges:
+            edge_counts.append(model.n_edges)
+        print(f"gallop: {edge_counts}")
+        test_results = test(edge_counts)
+        equivs = [k for k, v in test_results.items() if not v.not_equiv]
+        if equivs:
+            interval_max = min(equivs)
+            interval_min = max([k for k in test_results if k < interval_max], default=interval_min)
+        elif model.n_edges in test_results:
+            interval_max = model.n_edges # the full model is equivalent by definition
+            interval_min = max([k for k in test_results if k < model.n_edges], default=interval_min)
+        else:
+            interval_min = max(test_results)
+            edge_counts = []
+
+    interval_max = refine_smallest_equiv(test, ranked_edges, interval_min, interval_max, probes_per_round)
+    full_results = {k: full_results[k] for k in sorted(full_results.keys())}
+    return full_results, interval_max
+
+
+def refine_smallest_equiv(
+    test: Callable[[list[int]], Dict[int, EquivResult]],
+    ranked_edges: RankedEdges,
+    interval_min: int,
+    interval_max: int,
+    probes_per_round: int,
+) -> int:
+    """
+    The smallest equivalent circuit size in the bracket (`interval_min` not equivalent,
+    `interval_max` equivalent), splitting the bracket into `probes_per_round + 1` even
+    parts per round, each tested by `test` (edge counts -> results keyed by size).
+    """
+    while interval_max - interval_min > 1:
+        width = interval_max - interval_min
+        edge_counts = sorted({
+            interval_min + math.ceil(i * width / (probes_per_round + 1))
+            for i in range(1, probes_per_round + 1)
+        } - {interval_min, interval_max})
+        # drop counts with the same circuit as a bracket end (tied scores)
+        sizes = ranked_edges.counts(ranked_edges.thresholds(edge_counts)).tolist()
+        edge_counts = [k for k, size in zip(edge_counts, sizes) if interval_min < size < interval_max]
+        if not edge_counts:
+            break
+        print(f"interval: {interval_min} - {interval_max}, probes: {edge_counts}")
+        test_results = test(edge_counts)
+        for k, v in sorted(test_results.items()):
+            if v.not_equiv:
+                interval_min = max(interval_min, k)
+            else:
+                interval_max = min(interval_max, k)
+                break
+    return interval_max
+
+
+class EdgeCountEstimate(Enum):
+    KNEE = "knee" # the knee of the ranked edge score curve
+    MASS = "mass" # the edges with a quantile of the total (positive) score mass
+
+
+def edge_count_estimate(
+    ranked_edges: RankedEdges,
+    estimate: EdgeCountEstimate = EdgeCountEstimate.KNEE,
+    mass_quantile: float = 0.9,
+) -> int:
+    """
+    A cheap estimate of the minimal equivalent edge count from the ranked scores alone
+    (the `compute_knees` interp1d knee, falling back to the score mass quantile when the
+    curve has no knee). Only positive scores are considered.
+    """
+    desc_scores = ranked_edges.desc_scores.detach().float().cpu()
+    desc_scores = desc_scores[desc_scores > 0]
+    if len(desc_scores) == 0:
+        return 0
+    if estimate == EdgeCountEstimate.KNEE:
+        _kneedle_poly, kneedle_1d = compute_knees(desc_scores.flip(0).numpy())
+        if kneedle_1d.knee is not None:
+            return min(max(round(len(desc_scores) - kneedle_1d.knee), 1), ranked_edges.n_edges)
+    cum_mass = desc_scores.cumsum(0)
+    k = int(torch.searchsorted(cum_mass, mass_quantile * cum_mass[-1]).item()) + 1
+    return min(k, len(desc_scores))
+
+
+@profiled()
+def seeded_search_smallest_equiv(
+    model: PatchableModel,
+    dataloader: PromptDataLoader,
+    prune_scores: PruneScores,
+    grad_function: GradFunc,
+    answer_function: AnswerFunc,
+    ablation_type: AblationType, 
+    use_abs: bool = True,
+    side: Side = Side.NONE,
+    alpha: float = 0.05,
+    epsilon: float = 0.1,
+    model_out: Optional[Dict[BatchKey, torch.Tensor]] = None,
+    model_out_cache: Optional[ModelOutputCache] = None,
+    seed_edge_count: Optional[int] = None,
+    estimate: EdgeCountEstimate = EdgeCountEstimate.KNEE,
+    bracket_frac: float = 0.25,
+    probes_per_round: int = 8,
+    circuits_per_forward: Optional[int] = None,
+    incremental_masks: bool = False,
+    prefix_cache: Optional[LayerPrefixCache] = None,
+    memo: Optional[EquivMemo] = None,
+    mode: EquivTestMode = EquivTestMode.FULL,
+) -> tuple[dict[int, EquivResult], int]:
+    """
+    Returns equiv test results and minimal equivalent number of edges (as
+    `sweep_search_smallest_equiv`), starting from a narrow bracket around
+    `seed_edge_count` (by default the `edge_count_estimate` of the ranked scores),
+    `bracket_frac` of the seed wide on each side.
+
+    The bracket ends are tested together; while the lower end is equivalent (or the
+    upper end is not) that end is moved out by twice the bracket width. The bracket is
+    then refined as in `gallop_search_smallest_equiv` (`probes_per_round` counts per
+    round). When the seed is close, this skips the coarse rounds of the sweep search.
+    """
+    memo = memo if memo is not None else EquivMemo()
+    ranked_edges = RankedEdges(prune_scores, use_abs=use_abs)
+    circuits_per_forward = default_circuits_per_forward(
+        circuits_per_forward, probes_per_round, incremental_masks, prefix_cache
+    )
+    full_results: Dict[int, EquivResult] = {}
+
+    def test(edge_counts: list[int]) -> Dict[int, EquivResult]:
+        test_results = equiv_test(
+            model=model, 
+            dataloader=dataloader,
+            prune_scores=prune_scores,
+            grad_function=grad_function,
+            answer_function=answer_function,
+            ablation_type=ablation_type,
+            edge_counts=edge_counts,
+            model_out=model_out,
+            model_out_cache=model_out_cache,
+            use_abs=use_abs,
+            side=side,
+            alpha=alpha,
+            epsilon=epsilon,
+            circuits_per_forward=circuits_per_forward,
+            incremental_masks=incremental_masks,
+            prefix_cache=prefix_cache,
+            memo=memo,
+            ranked_edges=ranked_edges,
+            mode=mode,
+        )
+        full_results.update(test_results)
+        return test_results
+
+    if seed_edge_count is None:
+        seed_edge_count = edge_count_estimate(ranked_edges, estimate)
+    seed_edge_count = min(max(seed_edge_count, 0), model.n_edges)
+    half_width = max(math.ceil(seed_edge_count * bracket_frac), 1)
+    lower = max(seed_edge_count - half_width, 0)
+    upper = min(seed_edge_count + half_width, model.n_edges)
+    print(f"seed: {seed_edge_count}")
+
+    # widen until the lower end is not equiv (or 0) and the upper end is equiv (or full)
+    interval_min, interval_max = -1, None
+    while interval_max is None:
+        print(f"bracket: {lower} - {upper}")
+        (lower_size, upper_size) = ranked_edges.counts(ranked_edges.thresholds([lower, upper])).tolist()
+        test_results = test([lower, upper])
+        lower_equiv = not test_results[lower_size].not_equiv
+        upper_equiv = not test_results[upper_size].not_equiv
+        width = upper - lower
+        if lower_equiv and lower > 0:
+            upper, lower = lower, max(lower - 2 * width, 0)
+        elif lower_equiv:
+            interval_max = lower_size
+        elif not upper_equiv and upper < model.n_edges:
+            lower, upper = upper, min(upper + 2 * width, model.n_edges)
+        else:
+            interval_min = lower_size
+            interval_max = upper_size if upper_equiv else model.n_edges # the full model is equivalent
+
+    interval_max = refine_smallest_equiv(test, ranked_edges, interval_min, interval_max, probes_per_round)
+    full_results = {k: full_results[k] for k in sorted(full_results.keys())}
+    return full_results, interval_max
+
 
 def plot_num_ablated_C_gt_M(
         results: Dict[int, Any], 
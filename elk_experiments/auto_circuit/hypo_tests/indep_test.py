@@ -6,12 +6,14 @@ from sklearn.metrics.pairwise import rbf_kernel
 from sklearn.preprocessing import KernelCenterer
 
 from auto_circuit.data import PromptDataLoader, PromptPairBatch
-from auto_circuit.prune import run_circuits
 from auto_circuit.types import PruneScores, BatchOutputs, PatchType, AblationType
 from auto_circuit.utils.patchable_model import PatchableModel
 from auto_circuit.utils.custom_tqdm import tqdm
 
+from elk_experiments.profiler import PROFILER, profiled
+from elk_experiments.auto_circuit.auto_circuit_utils import run_circuits
 from elk_experiments.auto_circuit.score_funcs import GradFunc, AnswerFunc, get_score_func
+from elk_experiments.auto_circuit.hypo_tests.model_output_cache import ModelOutputCache, MODEL_OUTPUT_CACHE
 
 
 
@@ -29,6 +31,7 @@ class IndepResults(NamedTuple):
     p_value: float 
 
 
+@profiled()
 def independence_test(
     model: PatchableModel,
     dataloader: PromptDataLoader,
@@ -40,18 +43,18 @@ def independence_test(
     use_abs: bool,
     alpha: float = 0.05,
     B: int = 1000,
+    model_out_cache: Optional[ModelOutputCache] = None,
 ) -> IndepResults:
     # compute model out 
-    m_out: BatchOutputs = {}
-    for batch in dataloader:
-        m_out[batch.key] = model(batch.clean)[model.out_slice]
+    m_out: BatchOutputs = (model_out_cache or MODEL_OUTPUT_CACHE).batch_outputs(model, dataloader)
     # construct independence scores, applying abs value if use_abs is False (to ablate negative edges and only take complement on positives)
     independence_scores = {k: v.clone() for k, v in prune_scores.items()}
     if not use_abs:
         for k in independence_scores:
             independence_scores[k][independence_scores[k] < 0] = threshold + 1
-    # next, we run the complement of the circuit 
-    c_comp_out = dict(next(iter(run_circuits(
+    score_func = get_score_func(grad_function, answer_function)
+    # next, we run the complement of the circuit (keeping only its scores)
+    c_comp_scores_out = dict(next(iter(run_circuits(
         model,
         dataloader,
         prune_scores=independence_scores,
@@ -60,15 +63,15 @@ def independence_test(
         ablation_type=ablation_type,
         reverse_clean_corrupt=False, 
         use_abs=True,
+        reducer=score_func,
     ).values())))
 
     # then, we compute the scores 
-    score_func = get_score_func(grad_function, answer_function)
     m_scores = []
     c_comp_scores = []
     for batch in dataloader:
         m_scores.append(score_func(m_out[batch.key], batch)) # supposed to be looking at all output #TODO
-        c_comp_scores.append(score_func(c_comp_out[batch.key], batch))
+        c_comp_scores.append(c_comp_scores_out[batch.key])
     m_scores = torch.cat(m_scores)[:, None].detach().cpu()
     c_comp_scores = torch.cat(c_comp_scores)[:, None].detach().cpu()
     sigma = torch.cdist(m_scores, c_comp_scores, p=2).median().item()
@@ -81,13 +84,14 @@ def independence_test(
     # then we compute the trace of the inner product of the cross product and itself (alternatively, the trace of the inner product of the covariance matrices)
     # we store that value, then for b iterations 
     t = 0
-    for b in range(B):
-        # permutate the model scores 
-        perm_m_scores = np.random.permutation(m_scores)
-        # compute the new HSIC value 
-        t_i = hsic(perm_m_scores, c_comp_scores, gamma=sigma)
-        # increment t with 1 if new value greater 
-        t += t_obs < t_i
+    with PROFILER.span("hsic_permutations", B=B):
+        for b in range(B):
+            # permutate the model scores 
+            perm_m_scores = np.random.permutation(m_scores)
+            # compute the new HSIC value 
+            t_i = hsic(perm_m_scores, c_comp_scores, gamma=sigma)
+            # increment t with 1 if new value greater 
+            t += t_obs < t_i
     # p value = t / B (higher p value -> more instances greater than t_obs -> more likely to be independent)
     p_value = t / B
     return IndepResults(not_indep=bool(p_value < alpha), p_value=p_value)
\ No newline at end of file
@@ -1,5 +1,6 @@
 from typing import Callable, Dict, Tuple, Union, Optional, Any, Literal, NamedTuple
 import random
+from contextlib import nullcontext
 
 import torch 
 import numpy as np
@@ -7,8 +8,6 @@ from scipy.stats import binom
 import matplotlib.pyplot as plt
 
 from auto_circuit.data import PromptDataLoader
-from auto_circuit.prune import run_circuits
-from auto_circuit.utils.tensor_ops import prune_scores_threshold
 from auto_circuit.types import (
     CircuitOutputs, 
     BatchKey,
@@ -21,9 +20,15 @@ from auto_circuit.types import (
 from auto_circuit.utils.patchable_model import PatchableModel
 from auto_circuit.utils.custom_tqdm import tqdm
 
+from elk_experiments.profiler import profiled
+from elk_experiments.auto_circuit.auto_circuit_utils import run_circuits, run_edge_ablations, prune_scores_threshold
+from elk_experiments.auto_circuit.prefix_cache import LayerPrefixCache
+from elk_experiments.auto_circuit.ranked_edges import RankedEdges
+from elk_experiments.auto_circuit.edge_index import EdgeIndex
+from elk_experiments.auto_circuit.sparse_prune_scores import SparsePruneScores
 from elk_experiments.auto_circuit.score_funcs import GradFunc, AnswerFunc, get_score_func
 from elk_experiments.auto_circuit.edge_graph import SeqGraph, sample_paths 
-from elk_experiments.auto_circuit.hypo_tests.utils import edges_from_mask, get_edge_idx, set_score
+from elk_experiments.auto_circuit.hypo_tests.utils import edges_from_mask
 
 
 
@@ -38,6 +43,7 @@ def join_values(d: Dict[Any, Dict]):
     return {k: v for sub_d in d.values() for k, v in sub_d.items()}
 
 
+@profiled()
 def minimality_test( #TODO: seperate infalted circuit seperate from dataset, get higher n 
     model: PatchableModel,
     dataloader: PromptDataLoader,
@@ -51,6 +57,7 @@ def minimality_test( #TODO: seperate infalted circuit seperate from dataset, get
     seq_graph: Optional[SeqGraph] = None,
     n_paths: Optional[int] = None,
     circuit_out: Optional[CircuitOutputs] = None,
+    circuit_scores: Optional[BatchOutputs] = None,
     threshold: Optional[float] = None,
     use_abs: bool = True,
     tokens: bool = False,
@@ -58,21 +65,42 @@ def minimality_test( #TODO: seperate infalted circuit seperate from dataset, get
     q_star: float = 0.9,
     max_edges_in_order: Optional[int] = None,
     max_edges_in_order_without_fail: Optional[int] = None,
-    max_edges_to_sample: int = 0
+    max_edges_to_sample: int = 0,
+    prefix_cache: Optional[LayerPrefixCache] = None,
+    edges_per_forward: Optional[int] = None,
 ) -> Tuple[Dict[Edge, MinResult], Dict[Edge, MinResult]]:
-    if circuit_out is None:
-        circuit_out = dict(next(iter(run_circuits(
+    """
+    Circuits are only kept as per instance scores (`circuit_scores`, or the scores of
+    `circuit_out`, if given, are the scores of the circuit).
+
+    If `prefix_cache` is given, the activations of the circuit are cached (on every batch),
+    and each edge ablation resumes the forward pass from the layer of the ablated edge.
+
+    If `edges_per_forward` is given, the edges are ablated in chunks of `edges_per_forward`
+    edges (in test order), packed into one forward pass per batch (see
+    `run_edge_ablations`), so a chunk costs one pass over the dataloader instead of one
+    per edge.
+    """
+    assert prefix_cache is None or edges_per_forward is None, "prefix caches run one edge at a time"
+    score_func = get_score_func(grad_function, answer_function)
+    if threshold is None:
+        threshold = prune_scores_threshold(prune_scores, edge_count, use_abs=use_abs)
+    if circuit_scores is None and circuit_out is not None:
+        circuit_scores = {batch.key: score_func(circuit_out[batch.key], batch) for batch in dataloader}
+    if circuit_scores is None or prefix_cache is not None:
+        prefix_cache_circuit_scores = dict(next(iter(run_circuits(
             model=model, 
             dataloader=dataloader,
-            test_edge_counts=[edge_count],
+            thresholds=[threshold],
             prune_scores=prune_scores,
             patch_type=PatchType.TREE_PATCH,
             ablation_type=ablation_type,
             reverse_clean_corrupt=False,
-            use_abs=use_abs
+            use_abs=use_abs,
+            prefix_cache=prefix_cache,
+            reducer=score_func,
         ).values())))
-    if threshold is None:
-        threshold = prune_scores_threshold(prune_scores, edge_count, use_abs=use_abs)
+        circuit_scores = circuit_scores if circuit_scores is not None else prefix_cache_circuit_scores
 
     # sample filtered paths if not provided
     if filtered_paths is None:
@@ -86,22 +114,27 @@ def minimality_test( #TODO: seperate infalted circuit seperate from dataset, get
             tested_edges=edges,
         )
     
-    # sample random paths, inflate prune scores, and run
-    sampled_paths: Dict[BatchKey, list[Edge]] = {}
-    prune_scores_inflated: Dict[BatchKey, PruneScores] = {}
+    # sample random paths, inflate prune scores (as sparse overrides of the shared
+    # circuit scores), and run
+    ranked_edges = RankedEdges(prune_scores, use_abs=use_abs)
+    index = EdgeIndex(
+        model.srcs, model.dests, {mod_name: ps.shape for mod_name, ps in prune_scores.items()}, tokens=tokens
+    )
+    path_edge_ids = [index.edge_ids(path) for path in filtered_paths]
+    sampled_paths: Dict[BatchKey, list[list[Edge]]] = {}
+    prune_scores_inflated: Dict[BatchKey, SparsePruneScores] = {}
     for batch in dataloader:
-        prune_scores_inflated[batch.key] = {
-            k: score.unsqueeze(0).repeat_interleave(batch.clean.size(0), 0)
-            for k, score in prune_scores.items()
-        }
-        sampled_paths[batch.key] = random.choices(filtered_paths, k=batch.clean.size(0))
-    for batch_key, paths in sampled_paths.items():
-        for batch_idx, path in enumerate(paths):
-            for edge in path:
-                set_score(edge, prune_scores_inflated[batch_key], threshold+1, batch_idx=batch_idx, tokens=tokens)
+        path_idxs = random.choices(range(len(filtered_paths)), k=batch.clean.size(0))
+        sampled_paths[batch.key] = [filtered_paths[i] for i in path_idxs]
+        inst_idxs = torch.arange(len(path_idxs)).repeat_interleave(
+            torch.tensor([len(filtered_paths[i]) for i in path_idxs])
+        )
+        prune_scores_inflated[batch.key] = SparsePruneScores(ranked_edges, batch.clean.size(0)).with_overrides(
+            inst_idxs, torch.cat([path_edge_ids[i] for i in path_idxs]), threshold+1
+        )
     
     # join values b/c number of edges can vary by batch
-    circuit_out_inflated: BatchOutputs = join_values(run_circuits(
+    circuit_scores_inflated: BatchOutputs = join_values(run_circuits(
         model=model, 
         dataloader=dataloader,
         thresholds=[threshold],
@@ -109,17 +142,19 @@ def minimality_test( #TODO: seperate infalted circuit seperate from dataset, get
         patch_type=PatchType.TREE_PATCH,
         ablation_type=ablation_type,
         reverse_clean_corrupt=False,
-        use_abs=use_abs
+        use_abs=use_abs,
+        reducer=score_func,
     ))
 
     # ablate random edges in paths and run 
     edges_set = set(edges)
-    prune_scores_ablated_paths = prune_scores_inflated
+    prune_scores_ablated_paths: Dict[BatchKey, SparsePruneScores] = {}
     for batch_key, paths in sampled_paths.items():
-        for batch_idx, path in enumerate(paths):
-            edge_to_ablate = random.choice(list(set(path) - edges_set)) 
-            set_score(edge_to_ablate, prune_scores_ablated_paths[batch_key], 0.0, batch_idx, tokens=tokens)
-    circuit_out_ablated_paths: BatchOutputs = join_values(run_circuits(
+        edges_to_ablate = [random.choice(list(set(path) - edges_set)) for path in paths]
+        prune_scores_ablated_paths[batch_key] = prune_scores_inflated[batch_key].with_overrides(
+            torch.arange(len(paths)), index.edge_ids(edges_to_ablate), 0.0
+        )
+    circuit_scores_ablated_paths: BatchOutputs = join_values(run_circuits(
         model=model, 
         dataloader=dataloader,
         thresholds=[threshold],
@@ -127,97 +162,119 @@ def minimality_test( #TODO: seperate infalted circuit seperate from dataset, get
         patch_type=PatchType.TREE_PATCH,
         ablation_type=ablation_type,
         reverse_clean_corrupt=False,
-        use_abs=use_abs
+        use_abs=use_abs,
+        reducer=score_func,
     ))
-    # test edges
-    def test_edge(edge):
+    circuit_scores_ablated: Dict[Edge, BatchOutputs] = {}
+    def test_edge(edge, next_edges: list[Edge]):
+        if edges_per_forward is not None and edge not in circuit_scores_ablated:
+            circuit_scores_ablated.update(run_edge_ablations(
+                model=model,
+                dataloader=dataloader,
+                prune_scores=prune_scores,
+                threshold=threshold,
+                edges=[edge] + [e for e in next_edges[:edges_per_forward - 1] if e != edge],
+                ablation_type=ablation_type,
+                use_abs=use_abs,
+                tokens=tokens,
+                edges_per_forward=edges_per_forward,
+                reducer=score_func,
+            ))
         return minimality_test_edge(
             model=model,
             dataloader=dataloader,
             prune_scores=prune_scores,
             edge=edge,
-            circuit_out_inflated=circuit_out_inflated,
-            circuit_out_ablated_paths=circuit_out_ablated_paths,
+            circuit_scores_inflated=circuit_scores_inflated,
+            circuit_scores_ablated_paths=circuit_scores_ablated_paths,
             ablation_type=ablation_type,
             threshold=threshold,
             grad_function=grad_function,
             answer_function=answer_function,
-            circuit_out=circuit_out,
+            circuit_scores=circuit_scores,
             tokens=tokens,
             alpha=alpha / edge_count, # bonferroni correction
             q_star=q_star,
+            prefix_cache=prefix_cache,
+            circuit_scores_ablated=circuit_scores_ablated.pop(edge, None),
         )
-    # run minimality test until failure and exceeds max_edges_in_order (whichever comes second)
-    ordered_test_results = {}
-    has_failed = False
-    for i, edge in tqdm(enumerate(edges)):
-        result = test_edge(edge)
-        has_failed = has_failed or result.not_minimal
-        ordered_test_results[edge] = result
-        if has_failed and i >= max_edges_in_order:
-            break
-        if i >= max_edges_in_order_without_fail:
-            break
-    
-    # if failed, samples without replacement and run minimality test
-    sampled_test_results = {}
-    if has_failed:
-        sampled_edges = random.sample(edges, min(max_edges_to_sample, len(edges)))
-        for edge in tqdm(sampled_edges):
-            result = test_edge(edge)
-            sampled_test_results[edge] = result
+    # test edges (keeping the cached circuit activations)
+    with prefix_cache.frozen() if prefix_cache is not None else nullcontext():
+        # run minimality test until failure and exceeds max_edges_in_order (whichever comes second)
+        ordered_test_results = {}
+        has_failed = False
+        for i, edge in tqdm(enumerate(edges)):
+            result = test_edge(edge, edges[i + 1:])
+            has_failed = has_failed or result.not_minimal
+            ordered_test_results[edge] = result
+            if has_failed and i >= max_edges_in_order:
+                break
+            if i >= max_edges_in_order_without_fail:
+                break
     
+        # if failed, samples without replacement and run minimality test
+        sampled_test_results = {}
+        if has_failed:
+            sampled_edges = random.sample(edges, min(max_edges_to_sample, len(edges)))
+            for i, edge in tqdm(enumerate(sampled_edges)):
+                result = test_edge(edge, sampled_edges[i + 1:])
+                sampled_test_results[edge] = result
     return ordered_test_results, sampled_test_results
 
+@profiled()
 def minimality_test_edge(
     model: PatchableModel,
     dataloader: PromptDataLoader,
     prune_scores: PruneScores,
     edge: Edge,
-    circuit_out_inflated: BatchOutputs, 
-    circuit_out_ablated_paths: BatchOutputs,
+    circuit_scores_inflated: BatchOutputs, 
+    circuit_scores_ablated_paths: BatchOutputs,
     ablation_type: AblationType,
     threshold: float,
     grad_function: GradFunc,
     answer_function: AnswerFunc,
     use_abs: bool = True,  
     tokens: bool = False,
-    circuit_out: Optional[CircuitOutputs] = None,
+    circuit_scores: Optional[BatchOutputs] = None,
     alpha: float = 0.05,
     q_star: float = 0.9,
+    prefix_cache: Optional[LayerPrefixCache] = None,
+    circuit_scores_ablated: Optional[BatchOutputs] = None,
 ) -> MinResult:
-    
-    # ablate edge and run 
-    prune_scores_ablated = {k: v.clone() for k, v in prune_scores.items()}
-    prune_scores_ablated[edge.dest.module_name][get_edge_idx(edge, tokens=tokens)] = 0.0
-    circuit_out_ablated = next(iter(run_circuits(
-        model=model, 
-        dataloader=dataloader,
-        thresholds=[threshold],
-        prune_scores=prune_scores_ablated,
-        patch_type=PatchType.TREE_PATCH,
-        ablation_type=ablation_type,
-        reverse_clean_corrupt=False,
-        use_abs=use_abs
-    ).values()))
+    score_func = get_score_func(grad_function, answer_function)
+
+    # ablate edge and run (unless the ablated circuit scores are given)
+    if circuit_scores_ablated is None:
+        prune_scores_ablated = {k: v.clone() for k, v in prune_scores.items()}
+        index = EdgeIndex(
+            model.srcs, model.dests, {mod_name: ps.shape for mod_name, ps in prune_scores.items()}, tokens=tokens
+        )
+        index.scatter(prune_scores_ablated, index.edge_ids([edge]), 0.0)
+        circuit_scores_ablated = next(iter(run_circuits(
+            model=model, 
+            dataloader=dataloader,
+            thresholds=[threshold],
+            prune_scores=prune_scores_ablated,
+            patch_type=PatchType.TREE_PATCH,
+            ablation_type=ablation_type,
+            reverse_clean_corrupt=False,
+            use_abs=use_abs,
+            prefix_cache=prefix_cache,
+            reducer=score_func,
+        ).values()))
 
     # compute statistics
     n = 0
     num_edge_score_gt_ref = 0
     diffs = []
     diffs_inflated = []
-    score_func = get_score_func(grad_function, answer_function)
     for batch in dataloader:
         bs = batch.clean.size(0)
         # compute frequency diff between full circuit and ablated edge is greater than inflated circuit - ablated circuit
-        circ_out_ablated = circuit_out_ablated[batch.key]
-        circ_out_inflated = circuit_out_inflated[batch.key]
-        circ_out_ablated_paths = circuit_out_ablated_paths[batch.key]
-        circ_out = circuit_out[batch.key]
-        circ_out_logit_diff = score_func(circ_out, batch)
-        circ_out_ablated_logit_diff = score_func(circ_out_ablated, batch)
-        circ_out_inflated_logit_diff = score_func(circ_out_inflated, batch)
-        circ_out_inflated_ablated_logit_diff = score_func(circ_out_ablated_paths, batch)
+        circ_out_logit_diff = circuit_scores[batch.key]
+        circ_out_ablated_logit_diff = circuit_scores_ablated[batch.key]
+        circ_out_inflated_logit_diff = circuit_scores_inflated[batch.key]
+        circ_out_inflated_ablated_logit_diff = circuit_scores_ablated_paths[batch.key]
 
         circ_diff = torch.abs(circ_out_logit_diff - circ_out_ablated_logit_diff)
         circ_inflated_diff = torch.abs(circ_out_inflated_logit_diff - circ_out_inflated_ablated_logit_diff)
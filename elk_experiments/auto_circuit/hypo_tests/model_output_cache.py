@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple, Union
+import hashlib
+
+import torch
+
+from auto_circuit.data import PromptDataLoader, PromptPairBatch
+from auto_circuit.types import BatchKey, BatchOutputs
+
+from elk_experiments.utils import model_fingerprint
+
+ModelOutputKey = Tuple[str, BatchKey, str] # model fingerprint, batch key, out slice
+
+
+class ModelOutputCache:
+    """
+    Outputs of the full (unpatched) model, keyed by (model fingerprint, batch key, out
+    slice). Each output is computed once, in inference mode, and is optionally spilled to
+    `cache_dir` so later runs (and other hypothesis tests) can reuse it.
+
+    Outputs must be requested outside of `patch_mode`, otherwise the cached outputs would
+    be those of the patched model.
+
+    With `max_outputs`, at most that many outputs are kept in memory (least recently
+    used outputs are dropped first, and recomputed or reloaded when requested again).
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[Union[str, Path]] = None,
+        keep_in_memory: bool = True,
+        max_outputs: Optional[int] = None,
+    ):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.keep_in_memory = keep_in_memory
+        self.max_outputs = max_outputs
+        self._outputs: "OrderedDict[ModelOutputKey, torch.Tensor]" = OrderedDict()
+
+    def _key(self, model: torch.nn.Module, batch_key: BatchKey, out_slice: Any) -> ModelOutputKey:
+        return (model_fingerprint(model), batch_key, repr(out_slice))
+
+    def _path(self, key: ModelOutputKey) -> Path:
+        assert self.cache_dir is not None
+        fingerprint, batch_key, out_slice = key
+        slice_digest = hashlib.blake2b(out_slice.encode(), digest_size=4).hexdigest()
+        return self.cache_dir / f"{fingerprint}_{batch_key}_{slice_digest}.pt"
+
+    def get(
+        self,
+        model: torch.nn.Module,
+        batch: PromptPairBatch,
+        out_slice: Optional[Any] = None
+    ) -> torch.Tensor:
+        """
+        Output of `model` on `batch.clean`, sliced by `out_slice` (default
+        `model.out_slice`).
+        """
+        out_slice = out_slice if out_slice is not None else model.out_slice
+        key = self._key(model, batch.key, out_slice)
+        if key in self._outputs:
+            self._outputs.move_to_end(key)
+            return self._outputs[key]
+        path = self._path(key) if self.cache_dir is not None else None
+        if path is not None and path.exists():
+            output = torch.load(path)
+        else:
+            with torch.inference_mode():
+                output = model(batch.clean)[out_slice]
+            if path is not None:
+                torch.save(output, path)
+        if self.keep_in_memory:
+            self._outputs[key] = output
+            if self.max_outputs is not None and len(self._outputs) > self.max_outputs:
+                self._outputs.popitem(last=False)
+        return output
+
+    def batch_outputs(
+        self,
+        model: torch.nn.Module,
+        dataloader: PromptDataLoader,
+        out_slice: Optional[Any] = None
+    ) -> BatchOutputs:
+        """Outputs of `model` for every batch in `dataloader`, keyed by batch key."""
+        return {batch.key: self.get(model, batch, out_slice=out_slice) for batch in dataloader}
+
+    def clear(self):
+        """Drop the in-memory outputs (outputs spilled to disk are kept)."""
+        self._outputs.clear()
+
+
+# shared by every hypothesis test unless a cache is passed explicitly (bounded, since it
+# lives as long as the process; pass an unbounded cache to keep every output)
+MODEL_OUTPUT_CACHE_MAX_OUTPUTS = 64
+MODEL_OUTPUT_CACHE = ModelOutputCache(max_outputs=MODEL_OUTPUT_CACHE_MAX_OUTPUTS)
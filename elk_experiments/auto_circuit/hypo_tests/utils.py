@@ -1,45 +1,30 @@
 from typing import Dict, Optional, NamedTuple
 import torch
 from auto_circuit.types import SrcNode, DestNode, Edge
+from auto_circuit.utils.patchable_model import PatchableModel
 
+from elk_experiments.auto_circuit.edge_index import EdgeIndex, edge_index
 
-def edges_from_mask(srcs: set[SrcNode], dests: set[DestNode], mask: Dict[str, torch.Tensor], token: bool=False) -> list[Edge]:
+
+def edges_from_mask(
+    srcs: set[SrcNode], 
+    dests: set[DestNode], 
+    mask: Dict[str, torch.Tensor], 
+    token: bool=False,
+    model: Optional[PatchableModel] = None
+) -> list[Edge]:
     #TODO: fix for SAEs
-    SRC_IDX_TO_NODE = {src.src_idx: src for src in srcs}
-    DEST_MOD_AND_HEAD_TO_NODE = {(dest.module_name, dest.head_idx): dest for dest in dests}
-    edges = []
-    for mod_name, mask in mask.items():
-        for idx in mask.nonzero():
-            # src idx 
-            if len(idx) == 1:
-                assert not token
-                src_idx = idx.item() 
-                dest_idx = None
-                seq_idx = None
-            elif len(idx) == 2 and not token: 
-                src_idx = idx[1].item()
-                dest_idx = idx[0].item()
-                seq_idx = None
-            elif len(idx) == 2 and token:
-                src_idx = idx[1].item()
-                dest_idx = None
-                seq_idx = idx[0].item()
-            else: 
-                assert token and len(idx) == 3
-                src_idx = idx[2].item()
-                dest_idx = idx[1].item()
-                seq_idx = idx[0].item()
-            dest_node = DEST_MOD_AND_HEAD_TO_NODE[(mod_name, dest_idx)]
-            src_node = SRC_IDX_TO_NODE[src_idx]
-            edges.append(Edge(src=src_node, dest=dest_node, seq_idx=seq_idx))
-    return edges
+    # use the model's (cached) index if given, otherwise index the nodes for this mask
+    index = edge_index(model) if model is not None else EdgeIndex(
+        srcs, dests, {mod_name: m.shape for mod_name, m in mask.items()}, tokens=token
+    )
+    return index.mask_to_edges(mask)
 
 
 def get_edge_idx(edge: Edge, tokens=False):
     # TODO: make backwards compatible
-    if edge.dest.name == "Resid End":
-        idx = (edge.src.src_idx,)
-    elif edge.dest.name.startswith("MLP"):
+    # dests without heads (mlps, resid end) have no head dim
+    if edge.dest.head_idx is None:
         idx = (edge.src.src_idx,)
     else:
         idx = (edge.dest.head_idx, edge.src.src_idx)
@@ -52,13 +37,12 @@ def set_score(edge: Edge, scores, value, batch_idx: Optional[int] = None, tokens
     idx = get_edge_idx(edge, tokens=tokens)
     # remove nones
     idx = tuple(filter(lambda x: x is not None, idx))
-    # if idx[0] is None:
-    #     idx = idx[1:]
     if batch_idx is not None:
         idx = (batch_idx,) + idx
     scores[edge.dest.module_name][idx] = value
     return scores
 
+
 def result_to_json(result: NamedTuple): 
     return {
         k: v.tolist() if isinstance(v, torch.Tensor) else v 
@@ -0,0 +1,105 @@
+from collections import defaultdict
+from itertools import chain
+from typing import Any, Dict, List, Optional
+
+import torch
+import torch.multiprocessing
+
+from auto_circuit.data import PromptDataLoader
+from auto_circuit.types import AblationType, CircuitOutputs
+from auto_circuit.utils.patchable_model import PatchableModel
+
+from elk_experiments.auto_circuit.auto_circuit_utils import BatchShard, run_circuits
+from elk_experiments.auto_circuit.src_ablation_cache import SRC_ABLATION_CACHE
+
+
+def share_weights(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Move the parameters and buffers of `model` to shared memory, except the patch masks
+    (which each worker sets in place for its own circuits).
+    """
+    for name, tensor in chain(model.named_parameters(), model.named_buffers()):
+        if "patch_mask" not in name:
+            tensor.share_memory_()
+    return model
+
+
+# state inherited by forked workers (set by the parent right before forking)
+_WORKER_STATE: Dict[str, Any] = {}
+
+
+def _init_worker(threads_per_worker: int):
+    torch.set_num_threads(threads_per_worker)
+
+
+def _run_shard(batch_idxs: List[int]) -> Dict[int, Dict[int, Any]]:
+    state = _WORKER_STATE
+    shard = BatchShard([state["batches"][i] for i in batch_idxs], state["seq_labels"])
+    circ_outs = run_circuits(model=state["model"], dataloader=shard, **state["kwargs"])
+    return {edge_count: dict(outs) for edge_count, outs in circ_outs.items()}
+
+
+def parallel_run_circuits(
+    model: PatchableModel,
+    dataloader: PromptDataLoader,
+    n_workers: int,
+    threads_per_worker: Optional[int] = None,
+    **kwargs,
+) -> CircuitOutputs:
+    """
+    `run_circuits` with the batches of `dataloader` sharded across `n_workers` forked
+    (CPU) worker processes. The model weights are moved to shared memory (so workers
+    don't copy them), each worker runs with `threads_per_worker` intra-op threads
+    (default: an even split of `torch.get_num_threads()`), and dataset mean src
+    ablations are computed once, over the full dataloader, before forking.
+
+    Every circuit is run on each batch exactly as in the serial path, and the outputs
+    are merged in the serial order (edge counts, then batches in dataloader order), so
+    the result is the same as `run_circuits(model, dataloader, **kwargs)` (bit for bit
+    when the serial run uses the same number of intra-op threads, as some CPU kernels
+    reduce in a thread count dependent order).
+
+    Args:
+        model: The model to run (on the CPU).
+        dataloader: The dataloader to shard by batch.
+        n_workers: The number of worker processes (1 runs serially in this process).
+        threads_per_worker: The intra-op thread budget of each worker.
+        kwargs: The other arguments of `run_circuits` (e.g. `prune_scores`,
+            `test_edge_counts`, `reducer`), which are inherited by the workers on fork
+            (so they need not be picklable).
+
+    Returns:
+        The merged circuit outputs.
+    """
+    batches = list(dataloader)
+    n_workers = min(n_workers, len(batches))
+    if n_workers <= 1:
+        return run_circuits(model=model, dataloader=dataloader, **kwargs)
+    assert kwargs.get("prefix_cache") is None, "prefix caches are per process"
+    threads_per_worker = threads_per_worker or max(1, torch.get_num_threads() // n_workers)
+
+    ablation_type: AblationType = kwargs.get("ablation_type", AblationType.RESAMPLE)
+    if ablation_type.mean_over_dataset and kwargs.get("mean_src_outs") is None:
+        src_ablation_cache = kwargs.pop("src_ablation_cache", None) or SRC_ABLATION_CACHE
+        kwargs["mean_src_outs"] = src_ablation_cache.src_outs(model, dataloader, ablation_type)
+    share_weights(model)
+
+    # contiguous shards, so each worker's outputs are a run of the serial batch order
+    shard_size, n_larger = divmod(len(batches), n_workers)
+    shard_starts = [i * shard_size + min(i, n_larger) for i in range(n_workers + 1)]
+    shards = [list(range(start, stop)) for start, stop in zip(shard_starts, shard_starts[1:])]
+    _WORKER_STATE.update(
+        model=model, batches=batches, seq_labels=getattr(dataloader, "seq_labels", None), kwargs=kwargs
+    )
+    try:
+        ctx = torch.multiprocessing.get_context("fork")
+        with ctx.Pool(len(shards), initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+            shard_outs = pool.map(_run_shard, shards)
+    finally:
+        _WORKER_STATE.clear()
+
+    circ_outs: CircuitOutputs = defaultdict(dict)
+    for outs in shard_outs:
+        for edge_count, batch_outs in outs.items():
+            circ_outs[edge_count].update(batch_outs)
+    return circ_outs
@@ -0,0 +1,178 @@
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Tuple
+from collections import OrderedDict
+from contextlib import contextmanager
+import re
+
+import torch
+
+from auto_circuit.types import BatchKey
+from auto_circuit.utils.patchable_model import PatchableModel
+
+from elk_experiments.profiler import PROFILER
+
+if TYPE_CHECKING:
+    from elk_experiments.auto_circuit.auto_circuit_utils import CircuitMasks
+
+_BLOCK_RE = re.compile(r"^blocks\.(\d+)\.")
+
+
+def same_tensor(a: torch.Tensor, b: torch.Tensor) -> bool:
+    """Whether `a` and `b` are equal (checking for views of the same memory first)."""
+    if a is b or (
+        a.data_ptr() == b.data_ptr() and a.shape == b.shape
+        and a.stride() == b.stride() and a.dtype == b.dtype
+    ):
+        return True
+    return a.shape == b.shape and torch.equal(a, b)
+
+
+def module_layer(module_name: str, n_layers: int) -> int:
+    """The block of a (dest) module, or `n_layers` for modules after the blocks."""
+    match = _BLOCK_RE.match(module_name)
+    return int(match.group(1)) if match is not None else n_layers
+
+
+class PrefixEntry(NamedTuple):
+    flat_mask: torch.Tensor # the mask the activations were computed with
+    patch_src_outs: torch.Tensor
+    resids: Dict[int, torch.Tensor] # layer -> residual stream input to the layer
+    curr_src_outs: torch.Tensor
+    output: torch.Tensor
+
+
+class LayerPrefixCache:
+    """
+    Reuses the forward pass below the first layer where a circuit's masks differ from
+    those of the last circuit run on the same batch.
+
+    For each batch key, the cache keeps the residual stream at every block boundary, the
+    src outputs (`curr_src_outs`) and the output of the last run, with the (flat) mask it
+    was run with. A new run finds the lowest layer containing a dest whose mask changed,
+    restores `curr_src_outs` (so dests above read the cached outputs of srcs below), and
+    resumes the `HookedTransformer` with `start_at_layer`. If no mask changed, the cached
+    output is returned. The patch src outs must be the same as those of the cached run.
+
+    Must be used inside `patch_mode` (the runs share its `curr_src_outs`). With `update`
+    set to `False` the cached runs are kept (e.g. to run many small ablations of one base
+    circuit, each resuming from the layer of its own ablated edges).
+    """
+
+    def __init__(self, model: PatchableModel, max_batches: Optional[int] = None, update: bool = True):
+        self.model = model
+        self.wrapped_model = model.wrapped_model
+        self.n_layers: int = self.wrapped_model.cfg.n_layers
+        self.max_batches = max_batches
+        self.update = update
+        self.entries: "OrderedDict[BatchKey, PrefixEntry]" = OrderedDict()
+        self._edge_layers: Dict[Tuple[str, ...], torch.Tensor] = {}
+        self._captured: Optional[Dict[int, torch.Tensor]] = None
+        self.n_layers_run = 0 # blocks run (out of n_layers per run), for measuring reuse
+        self.n_runs = 0
+
+        blocks = self.wrapped_model.blocks
+        self._hook_handles = [
+            block.register_forward_pre_hook(self._capture_hook(layer))
+            for layer, block in enumerate(blocks)
+        ]
+        self._hook_handles.append(blocks[-1].register_forward_hook(
+            lambda module, args, out: self._capture(self.n_layers, out)
+        ))
+
+    def _capture(self, layer: int, resid: torch.Tensor):
+        if self._captured is not None:
+            self._captured[layer] = resid
+
+    def _capture_hook(self, layer: int):
+        def hook(module, args):
+            self._capture(layer, args[0])
+        return hook
+
+    def remove_hooks(self):
+        for handle in self._hook_handles:
+            handle.remove()
+        self._hook_handles = []
+
+    def clear(self):
+        self.entries.clear()
+
+    @contextmanager
+    def frozen(self):
+        """Keep the cached runs (`update = False`) within the block, restoring `update` after."""
+        update = self.update
+        self.update = False
+        try:
+            yield self
+        finally:
+            self.update = update
+
+    def edge_layers(self, circuit_masks: "CircuitMasks") -> torch.Tensor:
+        """The layer of the dest of each flat edge."""
+        mod_names = tuple(dest.module_name for dest in circuit_masks.dests)
+        if mod_names not in self._edge_layers:
+            layers = torch.tensor([module_layer(name, self.n_layers) for name in mod_names])
+            sizes = torch.tensor(circuit_masks.sizes)
+            self._edge_layers[mod_names] = layers.repeat_interleave(sizes).to(circuit_masks.ranked_edges.scores.device)
+        return self._edge_layers[mod_names]
+
+    def start_layer(self, circuit_masks: "CircuitMasks", batch_key: BatchKey, flat_mask: torch.Tensor) -> int:
+        """
+        The layer to resume the forward pass from (0 for a full pass, `n_layers + 1`
+        when nothing changed).
+        """
+        entry = self.entries.get(batch_key)
+        patch_src_outs = circuit_masks.dests[0].patch_src_outs
+        if entry is None or entry.flat_mask.shape != flat_mask.shape:
+            return 0
+        if not same_tensor(entry.patch_src_outs, patch_src_outs):
+            return 0
+        n_edges = flat_mask.size(-1)
+        changed = (flat_mask != entry.flat_mask).reshape(-1, n_edges).any(dim=0)
+        edge_layers = self.edge_layers(circuit_masks)
+        no_change = torch.full_like(edge_layers, self.n_layers + 1)
+        return int(torch.where(changed, edge_layers, no_change).min().item())
+
+    def run(
+        self,
+        circuit_masks: "CircuitMasks",
+        batch_key: BatchKey,
+        batch_input: torch.Tensor,
+        flat_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        The (sliced) output of the model on `batch_input`, with the masks currently set
+        (which must be `flat_mask`).
+        """
+        start_layer = self.start_layer(circuit_masks, batch_key, flat_mask)
+        self.n_runs += 1
+        if start_layer > self.n_layers:
+            self.entries.move_to_end(batch_key)
+            return self.entries[batch_key].output
+        curr_src_outs = circuit_masks.dests[0].curr_src_outs
+        assert curr_src_outs is not None, "must be run in patch_mode"
+        self._captured = {}
+        try:
+            if start_layer == 0:
+                output = self.model(batch_input)[self.model.out_slice]
+            else:
+                entry = self.entries[batch_key]
+                curr_src_outs.copy_(entry.curr_src_outs)
+                output = self.model(entry.resids[start_layer], start_at_layer=start_layer)[self.model.out_slice]
+            captured = self._captured
+        finally:
+            self._captured = None
+        self.n_layers_run += self.n_layers - start_layer
+        PROFILER.count("prefix_layers_skipped", start_layer)
+        if self.update or batch_key not in self.entries:
+            resids = dict(self.entries[batch_key].resids) if start_layer > 0 else {}
+            resids.update(captured)
+            self.entries[batch_key] = PrefixEntry(
+                flat_mask=flat_mask.clone(),
+                patch_src_outs=circuit_masks.dests[0].patch_src_outs,
+                resids=resids,
+                curr_src_outs=curr_src_outs.clone(),
+                output=output,
+            )
+            self.entries.move_to_end(batch_key)
+            if self.max_batches is not None and len(self.entries) > self.max_batches:
+                self.entries.popitem(last=False)
+        return output
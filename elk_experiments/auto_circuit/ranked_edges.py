@@ -0,0 +1,110 @@
+from typing import List, Optional, Sequence, Union
+
+import torch
+
+from auto_circuit.types import PruneScores
+
+# use topk / kthvalue (instead of a full sort) for at most this many cutoffs
+MAX_PARTIAL_SORT_CUTOFFS = 4
+# use topk (instead of kthvalue) when the largest cutoff is at most this fraction of edges
+TOPK_MAX_FRAC = 1 / 16
+
+
+class RankedEdges:
+    """
+    Edge scores of a `PruneScores`, flattened (in `prune_scores` module order) and ranked
+    once, to answer threshold and edge count queries without re-sorting.
+
+    The full sort is only computed when needed: queries for a few cutoffs on unsorted
+    scores use `topk` / `kthvalue`, and edge counts use a single comparison. Once sorted,
+    thresholds are O(1) lookups and edge counts O(log E) binary searches.
+
+    Per instance scores (with a leading batch dim) are ranked per instance, and the
+    queries return one value per instance.
+    """
+
+    def __init__(self, prune_scores: PruneScores, use_abs: bool = True, per_inst: bool = False):
+        self.prune_scores = prune_scores
+        self.use_abs = use_abs
+        self.per_inst = per_inst
+        start_dim = 1 if per_inst else 0
+        scores = torch.cat([ps.flatten(start_dim) for ps in prune_scores.values()], dim=start_dim)
+        self.scores: torch.Tensor = scores.abs() if use_abs else scores # [E] or [B, E]
+        self._asc_scores: Optional[torch.Tensor] = None
+        self._asc_order: Optional[torch.Tensor] = None
+
+    @property
+    def n_edges(self) -> int:
+        return self.scores.size(-1)
+
+    @property
+    def is_sorted(self) -> bool:
+        return self._asc_scores is not None
+
+    def sort(self) -> "RankedEdges":
+        if not self.is_sorted:
+            self._asc_scores, self._asc_order = self.scores.sort(dim=-1, stable=True)
+        return self
+
+    @property
+    def desc_scores(self) -> torch.Tensor:
+        """The scores in descending order (as returned by `desc_prune_scores`)."""
+        return self.sort()._asc_scores.flip(-1)
+
+    @property
+    def order(self) -> torch.Tensor:
+        """Flat edge indices in descending score order."""
+        return self.sort()._asc_order.flip(-1)
+
+    def _no_edges_threshold(self) -> torch.Tensor:
+        shape = self.scores.shape[:-1]
+        return torch.full(shape, float("inf"), dtype=self.scores.dtype, device=self.scores.device)
+
+    def threshold(self, k: int) -> torch.Tensor:
+        """The minimum score of the top `k` edges (`inf` if `k` is 0)."""
+        return self.thresholds([k])[0]
+
+    def thresholds(self, ks: Sequence[int]) -> List[torch.Tensor]:
+        """The minimum score of the top `k` edges, for each `k` in `ks`."""
+        assert all(0 <= k <= self.n_edges for k in ks)
+        nonzero_ks = [k for k in ks if k > 0]
+        if not nonzero_ks:
+            return [self._no_edges_threshold() for _ in ks]
+        if not self.is_sorted and len(set(nonzero_ks)) <= MAX_PARTIAL_SORT_CUTOFFS:
+            max_k = max(nonzero_ks)
+            if max_k <= self.n_edges * TOPK_MAX_FRAC:
+                top_scores = self.scores.topk(max_k, dim=-1, sorted=True).values
+                kth_score = lambda k: top_scores[..., k - 1]
+            else:
+                kth_score = lambda k: self.scores.kthvalue(self.n_edges - k + 1, dim=-1).values
+        else:
+            asc_scores = self.sort()._asc_scores
+            kth_score = lambda k: asc_scores[..., self.n_edges - k]
+        return [kth_score(k) if k > 0 else self._no_edges_threshold() for k in ks]
+
+    def count(self, threshold: Union[float, torch.Tensor]) -> torch.Tensor:
+        """The number of edges with score >= `threshold` (per instance if `per_inst`)."""
+        threshold = torch.as_tensor(threshold, dtype=self.scores.dtype, device=self.scores.device)
+        if not self.is_sorted:
+            return (self.scores >= threshold.unsqueeze(-1)).sum(dim=-1)
+        query = threshold.expand(self.scores.shape[:-1]).unsqueeze(-1).contiguous()
+        n_below = torch.searchsorted(self._asc_scores, query, side="left").squeeze(-1)
+        return self.n_edges - n_below
+
+    def threshold_tensor(self, thresholds: Sequence[Union[float, torch.Tensor]]) -> torch.Tensor:
+        """Stack thresholds into one `[n_thresholds, (batch)]` tensor on the scores' device."""
+        return torch.stack([
+            torch.as_tensor(thr, dtype=self.scores.dtype, device=self.scores.device).expand(self.scores.shape[:-1])
+            for thr in thresholds
+        ])
+
+    def counts(self, thresholds: Sequence[Union[float, torch.Tensor]]) -> torch.Tensor:
+        """`count` for each threshold, in one device-side op (`[n_thresholds, (batch)]`)."""
+        if len(thresholds) > MAX_PARTIAL_SORT_CUTOFFS:
+            self.sort()
+        thresholds = self.threshold_tensor(thresholds)
+        if not self.is_sorted:
+            return (self.scores.unsqueeze(0) >= thresholds.unsqueeze(-1)).sum(dim=-1)
+        query = thresholds.movedim(0, -1).contiguous() # [(batch), n_thresholds]
+        n_below = torch.searchsorted(self._asc_scores, query, side="left")
+        return (self.n_edges - n_below).movedim(-1, 0)
@@ -4,12 +4,9 @@ from functools import partial
 import torch 
 import torch as t
 from auto_circuit.data import PromptPairBatch
+from auto_circuit.utils import tensor_ops
 from auto_circuit.utils.tensor_ops import indices_vals
-from auto_circuit.utils.tensor_ops import (
-    batch_answer_diffs, 
-    batch_answer_max_diffs, 
-    batch_answer_vals
-)
+from auto_circuit.utils.tensor_ops import batch_answer_vals
 
 
 class GradFunc(Enum):
@@ -25,6 +22,46 @@ class AnswerFunc(Enum):
     MSE = "mse"
 
 
+def is_vocab_mask(answers) -> bool:
+    """Whether `answers` is a boolean vocab mask (rather than answer token indices)."""
+    return isinstance(answers, t.Tensor) and answers.dtype == t.bool
+
+
+def _answer_maxs(vals: t.Tensor, answers) -> t.Tensor:
+    if isinstance(answers, t.Tensor):
+        return t.gather(vals, dim=-1, index=answers).max(dim=-1).values
+    return t.stack([t.gather(v, dim=-1, index=a).max() for v, a in zip(vals, answers)])
+
+
+def batch_answer_diffs(vals: t.Tensor, batch: PromptPairBatch) -> t.Tensor:
+    """
+    Same as `auto_circuit.utils.tensor_ops.batch_answer_diffs`, but also accepts 
+    `batch.wrong_answers` as a boolean vocab mask (see 
+    `auto_circuit_utils.wrong_answer_mask`).
+    """
+    if not is_vocab_mask(batch.wrong_answers):
+        return tensor_ops.batch_answer_diffs(vals, batch)
+    wrong_mask = batch.wrong_answers
+    # masked_fill rather than a multiply, as -inf (e.g. underflowed logprobs) * 0 is nan
+    wrong_avgs = vals.masked_fill(~wrong_mask, 0).sum(dim=-1) / wrong_mask.sum(dim=-1)
+    return batch_answer_vals(vals, batch) - wrong_avgs
+
+
+def batch_answer_max_diffs(vals: t.Tensor, batch: PromptPairBatch) -> t.Tensor:
+    """
+    Same as `auto_circuit.utils.tensor_ops.batch_answer_max_diffs`, but also accepts 
+    `batch.wrong_answers` as a boolean vocab mask.
+    """
+    if not is_vocab_mask(batch.wrong_answers):
+        return tensor_ops.batch_answer_max_diffs(vals, batch)
+    wrong_maxs = vals.masked_fill(~batch.wrong_answers, float("-inf")).max(dim=-1).values
+    return _answer_maxs(vals, batch.answers) - wrong_maxs
+
+
+def batch_avg_answer_diff(vals: t.Tensor, batch: PromptPairBatch) -> t.Tensor:
+    return batch_answer_diffs(vals, batch).mean()
+
+
 GRAD_FUNC_DICT = {
     GradFunc.LOGIT: lambda x: x,
     GradFunc.PROB: partial(t.softmax, dim=-1),
@@ -42,4 +79,4 @@ ANSWER_FUNC_DICT = {
 def get_score_func(grad_func: GradFunc, answer_func: AnswerFunc):
     grad_func = GRAD_FUNC_DICT[grad_func]
     answer_func = ANSWER_FUNC_DICT[answer_func]
-    return lambda vals, batch: answer_func(grad_func(vals), batch)
\ No newline at end of file
+    return lambda vals, batch: answer_func(grad_func(vals), batch)
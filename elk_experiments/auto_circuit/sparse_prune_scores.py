@@ -0,0 +1,72 @@
+from typing import Optional, Union
+
+import torch
+
+from elk_experiments.auto_circuit.ranked_edges import RankedEdges
+
+
+class SparsePruneScores:
+    """
+    Per instance prune scores of a batch, as shared (ranked) base scores and a sparse
+    list of (instance, flat edge id, value) overrides, e.g. a circuit with a few path
+    edges added or ablated per instance. Flat edge ids index the flattened base scores
+    (in `ranked_edges.prune_scores` module order, see `EdgeIndex`).
+
+    Unlike dense per instance scores (`[batch, ...]` per module), the base is stored (and
+    ranked) once for every batch, and the per instance masks are built with one scatter
+    of the overrides (see `SparseCircuitMasks`). `run_circuits` accepts a dict of these
+    (by batch key) in place of per instance prune scores.
+    """
+
+    def __init__(
+        self,
+        ranked_edges: RankedEdges,
+        batch_size: int,
+        inst_idxs: Optional[torch.Tensor] = None,
+        edge_ids: Optional[torch.Tensor] = None,
+        values: Optional[torch.Tensor] = None,
+    ):
+        assert not ranked_edges.per_inst
+        self.ranked_edges = ranked_edges
+        self.batch_size = batch_size
+        device = ranked_edges.scores.device
+        empty_idxs = torch.empty(0, dtype=torch.long, device=device)
+        self.inst_idxs = inst_idxs if inst_idxs is not None else empty_idxs
+        self.edge_ids = edge_ids if edge_ids is not None else empty_idxs
+        self.values = values if values is not None else torch.empty(0, dtype=ranked_edges.scores.dtype, device=device)
+
+    @property
+    def n_edges(self) -> int:
+        return self.ranked_edges.n_edges
+
+    def with_overrides(
+        self,
+        inst_idxs: torch.Tensor,
+        edge_ids: torch.Tensor,
+        values: Union[float, torch.Tensor],
+    ) -> "SparsePruneScores":
+        """
+        New scores with the (raw, as in prune scores) `values` of (`inst_idxs`,
+        `edge_ids`) overridden (replacing earlier overrides of the same entries).
+        """
+        device = self.ranked_edges.scores.device
+        inst_idxs, edge_ids = inst_idxs.to(device), edge_ids.to(device)
+        values = torch.as_tensor(values, dtype=self.values.dtype, device=device).expand(edge_ids.shape)
+        keep = ~torch.isin(self.inst_idxs * self.n_edges + self.edge_ids, inst_idxs * self.n_edges + edge_ids)
+        return SparsePruneScores(
+            self.ranked_edges,
+            self.batch_size,
+            torch.cat([self.inst_idxs[keep], inst_idxs]),
+            torch.cat([self.edge_ids[keep], edge_ids]),
+            torch.cat([self.values[keep], values]),
+        )
+
+    def override_scores(self) -> torch.Tensor:
+        """The override values as ranked (absolute values if `use_abs`)."""
+        return self.values.abs() if self.ranked_edges.use_abs else self.values
+
+    def flat_scores(self) -> torch.Tensor:
+        """The dense `[batch, n_edges]` (ranked) scores."""
+        scores = self.ranked_edges.scores.unsqueeze(0).repeat(self.batch_size, 1)
+        scores[self.inst_idxs, self.edge_ids] = self.override_scores()
+        return scores
@@ -0,0 +1,157 @@
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import weakref
+
+import torch
+
+from auto_circuit.data import PromptDataLoader
+from auto_circuit.types import AblationType, SrcNode
+from auto_circuit.utils.patchable_model import PatchableModel
+
+from elk_experiments.artifact_store import ArtifactStore
+from elk_experiments.utils import model_fingerprint
+from elk_experiments.profiler import PROFILER
+
+SrcAblationKey = Tuple[str, str, str] # model fingerprint, dataloader fingerprint, ablation type
+
+_LOADER_FINGERPRINTS: "weakref.WeakKeyDictionary[PromptDataLoader, str]" = weakref.WeakKeyDictionary()
+
+
+def loader_fingerprint(dataloader: PromptDataLoader) -> str:
+    """
+    Digest of the batch keys of `dataloader`, in order (memoized per dataloader, so
+    assumes the batches do not change).
+    """
+    if dataloader not in _LOADER_FINGERPRINTS:
+        digest = hashlib.blake2b(digest_size=16)
+        for batch in dataloader:
+            digest.update(f"{batch.key},".encode())
+        _LOADER_FINGERPRINTS[dataloader] = digest.hexdigest()
+    return _LOADER_FINGERPRINTS[dataloader]
+
+
+def batch_mean_src_outs(src_outs: Dict[int, torch.Tensor], batch_input: torch.Tensor) -> torch.Tensor:
+    """The mean patch src outs (per sequence length) for `batch_input`, expanded to its batch size."""
+    src_out = src_outs[batch_input.size(1)]
+    return src_out.expand(src_out.size(0), batch_input.size(0), *src_out.shape[2:])
+
+
+class StreamingSrcMean:
+    """
+    Running mean of the outputs of every src module of `model` (per sequence length),
+    updated batch by batch with the batch size weighted (Welford) update
+    `mean += (batch_sum - n_batch * mean) / (n + n_batch)`, accumulated in fp32.
+    """
+
+    def __init__(self, model: PatchableModel):
+        self.model = model
+        self.src_modules: Dict[torch.nn.Module, List[SrcNode]] = defaultdict(list)
+        for src in model.srcs:
+            self.src_modules[src.module(model)].append(src)
+        self.means: Dict[int, Dict[torch.nn.Module, torch.Tensor]] = defaultdict(dict)
+        self.counts: Dict[int, int] = defaultdict(int)
+        self.dtype: Optional[torch.dtype] = None
+
+    def _hook(self, module: torch.nn.Module, input, out: torch.Tensor):
+        seq_len, n, n_batch = out.size(1), self.counts[out.size(1)], out.size(0)
+        batch_sum = out.float().sum(dim=0, keepdim=True)
+        means = self.means[seq_len]
+        if module not in means:
+            means[module] = batch_sum / n_batch
+        else:
+            means[module] += (batch_sum - n_batch * means[module]) / (n + n_batch)
+        self.dtype = out.dtype
+
+    def update(self, inputs: torch.Tensor):
+        handles = [module.register_forward_hook(self._hook) for module in self.src_modules]
+        try:
+            with torch.inference_mode():
+                self.model(inputs)
+        finally:
+            for handle in handles:
+                handle.remove()
+        self.counts[inputs.size(1)] += inputs.size(0)
+
+    def src_outs(self) -> Dict[int, torch.Tensor]:
+        """The mean patch src outs (`[Srcs, 1, seq, ...]`) for each sequence length."""
+        src_outs: Dict[int, torch.Tensor] = {}
+        for seq_len, means in self.means.items():
+            outs: Dict[SrcNode, torch.Tensor] = {}
+            for module, src_nodes in self.src_modules.items():
+                mean = means[module].to(self.dtype)
+                for src in src_nodes:
+                    outs[src] = mean if src.head_dim is None else mean.select(src.head_dim, src.head_idx)
+            src_outs[seq_len] = torch.stack([outs[src] for src in sorted(outs, key=lambda s: s.src_idx)])
+        return src_outs
+
+
+class SrcAblationCache:
+    """
+    Dataset-level patch src outs (for `AblationType`s with `mean_over_dataset`), keyed by
+    (model fingerprint, dataloader fingerprint, ablation type), so repeated `run_circuits`
+    calls on the same data (e.g. one per edge in `minimality_test`) skip recomputing the
+    dataset mean. Each mean is computed in a single streaming pass (`StreamingSrcMean`),
+    with one mean per sequence length (for length bucketed dataloaders), and is
+    optionally persisted to an `ArtifactStore`.
+
+    Unlike `src_ablations`, the means have a batch dim of 1 (see `batch_src_outs`), and
+    uneven (e.g. last) batches are weighted by their size.
+    """
+
+    def __init__(self, artifact_store: Optional[ArtifactStore] = None, keep_in_memory: bool = True):
+        self.artifact_store = artifact_store
+        self.keep_in_memory = keep_in_memory
+        self._src_outs: Dict[SrcAblationKey, Dict[int, torch.Tensor]] = {}
+
+    def _key(self, model: PatchableModel, dataloader: PromptDataLoader, ablation_type: AblationType) -> SrcAblationKey:
+        return (model_fingerprint(model), loader_fingerprint(dataloader), ablation_type.name)
+
+    def _config(self, key: SrcAblationKey) -> Dict[str, str]:
+        model, dataloader, ablation_type = key
+        return {"artifact": "src_ablations", "model": model, "dataloader": dataloader, "ablation_type": ablation_type}
+
+    def src_outs(
+        self, model: PatchableModel, dataloader: PromptDataLoader, ablation_type: AblationType
+    ) -> Dict[int, torch.Tensor]:
+        """The mean patch src outs (`[Srcs, 1, seq, ...]`) for each sequence length."""
+        assert ablation_type.mean_over_dataset
+        key = self._key(model, dataloader, ablation_type)
+        if key in self._src_outs:
+            return self._src_outs[key]
+        device = next(model.parameters()).device
+        src_outs = None
+        if self.artifact_store is not None:
+            src_outs = self.artifact_store.get(self._config(key), device=str(device), lazy=False)
+        if src_outs is None:
+            stream = StreamingSrcMean(model)
+            with PROFILER.span("src_ablation_mean", ablation_type=ablation_type.name):
+                for batch in dataloader:
+                    if ablation_type.clean_dataset:
+                        stream.update(batch.clean)
+                    if ablation_type.corrupt_dataset:
+                        stream.update(batch.corrupt)
+                src_outs = stream.src_outs()
+            if self.artifact_store is not None:
+                self.artifact_store.put(self._config(key), src_outs)
+        if self.keep_in_memory:
+            self._src_outs[key] = src_outs
+        return src_outs
+
+    def batch_src_outs(
+        self,
+        model: PatchableModel,
+        dataloader: PromptDataLoader,
+        ablation_type: AblationType,
+        batch_input: torch.Tensor,
+    ) -> torch.Tensor:
+        """The mean patch src outs for `batch_input`, expanded to its batch size."""
+        return batch_mean_src_outs(self.src_outs(model, dataloader, ablation_type), batch_input)
+
+    def clear(self):
+        """Drop the in-memory src outs (persisted src outs are kept)."""
+        self._src_outs.clear()
+
+
+# shared by every run_circuits call unless a cache is passed explicitly
+SRC_ABLATION_CACHE = SrcAblationCache()
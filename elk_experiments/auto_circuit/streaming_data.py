@@ -0,0 +1,199 @@
+from pathlib import Path
+from typing import Iterator, Optional, Sequence, Tuple, Union
+import queue
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from auto_circuit.data import PromptDataLoader, PromptPair, PromptPairBatch
+
+from elk_experiments.auto_circuit.auto_circuit_utils import batch_key, wrong_answer_mask
+
+
+def write_prompt_tokens(prompts: Sequence[torch.Tensor], path: Union[str, Path]) -> Path:
+    """
+    Write prompts to an int32 `.npy` token file (one row per prompt), one prompt at a time,
+    so the prompts never have to be stacked in memory.
+
+    Args:
+        prompts: The prompt token tensors (all of the same length).
+        path: The path of the `.npy` file.
+
+    Returns:
+        The path of the written file.
+    """
+    path = Path(path)
+    seq_len = len(prompts[0])
+    tokens = np.lib.format.open_memmap(path, mode="w+", dtype=np.int32, shape=(len(prompts), seq_len))
+    for i, prompt in enumerate(prompts):
+        tokens[i] = np.asarray(prompt, dtype=np.int32)
+    tokens.flush()
+    del tokens
+    return path
+
+
+def load_prompt_tokens(path: Union[str, Path], seq_len: Optional[int] = None) -> np.ndarray:
+    """
+    Memory-map a token file: either a `.npy` file, or a raw int32 file of
+    `[n_prompts, seq_len]` tokens (in which case `seq_len` is required).
+    """
+    path = Path(path)
+    if path.suffix == ".npy":
+        tokens = np.load(path, mmap_mode="r")
+    else:
+        if seq_len is None:
+            raise ValueError("seq_len must be provided for raw int32 token files")
+        tokens = np.memmap(path, dtype=np.int32, mode="r").reshape(-1, seq_len)
+    assert tokens.ndim == 2
+    return tokens
+
+
+class MemmapPromptDataset(Dataset):
+    """
+    Prompt dataset backed by a memory-mapped token file, with all-zero corrupt prompts
+    and effect token answers (as in `make_prompt_dataset`). Prompts are only read from
+    disk when a batch is loaded.
+    """
+
+    def __init__(
+        self,
+        tokens_path: Union[str, Path],
+        effect_tokens: list[int],
+        vocab_size: int,
+        seq_len: Optional[int] = None,
+        labels_path: Optional[Union[str, Path]] = None,
+    ):
+        self.tokens = load_prompt_tokens(tokens_path, seq_len=seq_len)
+        self.seq_len = self.tokens.shape[1]
+        self.labels = np.load(labels_path, mmap_mode="r") if labels_path is not None else None
+        if self.labels is not None:
+            assert len(self.labels) == len(self.tokens)
+        # shared across prompts (expanded, not copied, when batched)
+        self.corrupt_prompt = torch.zeros(self.seq_len, dtype=int)
+        self.answer = torch.tensor(effect_tokens, dtype=int)
+        self.wrong_answer_mask = wrong_answer_mask(effect_tokens, vocab_size)
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def __getitem__(self, idx: int) -> PromptPair:
+        clean = torch.from_numpy(np.asarray(self.tokens[idx], dtype=np.int64))
+        return PromptPair(clean, self.corrupt_prompt, self.answer, self.wrong_answer_mask)
+
+    def load_batch(self, start: int, stop: int) -> Union[PromptPairBatch, Tuple[PromptPairBatch, torch.Tensor]]:
+        """Read prompts `[start, stop)` from disk and collate them into a batch."""
+        clean = torch.from_numpy(np.asarray(self.tokens[start:stop], dtype=np.int64))
+        batch_size = clean.size(0)
+        corrupt = self.corrupt_prompt.expand(batch_size, -1)
+        answers = self.answer.expand(batch_size, -1)
+        wrong_answers = self.wrong_answer_mask.expand(batch_size, -1)
+        diverge_idxs = (~(clean == corrupt)).int().argmax(dim=1)
+        batch_dvrg_idx: int = int(diverge_idxs.min().item())
+        batch = PromptPairBatch(
+            batch_key(clean, corrupt), batch_dvrg_idx, clean, corrupt, answers, wrong_answers
+        )
+        if self.labels is None:
+            return batch
+        labels = torch.from_numpy(np.asarray(self.labels[start:stop])).to(torch.int)
+        return batch, labels
+
+
+_END = object()
+
+
+class StreamingPromptDataLoader(PromptDataLoader):
+    """
+    `PromptDataLoader` over a `MemmapPromptDataset`, where a background thread reads and
+    collates the next `prefetch` batches while the current batch is being used. Batches
+    are in dataset order (no shuffling), and have labels if the dataset has labels. As
+    with `PromptDataLoader`, every batch has `batch_size` prompts (a partial last batch
+    is dropped).
+    """
+
+    def __init__(self, dataset: MemmapPromptDataset, batch_size: int, prefetch: int = 2, **kwargs):
+        assert prefetch > 0
+        self.prefetch = prefetch
+        super().__init__(
+            dataset,
+            seq_len=dataset.seq_len,
+            diverge_idx=0,
+            batch_size=batch_size,
+            shuffle=False,
+            **kwargs
+        )
+
+    def __iter__(self) -> Iterator:
+        batch_queue: queue.Queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def load_batches():
+            try:
+                # full batches only (as with the drop_last of PromptDataLoader and its len)
+                n_prompts = len(self.dataset) // self.batch_size * self.batch_size
+                for start in range(0, n_prompts, self.batch_size):
+                    if not put(self.dataset.load_batch(start, start + self.batch_size)):
+                        return
+            except BaseException as e: # re-raised in the consumer
+                put(e)
+            put(_END)
+
+        loader_thread = threading.Thread(target=load_batches, daemon=True)
+        loader_thread.start()
+        try:
+            while True:
+                item = batch_queue.get()
+                if item is _END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            loader_thread.join()
+
+
+def make_memmap_prompt_dataloader(
+    tokens_path: Union[str, Path],
+    effect_tokens: list[int],
+    model,
+    batch_size: int,
+    seq_len: Optional[int] = None,
+    labels_path: Optional[Union[str, Path]] = None,
+    prefetch: int = 2,
+) -> StreamingPromptDataLoader:
+    """
+    Streaming analogue of `make_prompt_data_loader` (or, with `labels_path`, of
+    `make_mixed_prompt_dataloader`) for token files too large to stack in memory. The
+    returned loader can be passed directly to the detectors and `run_circuits`.
+
+    Args:
+        tokens_path: `.npy` or raw int32 token file of `[n_prompts, seq_len]` tokens.
+        effect_tokens: The answer tokens.
+        model: The model (used for the vocab size).
+        batch_size: The batch size.
+        seq_len: The prompt length (required for raw int32 token files).
+        labels_path: Optional `.npy` file of anomaly labels (one per prompt).
+        prefetch: The number of batches to load ahead of the current batch.
+
+    Returns:
+        The streaming dataloader.
+    """
+    dataset = MemmapPromptDataset(
+        tokens_path,
+        effect_tokens,
+        model.tokenizer.vocab_size,
+        seq_len=seq_len,
+        labels_path=labels_path
+    )
+    return StreamingPromptDataLoader(dataset, batch_size=batch_size, prefetch=prefetch)
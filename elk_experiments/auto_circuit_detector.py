@@ -20,15 +20,16 @@ from auto_circuit.data import PromptDataset, PromptDataLoader, PromptPair, Promp
 from auto_circuit.types import AblationType, PatchType, PruneScores, CircuitOutputs
 from auto_circuit.utils.ablation_activations import src_ablations
 from auto_circuit.utils.graph_utils import patch_mode, patchable_model, train_mask_mode, set_all_masks
-from auto_circuit.utils.tensor_ops import desc_prune_scores, prune_scores_threshold, batch_avg_answer_diff
-from auto_circuit.utils.patch_wrapper import PatchWrapperImpl
-from auto_circuit.utils.misc import module_by_name
 
 from elk_experiments.utils import set_model
 from elk_experiments.auto_circuit.auto_circuit_utils import (
     make_prompt_data_loader,
     make_mixed_prompt_dataloader,
+    CircuitMasks,
 )
+from elk_experiments.auto_circuit.score_funcs import batch_avg_answer_diff
+from elk_experiments.auto_circuit.ranked_edges import RankedEdges
+from elk_experiments.auto_circuit.prefix_cache import LayerPrefixCache
 
 
 
@@ -87,15 +88,23 @@ class AutoCircuitPruningDetector(AutoCircuitDetector):
         threshold: float | None = None,
         device: str = "cpu",
         layer_aggregation: str = "mean",
+        reuse_prefix: bool = False,
         **kwargs
         #TODO: option to use untrusted data
     ): 
+        # reuse_prefix: compute the normal output in patch mode (with zero masks), and 
+        # resume the patched pass from the first layer with a nonzero mask
         assert (k is not None) ^ (threshold is not None), "Either k or threshold must be specified"
+        self.reuse_prefix = reuse_prefix
+        self._prefix_cache: LayerPrefixCache | None = None
         self.prune_scores_func = prune_scores_func
         self.scores_func = scores_func
         self.patch_type = patch_type    
         self.k = k
         self.threshold = threshold
+        self._ranked_edges: RankedEdges | None = None
+        self._circuit_masks: CircuitMasks | None = None
+        self._flat_mask: torch.Tensor | None = None
         super().__init__(
             effect_tokens=effect_tokens,
             device=device, 
@@ -162,36 +171,46 @@ class AutoCircuitPruningDetector(AutoCircuitDetector):
             "Layerwise scores don't exist for finetuning detector"
         )
 
+    def circuit_masks(self) -> Tuple[CircuitMasks, torch.Tensor]:
+        # rank the pruning scores and build the circuit mask once (and again only if
+        # the scores are replaced)
+        if self._ranked_edges is None or self._ranked_edges.prune_scores is not self.pruning_scores:
+            self._ranked_edges = RankedEdges(self.pruning_scores) #TODO: look back at the other method they had
+            threshold = self._ranked_edges.threshold(self.k) if self.threshold is None else self.threshold
+            # EDGE_PATCH patches out edges in circuit, TREE_PATCH edges not in circuit
+            self._circuit_masks = CircuitMasks(self.model, self._ranked_edges, self.patch_type)
+            self._flat_mask = self._circuit_masks.flat_masks([threshold])[0]
+        return self._circuit_masks, self._flat_mask
+
     def scores(self, batch):
         # for now, assume we're reusing the patch src outs, mean over tokens
-        input = utils.inputs_from_batch(batch)
-        input = input.clean
+        inputs = utils.inputs_from_batch(batch)
+        input = inputs.clean
         
-        desc_ps = desc_prune_scores(self.pruning_scores) #TODO: look back at the other method they had
-        threshold = prune_scores_threshold(desc_ps, self.k) if self.threshold is None else self.threshold
-
-        # run patched model 
-        with patch_mode(self.model, self.patch_src_outs):
-            # set patch masks according to threshold
-            patch_edge_count = 0 
-            for mod_name, patch_mask in self.pruning_scores.items():
-                dest = module_by_name(self.model, mod_name)
-                assert isinstance(dest, PatchWrapperImpl)
-                assert dest.is_dest and dest.patch_mask is not None 
-                if self.patch_type == PatchType.EDGE_PATCH: # patch out edges in circuit
-                    dest.patch_mask.data = (patch_mask.abs() >= threshold).float()
-                    patch_edge_count += dest.patch_mask.int().sum().item()
-                else:
-                    assert self.patch_type == PatchType.TREE_PATCH # patch out edges not in circuit
-                    dest.patch_mask.data = (patch_mask.abs() < threshold).float()
-                    patch_edge_count += (1 - dest.patch_mask.int()).sum().item()
-            # run model
+        circuit_masks, flat_mask = self.circuit_masks()
+
+        if self.reuse_prefix:
+            if self._prefix_cache is None:
+                self._prefix_cache = LayerPrefixCache(self.model, max_batches=1)
+            batch_key = inputs.key
+            with patch_mode(self.model, self.patch_src_outs), torch.inference_mode():
+                zero_mask = torch.zeros_like(flat_mask)
+                circuit_masks.set_masks(zero_mask)
+                normal_logits = self._prefix_cache.run(circuit_masks, batch_key, input, zero_mask)
+                circuit_masks.set_masks(flat_mask)
+                patched_logits = self._prefix_cache.run(circuit_masks, batch_key, input, flat_mask)
+        else:
+            # run patched model 
+            with patch_mode(self.model, self.patch_src_outs):
+                # set patch masks according to threshold
+                circuit_masks.set_masks(flat_mask)
+                # run model
+                with torch.inference_mode():
+                    patched_logits = self.model(input)[self.model.out_slice]
+
+            # normal output 
             with torch.inference_mode():
-                patched_logits = self.model(input)[self.model.out_slice]
-
-        # normal output 
-        with torch.inference_mode():
-            normal_logits = self.model(input)[self.model.out_slice]
+                normal_logits = self.model(input)[self.model.out_slice]
         
         # compute scores
         scores = self.scores_func(patched_logits, normal_logits)
@@ -347,7 +366,7 @@ class AutoCircuitGradScoresDetector(AutoCircuitDetector, StatisticalDetector):
         
         with patch_mode(self.model, self.patch_outs, batch_size=inputs.clean.shape[0]):
             logits = self.model(inputs.clean)
-            loss = -self.metric(logits, inputs=inputs)
+            loss = -self.metric(logits, inputs)
             loss.backward()
         prune_scores = {
             dest_wrapper.module_name: dest_wrapper.patch_mask_batch.grad.detach().clone()
@@ -15,7 +15,9 @@ from auto_circuit.utils.graph_utils import (
     set_mask_batch_size
 )
 from auto_circuit.utils.patchable_model import PatchableModel
-from auto_circuit.utils.tensor_ops import batch_avg_answer_diff, batch_avg_answer_val
+from auto_circuit.utils.tensor_ops import batch_avg_answer_val
+
+from elk_experiments.auto_circuit.score_funcs import batch_avg_answer_diff
 
 
 def mask_gradient_instance_prune_scores(
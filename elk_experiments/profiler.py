@@ -0,0 +1,205 @@
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Union
+import json
+import os
+import resource
+import threading
+import time
+
+import torch
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes() -> int:
+    """The current resident set size of the process (0 if unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def peak_rss_bytes() -> int:
+    """The peak resident set size of the process so far (a process wide high-water mark)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # KiB on linux
+
+
+def tensor_bytes() -> int:
+    """The (CUDA) tensor memory currently allocated (0 on CPU)."""
+    return torch.cuda.memory_allocated() if torch.cuda.is_available() else 0
+
+
+def peak_tensor_bytes() -> int:
+    """The peak CUDA tensor memory allocated since the last reset (0 on CPU)."""
+    return torch.cuda.max_memory_allocated() if torch.cuda.is_available() else 0
+
+
+class Profiler:
+    """
+    Opt-in spans, counters and memory stats for a pipeline run.
+
+    `span(name, **args)` records the wall time of a block as a Chrome trace complete
+    event (spans nest by time, per thread), with the RSS at its end and its change over
+    the block (`rss_delta_mb`, sampled at the start and end, so memory freed within the
+    block is not counted), and the CUDA tensor memory at its end. `peak_tensor_mb` is
+    CUDA only (0 on CPU), and is the peak since the start of the outermost open span (the
+    CUDA peak stats are only reset there), so nested spans report their parent's peak
+    so far. The process wide peak RSS is `process_peak_rss_mb` in the summary.
+
+    `count(name)` increments a counter (e.g. forward and backward passes, see
+    `instrument_model`), recorded as Chrome trace counter events and attributed to every
+    open span. When disabled (the default for the shared `PROFILER`),
+    `span` returns a shared null context and `count` returns immediately.
+
+    Write the results with `write_chrome_trace` (open in chrome://tracing or Perfetto) and
+    `write_summary` (a table of per span totals).
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.events: List[Dict[str, Any]] = []
+        self.counters: Dict[str, int] = defaultdict(int)
+        self._open_spans: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+        self._start_ns = time.perf_counter_ns()
+        self._null_span = nullcontext()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.events.clear()
+        self.counters.clear()
+        self._open_spans.clear()
+        self._start_ns = time.perf_counter_ns()
+
+    def _ts_us(self, ns: int) -> float:
+        return (ns - self._start_ns) / 1000
+
+    def span(self, name: str, **args):
+        """Context manager recording the block as a span named `name` (with `args`)."""
+        if not self.enabled:
+            return self._null_span
+        return self._span(name, args)
+
+    @contextmanager
+    def _span(self, name: str, args: Dict[str, Any]) -> Iterator[None]:
+        open_spans = self._open_spans[threading.get_ident()]
+        if not open_spans and torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        span = {"counts": defaultdict(int)}
+        open_spans.append(span)
+        start_rss = rss_bytes()
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end_ns = time.perf_counter_ns()
+            end_rss = rss_bytes()
+            open_spans.pop()
+            self.events.append({
+                "name": name,
+                "ph": "X",
+                "ts": self._ts_us(start_ns),
+                "dur": (end_ns - start_ns) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {
+                    **{k: v if isinstance(v, (int, float, str, bool)) else str(v) for k, v in args.items()},
+                    **span["counts"],
+                    "rss_mb": end_rss / 2**20,
+                    "rss_delta_mb": (end_rss - start_rss) / 2**20,
+                    "tensor_mb": tensor_bytes() / 2**20,
+                    "peak_tensor_mb": peak_tensor_bytes() / 2**20,
+                },
+            })
+
+    def count(self, name: str, n: int = 1):
+        """Increment the counter `name` (and its count in every open span)."""
+        if not self.enabled:
+            return
+        self.counters[name] += n
+        for span in self._open_spans[threading.get_ident()]:
+            span["counts"][name] += n
+        self.events.append({
+            "name": name,
+            "ph": "C",
+            "ts": self._ts_us(time.perf_counter_ns()),
+            "pid": os.getpid(),
+            "args": {name: self.counters[name]},
+        })
+
+    def instrument_model(self, model: torch.nn.Module) -> List[torch.utils.hooks.RemovableHandle]:
+        """Count the forward (and backward) passes of `model` as `forward` (`backward`)."""
+        def hook(module, args, output):
+            self.count("forward")
+            if self.enabled and isinstance(output, torch.Tensor) and output.requires_grad:
+                output.register_hook(lambda grad: self.count("backward"))
+        return [model.register_forward_hook(hook)]
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Per span name: count, total / mean / max time, max RSS (change), peak CUDA memory and counts."""
+        rows: Dict[str, Dict[str, Any]] = {}
+        for event in self.events:
+            if event["ph"] != "X":
+                continue
+            row = rows.setdefault(event["name"], {
+                "span": event["name"], "count": 0, "total_s": 0.0, "max_ms": 0.0,
+                "max_rss_mb": 0.0, "max_rss_delta_mb": 0.0, "peak_tensor_mb": 0.0, "forward": 0, "backward": 0,
+            })
+            row["count"] += 1
+            row["total_s"] += event["dur"] / 1e6
+            row["max_ms"] = max(row["max_ms"], event["dur"] / 1e3)
+            row["max_rss_mb"] = max(row["max_rss_mb"], event["args"]["rss_mb"])
+            row["max_rss_delta_mb"] = max(row["max_rss_delta_mb"], event["args"]["rss_delta_mb"])
+            row["peak_tensor_mb"] = max(row["peak_tensor_mb"], event["args"]["peak_tensor_mb"])
+            for counter in ["forward", "backward"]:
+                row[counter] += event["args"].get(counter, 0)
+        for row in rows.values():
+            row["mean_ms"] = 1e3 * row["total_s"] / row["count"]
+        return sorted(rows.values(), key=lambda row: row["total_s"], reverse=True)
+
+    def summary_table(self) -> str:
+        columns = [
+            "span", "count", "total_s", "mean_ms", "max_ms", "forward", "backward",
+            "max_rss_mb", "max_rss_delta_mb", "peak_tensor_mb",
+        ]
+        rows = [[
+            f"{row[c]:.3f}" if isinstance(row[c], float) else str(row[c]) for c in columns
+        ] for row in self.summary()]
+        widths = [max([len(c)] + [len(r[i]) for r in rows]) for i, c in enumerate(columns)]
+        lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths))]
+        lines += ["  ".join(v.ljust(w) for v, w in zip(r, widths)) for r in rows]
+        lines += [f"{name}: {n}" for name, n in self.counters.items()]
+        lines.append(f"process_peak_rss_mb: {peak_rss_bytes() / 2**20:.3f}")
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path: Union[str, Path]):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def write_summary(self, path: Union[str, Path]):
+        with open(path, "w") as f:
+            f.write(self.summary_table() + "\n")
+
+
+# shared by the instrumented pipeline (disabled unless enabled by the caller)
+PROFILER = Profiler()
+
+
+def profiled(name: Optional[str] = None):
+    """Decorator recording each call as a `PROFILER` span (named after the function)."""
+    def decorator(fn):
+        span_name = name or fn.__name__
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with PROFILER.span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,9 +1,11 @@
 import os
 import json
+import hashlib
+import weakref
 from pathlib import Path
 from matplotlib import pyplot as plt
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, Tuple
 
 import torch
 
@@ -125,6 +127,69 @@ def load_json(folder_name: str, filename: str):
 
 
 
+def tensor_digest(*tensors: torch.Tensor, digest_size: int = 8) -> str:
+    """
+    Digest of the raw bytes (and shapes and dtypes) of `tensors`. Unlike `hash`, the 
+    digest is deterministic across processes, so it can key results persisted to disk.
+
+    Args:
+        tensors: The tensors to digest.
+        digest_size: The size of the digest in bytes.
+
+    Returns:
+        The hex digest.
+    """
+    digest = hashlib.blake2b(digest_size=digest_size)
+    for tensor in tensors:
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(f"{tuple(tensor.shape)}{tensor.dtype}".encode())
+        digest.update(tensor.reshape(-1).view(torch.uint8).numpy())
+    return digest.hexdigest()
+
+
+_MODEL_FINGERPRINTS: "weakref.WeakKeyDictionary[torch.nn.Module, Tuple[Tuple, str]]" = weakref.WeakKeyDictionary()
+
+def _weights_version(model: torch.nn.Module) -> Tuple:
+    """
+    The storage and in-place version counter of each parameter and buffer of `model` 
+    (excluding patch masks), which change whenever the weights are updated or replaced.
+    """
+    versions = []
+    for name, tensor in model.state_dict(keep_vars=True).items():
+        if "patch_mask" in name:
+            continue
+        try:
+            version = tensor._version
+        except RuntimeError: # inference tensors have no version counter
+            version = None
+        versions.append((name, tensor.data_ptr(), version))
+    return tuple(versions)
+
+def model_fingerprint(model: torch.nn.Module) -> str:
+    """
+    Digest of the names and values of the parameters and buffers of `model` (excluding 
+    patch masks, which change between circuits). Memoized per module, and recomputed 
+    when any weight is updated in place (e.g. by an optimizer step or `load_state_dict`) 
+    or replaced.
+
+    Args:
+        model: The model to fingerprint.
+
+    Returns:
+        The hex digest.
+    """
+    version = _weights_version(model)
+    if model not in _MODEL_FINGERPRINTS or _MODEL_FINGERPRINTS[model][0] != version:
+        digest = hashlib.blake2b(digest_size=16)
+        for name, tensor in model.state_dict().items():
+            if "patch_mask" in name:
+                continue
+            digest.update(name.encode())
+            digest.update(tensor_digest(tensor, digest_size=16).encode())
+        _MODEL_FINGERPRINTS[model] = (version, digest.hexdigest())
+    return _MODEL_FINGERPRINTS[model][1]
+
+
 def prod(x):
     cum_prod = 1 
     for i in x:
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Per-threshold patch mask setup overhead in run_circuits: the per-module loop (with
+# module_by_name lookups and an .item() edge count per module) vs CircuitMasks (one
+# fused comparison on the flat scores, with edge counts for all thresholds in one sync).
+# Only mask setup is timed (no forward passes).
+#
+# usage: python scripts/benchmark_mask_setup.py task="Indirect Object Identification Token Circuit" n_thresholds=100
+
+import sys
+import time
+from dataclasses import dataclass
+
+import torch
+from omegaconf import OmegaConf
+
+from auto_circuit.types import PatchType, PatchWrapper
+from auto_circuit.utils.misc import module_by_name
+
+from elk_experiments.auto_circuit.auto_circuit_utils import CircuitMasks
+from elk_experiments.auto_circuit.ranked_edges import RankedEdges
+from elk_experiments.auto_circuit.tasks import TASK_DICT
+
+
+@dataclass
+class Config:
+    task: str = "Docstring Component Circuit"
+    n_thresholds: int = 100
+    n_repeats: int = 3
+    use_abs: bool = True
+
+
+def sync(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def per_module_mask_setup(model, prune_scores, thresholds, use_abs: bool) -> list[int]:
+    # the mask setup run_circuits used before CircuitMasks
+    edge_counts = []
+    for threshold in thresholds:
+        patch_edge_count = 0
+        for mod_name, patch_mask in prune_scores.items():
+            dest = module_by_name(model, mod_name)
+            assert isinstance(dest, PatchWrapper)
+            assert dest.is_dest and dest.patch_mask is not None
+            dest.patch_mask.data = ((patch_mask.abs() if use_abs else patch_mask) < threshold).float()
+            patch_edge_count += (1 - dest.patch_mask.int()).sum().item()
+        edge_counts.append(patch_edge_count)
+    return edge_counts
+
+
+def fused_mask_setup(model, prune_scores, thresholds, use_abs: bool) -> list[int]:
+    circuit_masks = CircuitMasks(model, RankedEdges(prune_scores, use_abs=use_abs), PatchType.TREE_PATCH)
+    edge_counts = circuit_masks.edge_counts(thresholds)
+    for threshold in thresholds:
+        circuit_masks.set_masks(circuit_masks.flat_masks([threshold])[0])
+    return edge_counts
+
+
+def time_mask_setup(setup_fn, model, prune_scores, thresholds, conf: Config, device) -> tuple[float, list[int]]:
+    times = []
+    for _ in range(conf.n_repeats):
+        sync(device)
+        start = time.perf_counter()
+        edge_counts = setup_fn(model, prune_scores, thresholds, conf.use_abs)
+        sync(device)
+        times.append(time.perf_counter() - start)
+    return min(times), edge_counts
+
+
+conf = Config(**OmegaConf.merge(OmegaConf.structured(Config()), OmegaConf.from_cli(sys.argv[1:])))
+task = TASK_DICT[conf.task]
+task.init_task()
+model = task.model
+device = torch.device(task.device)
+
+prune_scores = {k: torch.randn_like(v) for k, v in model.new_prune_scores().items()}
+ranked_edges = RankedEdges(prune_scores, use_abs=conf.use_abs)
+edge_counts = torch.linspace(0, model.n_edges, conf.n_thresholds).round().int().tolist()
+thresholds = ranked_edges.thresholds(edge_counts)
+
+results = {}
+for name, setup_fn in [("per module", per_module_mask_setup), ("fused", fused_mask_setup)]:
+    results[name] = time_mask_setup(setup_fn, model, prune_scores, thresholds, conf, device)
+assert results["per module"][1] == results["fused"][1], "edge counts differ"
+
+print(f"{conf.task}: {model.n_edges} edges, {len(model.dest_wrappers)} dest modules, {len(thresholds)} thresholds")
+print(f"{'mask setup':<12} {'total (s)':>10} {'per threshold (ms)':>20}")
+for name, (total, _) in results.items():
+    print(f"{name:<12} {total:>10.4f} {1000 * total / len(thresholds):>20.3f}")
+print(f"speedup: {results['per module'][0] / results['fused'][0]:.1f}x")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Serial run_circuits vs parallel_run_circuits (batches sharded across forked CPU
+# workers, weights in shared memory). Checks that the merged outputs match the serial
+# outputs (run with the per worker thread budget, so CPU kernels reduce in the same
+# order).
+#
+# usage: python scripts/benchmark_parallel_run_circuits.py task="Indirect Object Identification Token Circuit" n_workers=4
+
+import sys
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import torch
+from omegaconf import OmegaConf
+
+from auto_circuit.types import AblationType, PatchType
+
+from elk_experiments.auto_circuit.auto_circuit_utils import run_circuits
+from elk_experiments.auto_circuit.parallel import parallel_run_circuits
+from elk_experiments.auto_circuit.tasks import TASK_DICT
+
+
+@dataclass
+class Config:
+    task: str = "Docstring Component Circuit"
+    n_workers: int = 4
+    threads_per_worker: Optional[int] = None
+    n_edge_counts: int = 8
+    ablation_type: str = "TOKENWISE_MEAN_CORRUPT"
+
+
+conf = Config(**OmegaConf.merge(OmegaConf.structured(Config()), OmegaConf.from_cli(sys.argv[1:])))
+task = TASK_DICT[conf.task]
+task.init_task()
+assert task.device == "cpu" or torch.device(task.device).type == "cpu", "parallel_run_circuits is for CPU"
+threads_per_worker = conf.threads_per_worker or max(1, torch.get_num_threads() // conf.n_workers)
+
+prune_scores = {k: torch.randn_like(v) for k, v in task.model.new_prune_scores().items()}
+kwargs = dict(
+    prune_scores=prune_scores,
+    test_edge_counts=torch.linspace(0, task.model.n_edges, conf.n_edge_counts).round().int().tolist(),
+    patch_type=PatchType.TREE_PATCH,
+    ablation_type=AblationType[conf.ablation_type],
+)
+
+n_threads = torch.get_num_threads()
+torch.set_num_threads(threads_per_worker)
+start = time.perf_counter()
+serial_outs = run_circuits(task.model, task.test_loader, **kwargs)
+serial_time = time.perf_counter() - start
+torch.set_num_threads(n_threads)
+
+start = time.perf_counter()
+parallel_outs = parallel_run_circuits(
+    task.model, task.test_loader, n_workers=conf.n_workers, threads_per_worker=threads_per_worker, **kwargs
+)
+parallel_time = time.perf_counter() - start
+
+assert list(serial_outs.keys()) == list(parallel_outs.keys()), "edge counts differ"
+for edge_count, serial_batch_outs in serial_outs.items():
+    assert list(serial_batch_outs.keys()) == list(parallel_outs[edge_count].keys()), "batches differ"
+    for batch_key, out in serial_batch_outs.items():
+        assert torch.equal(out, parallel_outs[edge_count][batch_key]), f"outputs differ ({edge_count} edges)"
+
+print(f"{conf.task}: {len(task.test_loader)} batches, {len(serial_outs)} edge counts")
+print(f"serial ({threads_per_worker} threads): {serial_time:.2f}s")
+print(f"parallel ({conf.n_workers} workers x {threads_per_worker} threads): {parallel_time:.2f}s")
+print(f"speedup: {serial_time / parallel_time:.1f}x")
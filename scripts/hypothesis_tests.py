@@ -48,6 +48,8 @@ torch.cuda.is_available()
 
 
 import os
+import atexit
+from functools import partial
 from typing import Callable, Dict, Tuple, Union, Optional, Any, Literal, NamedTuple
 from itertools import product
 from copy import deepcopy
@@ -65,18 +67,26 @@ import matplotlib.pyplot as plt
 
 from omegaconf import OmegaConf
 
-from auto_circuit.types import BatchKey, AblationType
+from auto_circuit.types import BatchKey, AblationType, PatchType
 from auto_circuit.prune_algos.mask_gradient import mask_gradient_prune_scores
 from auto_circuit.visualize import draw_seq_graph
 from auto_circuit.utils.custom_tqdm import tqdm
-from auto_circuit.utils.tensor_ops import desc_prune_scores, prune_scores_threshold
 
-from elk_experiments.auto_circuit.score_funcs import GradFunc, AnswerFunc
+from elk_experiments.auto_circuit.score_funcs import GradFunc, AnswerFunc, get_score_func
+from elk_experiments.auto_circuit.auto_circuit_utils import run_circuits
+from elk_experiments.auto_circuit.ranked_edges import RankedEdges
+from elk_experiments.auto_circuit.edge_index import edge_index
+from elk_experiments.auto_circuit.prefix_cache import LayerPrefixCache
 
 from elk_experiments.auto_circuit.hypo_tests.equiv_test import (
     Side,
+    EquivMemo,
+    EquivTestMode,
     equiv_test,
     sweep_search_smallest_equiv,
+    gallop_search_smallest_equiv,
+    seeded_search_smallest_equiv,
+    EdgeCountEstimate,
     plot_num_ablated_C_gt_M, 
     plot_circuit_and_model_scores,
     compute_knees, 
@@ -89,8 +99,8 @@ from elk_experiments.auto_circuit.hypo_tests.minimality_test import (
     plot_score_quantiles,
 )
 from elk_experiments.auto_circuit.hypo_tests.indep_test import independence_test
+from elk_experiments.auto_circuit.hypo_tests.model_output_cache import ModelOutputCache
 from elk_experiments.auto_circuit.hypo_tests.utils import (
-    get_edge_idx, 
     edges_from_mask, 
     result_to_json
 )
@@ -102,7 +112,10 @@ from elk_experiments.auto_circuit.edge_graph import (
     edge_in_path
 )
 from elk_experiments.auto_circuit.tasks import TASK_DICT
-from elk_experiments.utils import OUTPUT_DIR, repo_path_to_abs_path, load_cache, save_cache, save_json
+from elk_experiments.artifact_store import ArtifactStore
+from elk_experiments.profiler import PROFILER
+from elk_experiments.auto_circuit.src_ablation_cache import SRC_ABLATION_CACHE
+from elk_experiments.utils import OUTPUT_DIR, repo_path_to_abs_path, save_json
 
 
 # In[4]:
@@ -129,6 +142,16 @@ class Config:
     max_edges_to_test_without_fail: int = 500 #TODO: change to 125
     max_edges_to_sample: int = 100 # TODO: change to 125
     save_cache: bool = True
+    circuits_per_forward: int = 1
+    incremental_masks: bool = False
+    reuse_prefix: bool = False # resume circuit forward passes from the first changed layer
+    prefix_cache_max_batches: Optional[int] = None # bound on the batches cached (None: every batch of a loader)
+    artifact_max_gb: Optional[float] = None
+    profile: bool = False # write a chrome trace and span summary to the experiment dir
+    equiv_mode: Union[EquivTestMode, str] = EquivTestMode.FULL # sequential / halving stop non equiv circuits early
+    equiv_search: str = "sweep" # or "gallop" (multi probe galloping search) or "seeded" (bracket around equiv_seed)
+    equiv_seed: Union[EdgeCountEstimate, str] = EdgeCountEstimate.KNEE
+    edges_per_forward: Optional[int] = None # pack minimality edge ablations into batched forward passes
     
     def __post_init__(self):
         if isinstance(self.ablation_type, str):
@@ -149,10 +172,10 @@ class Config:
             self.grad_func_mask = self.grad_func
         if isinstance(self.answer_func_mask, str):
             self.answer_func_mask = AnswerFunc[self.answer_func_mask.upper()]
-        if isinstance(self.sample_type, str):
-            self.sample_type = SampleType[self.sample_type.upper()]
         elif self.answer_func_mask is None:
             self.answer_func_mask = self.answer_func
+        if isinstance(self.sample_type, str):
+            self.sample_type = SampleType[self.sample_type.upper()]
         # always override clean_corrupt for now
         self.clean_corrupt = "corrupt" if self.ablation_type == AblationType.RESAMPLE else None
         if self.epsilon < 0: 
@@ -161,6 +184,13 @@ class Config:
             self.side = Side[self.side.upper()]
         else: 
             self.side = Side.NONE if self.use_abs else Side.LEFT #TODO: fix this? for abs and negative epsilon?
+        # equivalence search options (independent of the defaults above)
+        if isinstance(self.equiv_mode, str):
+            self.equiv_mode = EquivTestMode[self.equiv_mode.upper()]
+        if isinstance(self.equiv_seed, str):
+            self.equiv_seed = EdgeCountEstimate[self.equiv_seed.upper()]
+        if self.equiv_search not in ("sweep", "gallop", "seeded"):
+            raise ValueError(f"unknown equiv_search: {self.equiv_search}")
 
 
 # In[5]:
@@ -188,6 +218,22 @@ exp_dir = score_dir / f"{conf.use_abs}_{conf.alpha}_{conf.epsilon}_{conf.q_star}
 #     print(f"Experiment directory {exp_dir} already exists. Exiting.")
 #     exit()
 exp_dir.mkdir(exist_ok=True)
+# prune scores and circuit outputs, keyed by the config that produced them
+artifact_store = ArtifactStore(
+    out_dir / "artifacts", 
+    max_bytes=int(conf.artifact_max_gb * 2**30) if conf.artifact_max_gb is not None else None
+)
+atexit.register(artifact_store.flush) # access times of the last reads
+# profile the pipeline (written on exit, including early exits)
+if conf.profile:
+    PROFILER.enable()
+    atexit.register(lambda: (
+        PROFILER.write_chrome_trace(exp_dir / "profile_trace.json"),
+        PROFILER.write_summary(exp_dir / "profile_summary.txt"),
+    ))
+# persist dataset mean src ablations (shared by every run_circuits call)
+if conf.save_cache:
+    SRC_ABLATION_CACHE.artifact_store = artifact_store
 
 
 # In[7]:
@@ -195,15 +241,28 @@ exp_dir.mkdir(exist_ok=True)
 
 # initialize task
 task = TASK_DICT[conf.task]
-task.init_task()
+with PROFILER.span("init_task"):
+    task.init_task()
+if conf.profile:
+    PROFILER.instrument_model(task.model)
 
 
 # In[8]:
 
 
-# compute edge scores
+# compute edge scores (or load them if already computed with the same config)
 # TODO: pass full model
-prune_scores = mask_gradient_prune_scores(
+prune_scores_config = {
+    "artifact": "prune_scores",
+    "task": conf.task,
+    "model": task.model.cfg.model_name,
+    "ablation_type": conf.ablation_type,
+    "grad_func": conf.grad_func_mask,
+    "answer_func": conf.answer_func_mask,
+    "ig_samples": conf.ig_samples,
+    "clean_corrupt": conf.clean_corrupt,
+}
+compute_prune_scores = lambda: mask_gradient_prune_scores(
     model=task.model, 
     dataloader=task.train_loader,
     official_edges=None,
@@ -214,27 +273,53 @@ prune_scores = mask_gradient_prune_scores(
     integrated_grad_samples=conf.ig_samples, 
     clean_corrupt=conf.clean_corrupt,
 )
-if conf.save_cache:
-    save_cache(prune_scores, exp_dir, "prune_scores")
+with PROFILER.span("prune_scores"):
+    if conf.save_cache:
+        prune_scores = artifact_store.get_or_compute(
+            prune_scores_config, compute_prune_scores, device=task.device, lazy=False
+        )
+    else:
+        prune_scores = compute_prune_scores()
+# ranked once, reused for every threshold below
+ranked_edges = RankedEdges(prune_scores, use_abs=conf.use_abs)
 
 
 # In[9]:
 
 
-model_out_train: dict[BatchKey, torch.Tensor] = {
-    batch.key: task.model(batch.clean)[task.model.out_slice] 
-    for batch in task.train_loader
-}
-model_out_test: dict[BatchKey, torch.Tensor] = {
-    batch.key: task.model(batch.clean)[task.model.out_slice] 
-    for batch in task.test_loader
-}
+# cache of circuit activations below the first layer with changed masks (per batch),
+# cleared after each stage so it only holds one loader's batches (at most
+# prefix_cache_max_batches) at a time
+prefix_cache = (
+    LayerPrefixCache(task.model, max_batches=conf.prefix_cache_max_batches) if conf.reuse_prefix else None
+)
+
+
+# full model outputs, computed once and shared by every hypothesis test
+model_out_cache = ModelOutputCache(cache_dir=score_dir / "model_out")
+model_out_train: dict[BatchKey, torch.Tensor] = model_out_cache.batch_outputs(task.model, task.train_loader)
+model_out_test: dict[BatchKey, torch.Tensor] = model_out_cache.batch_outputs(task.model, task.test_loader)
 
 
 # In[10]:
 
 
-equiv_results, min_equiv = sweep_search_smallest_equiv(
+# per instance scores of every tested edge count (persisted, so reruns with a different
+# alpha / epsilon / side reuse them without forward passes)
+equiv_memo_config = {
+    **prune_scores_config,
+    "split": "train",
+    "use_abs": conf.use_abs,
+    "score_grad_func": conf.grad_func,
+    "score_answer_func": conf.answer_func,
+}
+equiv_memo = EquivMemo(artifact_store, equiv_memo_config) if conf.save_cache else EquivMemo()
+search_smallest_equiv = {
+    "sweep": sweep_search_smallest_equiv,
+    "gallop": gallop_search_smallest_equiv,
+    "seeded": partial(seeded_search_smallest_equiv, estimate=conf.equiv_seed),
+}[conf.equiv_search]
+equiv_results, min_equiv = search_smallest_equiv(
     model=task.model, 
     dataloader=task.train_loader,
     prune_scores=prune_scores,
@@ -246,7 +331,14 @@ equiv_results, min_equiv = sweep_search_smallest_equiv(
     alpha=conf.alpha,
     epsilon=conf.epsilon,
     model_out=model_out_train,
+    circuits_per_forward=conf.circuits_per_forward,
+    incremental_masks=conf.incremental_masks,
+    prefix_cache=prefix_cache,
+    memo=equiv_memo,
+    mode=conf.equiv_mode,
 )
+if prefix_cache is not None:
+    prefix_cache.clear()
 save_json({k: result_to_json(v) for k, v in equiv_results.items()}, exp_dir, "equiv_results")
 
 
@@ -273,9 +365,9 @@ save_json(result_to_json(equiv_test_result), exp_dir, "equiv_test_result")
 # In[12]:
 
 
-threshold = prune_scores_threshold(prune_scores, min_equiv, use_abs=conf.use_abs)
+threshold = ranked_edges.threshold(min_equiv)
 edge_mask = {k: (torch.abs(v) if conf.use_abs else v) >= threshold for k, v in prune_scores.items()}
-edges = edges_from_mask(task.model.srcs, task.model.dests, edge_mask, token=task.token_circuit)
+edges = edges_from_mask(task.model.srcs, task.model.dests, edge_mask, token=task.token_circuit, model=task.model)
 save_json([edge.name for edge in edges], exp_dir, "edges")
 
 
@@ -341,7 +433,8 @@ if valid_edges_equiv_result.not_equiv:
 else: 
     edges_under_test = valid_edges
     circuit_prune_scores = valid_edge_scores
-edges_under_test_scores = {edge: prune_scores[edge.dest.module_name][get_edge_idx(edge, tokens=task.token_circuit)] for edge in edges_under_test}
+edges_under_test_score_vals = edge_index(task.model).gather(prune_scores, edge_index(task.model).edge_ids(edges_under_test))
+edges_under_test_scores = dict(zip(edges_under_test, edges_under_test_score_vals))
 edges_under_test = sorted(edges_under_test_scores.keys(), key=lambda x: abs(edges_under_test_scores[x]), reverse=False)
 
 
@@ -380,7 +473,7 @@ fig.savefig(repo_path_to_abs_path(exp_dir / "circuit_model_scores.png"))
 
 # plot attribution scores 
 import numpy as np
-edge_scores = np.flip(desc_prune_scores(prune_scores, use_abs=conf.use_abs).detach().cpu().numpy())
+edge_scores = np.flip(ranked_edges.desc_scores.detach().cpu().numpy())
 if not conf.use_abs:
     edge_scores = edge_scores[edge_scores > 0]
 kneedle_poly, kneedle_1d = compute_knees(edge_scores)
@@ -431,6 +524,35 @@ assert all([any([edge in complement_edges for edge in path]) for path in filtere
 
 
 # run minimality test
+circuit_scores_config = {
+    **prune_scores_config,
+    "artifact": "circuit_scores",
+    "score_grad_func": conf.grad_func,
+    "score_answer_func": conf.answer_func,
+    "split": "test",
+    "use_abs": conf.use_abs,
+    "edge_count": len(edges_under_test),
+    "valid_edges": edges_under_test is valid_edges,
+}
+compute_circuit_scores = lambda: dict(next(iter(run_circuits(
+    model=task.model, 
+    dataloader=task.test_loader,
+    test_edge_counts=[len(edges_under_test)],
+    prune_scores=circuit_prune_scores,
+    patch_type=PatchType.TREE_PATCH,
+    ablation_type=conf.ablation_type,
+    reverse_clean_corrupt=False,
+    use_abs=conf.use_abs,
+    reducer=get_score_func(conf.grad_func, conf.answer_func),
+).values())))
+if conf.save_cache:
+    circuit_scores_test = artifact_store.get_or_compute(
+        circuit_scores_config, compute_circuit_scores, device=task.device, lazy=False
+    )
+else:
+    circuit_scores_test = compute_circuit_scores()
+# batched edge ablations run every edge from the first layer (no prefix reuse)
+min_prefix_cache = prefix_cache if conf.edges_per_forward is None else None
 min_test_results, min_test_sampled_results = minimality_test(
     model=task.model, 
     dataloader=task.test_loader,
@@ -441,6 +563,7 @@ min_test_results, min_test_sampled_results = minimality_test(
     grad_function=conf.grad_func,
     answer_function=conf.answer_func,
     filtered_paths=filtered_paths_uniform,
+    circuit_scores=circuit_scores_test,
     use_abs=conf.use_abs,
     tokens=task.token_circuit,
     alpha=conf.alpha, 
@@ -448,7 +571,11 @@ min_test_results, min_test_sampled_results = minimality_test(
     max_edges_in_order=conf.max_edges_to_test_in_order,
     max_edges_in_order_without_fail=conf.max_edges_to_test_without_fail,
     max_edges_to_sample=conf.max_edges_to_sample,
+    prefix_cache=min_prefix_cache,
+    edges_per_forward=conf.edges_per_forward,
 )
+if prefix_cache is not None:
+    prefix_cache.clear()
 save_json({e.name: result_to_json(r) for e, r in min_test_results.items()}, exp_dir, "min_test_results")
 save_json({e.name: result_to_json(r) for e, r in min_test_sampled_results.items()}, exp_dir, "min_test_sampled_results")
 
@@ -481,7 +608,11 @@ if not true_edges_tested:
         max_edges_in_order=conf.max_edges_to_test_in_order,
         max_edges_in_order_without_fail=conf.max_edges_to_test_without_fail,
         max_edges_to_sample=conf.max_edges_to_sample,
+        prefix_cache=min_prefix_cache,
+        edges_per_forward=conf.edges_per_forward,
     )
+    if prefix_cache is not None:
+        prefix_cache.clear()
     save_json({e.name: result_to_json(r) for e, r in min_test_true_edge_results.items()}, score_dir, f"min_test_true_edge_results_{min_postfix_full}")
     save_json({e.name: result_to_json(r) for e, r in min_test_true_edge_sampled_results.items()}, score_dir, f"min_test_true_edge_sampled_results_{conf.max_edges_to_sample}_{min_postfix}")
 
@@ -576,7 +707,8 @@ indep_result = independence_test(
     answer_function=conf.answer_func,
     threshold=threshold, 
     use_abs=conf.use_abs,
-    B=1000
+    B=1000,
+    model_out_cache=model_out_cache,
 ) 
 save_json(result_to_json(indep_result), exp_dir, "indep_result")
 
@@ -595,7 +727,8 @@ if not true_edges_tested:
         threshold=1.0, 
         use_abs=True,
         alpha=conf.alpha,
-        B=1000
+        B=1000,
+        model_out_cache=model_out_cache,
     )
     save_json(result_to_json(indep_true_edge_result), score_dir, f"indep_true_edge_result")
 